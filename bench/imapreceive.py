@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# Benchmark of receiving IMAP responses over SSL
+# Copyright (C) 2002-2007 John Goerzen <jgoerzen@complete.org>
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+"""Streams a FETCH response with a big literal, and a long SEARCH
+response line, over SSL on a local socketpair, and times reading them
+through the receive buffer of imaplibutil.WrappedIMAP4_SSL and through
+the one it had before (a string, refilled 1024 bytes at a time by
+readline() and at most 16K at a time by read()):
+
+    python bench/imapreceive.py [literal megabytes]
+
+100 MB by default.  The openssl command makes the self-signed
+certificate of the server end."""
+
+import os, sys, new, time, socket, ssl, shutil, subprocess, tempfile, threading
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from offlineimap.imaplibutil import WrappedIMAP4_SSL
+
+class OldWrappedIMAP4_SSL(WrappedIMAP4_SSL):
+    """The receive buffer of WrappedIMAP4_SSL as it was before."""
+
+    def _read_upto(self, n):
+        bytesfrombuf = min(n, len(self._readbuf))
+        if bytesfrombuf:
+            retval = self._readbuf[:bytesfrombuf]
+            self._readbuf = self._readbuf[bytesfrombuf:]
+            return retval
+        return self.sslobj.read(min(n, 16384))
+
+    def read(self, n):
+        chunks = []
+        read = 0
+        while read < n:
+            data = self._read_upto(n - read)
+            read += len(data)
+            chunks.append(data)
+        return ''.join(chunks)
+
+    def readline(self):
+        retval = ''
+        while 1:
+            linebuf = self._read_upto(1024)
+            nlindex = linebuf.find("\n")
+            if nlindex != -1:
+                retval += linebuf[:nlindex + 1]
+                self._readbuf = linebuf[nlindex + 1:] + self._readbuf
+                return retval
+            else:
+                retval += linebuf
+
+def makecert(tmpdir):
+    certfile = os.path.join(tmpdir, 'cert.pem')
+    devnull = open(os.devnull, 'w')
+    try:
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey',
+                               'rsa:2048', '-nodes', '-days', '1',
+                               '-subj', '/CN=localhost',
+                               '-keyout', certfile, '-out', certfile],
+                              stdout = devnull, stderr = devnull)
+    finally:
+        devnull.close()
+    return certfile
+
+def serve(sock, certfile, responses):
+    sslobj = ssl.wrap_socket(sock, certfile = certfile, server_side = True)
+    for response in responses:
+        sslobj.sendall(response)
+    sslobj.close()
+
+def getclient(imapclass, certfile, responses):
+    """Returns an imapclass object reading responses from a server
+    thread, without the IMAP greeting and login."""
+    # ssl wants socket.socket objects, which socketpair() does not make.
+    serversock, clientsock = [socket.socket(_sock = sock) \
+                              for sock in socket.socketpair()]
+    thread = threading.Thread(target = serve,
+                              args = (serversock, certfile, responses))
+    thread.setDaemon(1)
+    thread.start()
+    imapobj = new.instance(imapclass)
+    if imapclass == OldWrappedIMAP4_SSL:
+        imapobj._readbuf = ''
+    else:
+        imapobj._readbuf = bytearray()
+        imapobj._readpos = 0
+    imapobj.sslobj = ssl.wrap_socket(clientsock)
+    return imapobj, thread
+
+def fetchliteral(imapobj):
+    # As imaplib._get_response() does.
+    line = imapobj.readline()
+    size = int(line[line.rindex('{') + 1:-3])
+    data = imapobj.read(size)
+    imapobj.readline()
+    return len(data)
+
+def searchline(imapobj):
+    return len(imapobj.readline())
+
+def timeit(imapclass, certfile, responses, func):
+    imapobj, thread = getclient(imapclass, certfile, responses)
+    start = time.time()
+    size = func(imapobj)
+    seconds = time.time() - start
+    thread.join()
+    return size, seconds
+
+def main():
+    megabytes = 100
+    if len(sys.argv) > 1:
+        megabytes = int(sys.argv[1])
+    literal = os.urandom(1024 * 1024) * megabytes
+    fetch = ['* 1 FETCH (UID 1 BODY[] {%d}\r\n' % len(literal), literal,
+             ')\r\n']
+    search = ['* SEARCH %s\r\n' % ' '.join([str(uid) for uid \
+                                            in xrange(1, 1000001)])]
+    tmpdir = tempfile.mkdtemp()
+    try:
+        certfile = makecert(tmpdir)
+        for name, responses, func in \
+                [('%d MB literal' % megabytes, fetch, fetchliteral),
+                 ('SEARCH line', search, searchline)]:
+            for label, imapclass in [('before', OldWrappedIMAP4_SSL),
+                                     ('now', WrappedIMAP4_SSL)]:
+                size, seconds = timeit(imapclass, certfile, responses, func)
+                print "%-15s %-7s %9d bytes %7.3fs %8.1f MB/s" % \
+                      (name, label, size, seconds,
+                       size / seconds / 1024 / 1024)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# Benchmark of scanning Maildir folders
+# Copyright (C) 2002-2007 John Goerzen <jgoerzen@complete.org>
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+"""Times MaildirFolder._scanfolder() on a folder of empty messages,
+with and without the scan index, against the scan from before the index
+(which listed and parsed every file name each time):
+
+    python bench/maildirscan.py [messages [directory]]
+
+The folder is built below directory, /dev/shm by default, so that the
+disk does not get in the way; it is removed afterwards."""
+
+import os, sys, time, shutil, tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from offlineimap.messagetable import MessageTable
+from offlineimap.folder.Maildir import MaildirFolder, uidmatchre, flagmatchre
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+class FakeUI:
+    def debug(self, debugtype, msg):
+        pass
+
+class FakeConfig:
+    def getfsync(self):
+        return False
+    def getdefaultint(self, section, option, default):
+        return default
+
+class FakeRepository:
+    def __init__(self, indexdir, scanindex):
+        self.indexdir = indexdir
+        self.scanindex = scanindex
+    def getscanindexdir(self):
+        return self.indexdir
+    def getscanindex(self):
+        return self.scanindex
+    def getsep(self):
+        return '.'
+    def checkunchanged(self, foldername):
+        return False
+    def markchanged(self, foldername):
+        pass
+
+def scanbaseline(folder):
+    """_scanfolder() as it was before the scan index, filling the
+    MessageTable the folders use now."""
+    retval = MessageTable()
+    files = []
+    nouidcounter = -1
+    foldermd5 = md5(folder.getvisiblename()).hexdigest()
+    folderstr = ',FMD5=' + foldermd5
+    for dirannex in ['new', 'cur']:
+        fulldirname = os.path.join(folder.getfullname(), dirannex)
+        files.extend(os.path.join(fulldirname, filename) for
+                     filename in os.listdir(fulldirname))
+    for file in files:
+        messagename = os.path.basename(file)
+        foldermatch = messagename.find(folderstr) != -1
+        if not foldermatch:
+            uid = nouidcounter
+            nouidcounter -= 1
+        else:
+            uidmatch = uidmatchre.search(messagename)
+            if not uidmatch:
+                uid = nouidcounter
+                nouidcounter -= 1
+            else:
+                uid = long(uidmatch.group(1))
+        flagmatch = flagmatchre.search(messagename)
+        flags = []
+        if flagmatch:
+            flags = [x for x in flagmatch.group(1)]
+        flags.sort()
+        retval[uid] = {'uid': uid, 'flags': flags, 'filename': file}
+    return retval
+
+def cputime():
+    times = os.times()
+    return times[0] + times[1]
+
+def best(func, setup = None, runs = 7):
+    """Returns the least CPU time func() took in runs runs, each after
+    calling setup() if given.  CPU time, system calls included, is much
+    less noisy than wall clock time on a busy machine."""
+    times = []
+    for i in range(runs):
+        if setup:
+            setup()
+        start = cputime()
+        func()
+        times.append(cputime() - start)
+    return min(times)
+
+def main():
+    messages = 200000
+    directory = '/dev/shm'
+    if len(sys.argv) > 1:
+        messages = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        directory = sys.argv[2]
+    tmpdir = tempfile.mkdtemp(dir = directory)
+    try:
+        root = os.path.join(tmpdir, 'mail')
+        indexdir = os.path.join(tmpdir, 'index')
+        os.mkdir(indexdir)
+        for dirannex in ['cur', 'new', 'tmp']:
+            os.makedirs(os.path.join(root, 'INBOX', dirannex))
+        folderstr = ',FMD5=' + md5('INBOX').hexdigest()
+        curdir = os.path.join(root, 'INBOX', 'cur')
+        for uid in xrange(1, messages + 1):
+            open(os.path.join(curdir, '%d_%d.host,U=%d%s:2,S' % \
+                              (1200000000 + uid, uid, uid, folderstr)),
+                 'w').close()
+
+        def getfolder(scanindex):
+            folder = MaildirFolder(root, 'INBOX', '.',
+                                   FakeRepository(indexdir, scanindex),
+                                   'Test', FakeConfig())
+            folder.ui = FakeUI()
+            return folder
+
+        def scan(scanindex):
+            getfolder(scanindex)._scanfolder()
+
+        # Let the directory mtimes age enough to be trusted.
+        scan(1)
+        time.sleep(2.1)
+        scan(1)
+
+        state = {'uid': messages}
+        def deliver():
+            # One new message, as a delivery between two syncs does.
+            state['uid'] += 1
+            uid = state['uid']
+            open(os.path.join(root, 'INBOX', 'new', '%d_%d.host' % \
+                              (1300000000 + uid, uid)), 'w').close()
+            # Older than two seconds, as between two syncs.
+            os.utime(os.path.join(root, 'INBOX', 'new'), (uid, uid))
+
+        def flag():
+            # One message marked as replied, which renames it in cur/.
+            state['uid'] += 1
+            for name in os.listdir(curdir):
+                if name.endswith(':2,S'):
+                    os.rename(os.path.join(curdir, name),
+                              os.path.join(curdir, name[:-1] + 'RS'))
+                    break
+            os.utime(curdir, (state['uid'], state['uid']))
+
+        print "%d messages in %s" % (messages, tmpdir)
+        print "before the index:    %.3fs" % best(lambda: scanbaseline(getfolder(0)))
+        print "scanindex = no:      %.3fs" % best(lambda: scan(0))
+        print "unchanged:           %.3fs" % best(lambda: scan(1))
+        print "new/ changed:        %.3fs" % best(lambda: scan(1), deliver)
+        print "cur/ changed:        %.3fs" % best(lambda: scan(1), flag)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# Benchmark of the memory message lists take
+# Copyright (C) 2002-2007 John Goerzen <jgoerzen@complete.org>
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+"""Measures the bytes per message and the build time of message lists
+kept as a hash of hashes, as the folders did before, and as a
+MessageTable, for lists like those of IMAP folders and of Maildir
+folders:
+
+    python bench/messagetable.py [messages ...]
+
+100000 and 1000000 messages by default.  Each list is built in a
+child process of its own, and its size is how much the resident set of
+that process grew, so this only works on Linux."""
+
+import os, sys, gc
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from offlineimap.messagetable import MessageTable
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+pagesize = os.sysconf('SC_PAGE_SIZE')
+
+def getrss():
+    file = open('/proc/self/statm')
+    try:
+        return int(file.read().split()[1]) * pagesize
+    finally:
+        file.close()
+
+def cputime():
+    times = os.times()
+    return times[0] + times[1]
+
+flagsets = ['S', 'RS', 'FS', '', 'S', 'S', 'DS', 'S']
+
+def imapmessages(count):
+    """Yields messages as IMAPFolder.cachemessagelist() makes them."""
+    for uid in xrange(1, count + 1):
+        yield {'uid': long(uid), 'flags': list(flagsets[uid % 8]),
+               'time': None}
+
+def maildirmessages(count):
+    """Yields messages as MaildirFolder._scanfolder() makes them."""
+    folderstr = ',FMD5=' + md5('INBOX').hexdigest()
+    prefix = '/home/user/Mail/INBOX/cur/'
+    for uid in xrange(1, count + 1):
+        flags = flagsets[uid % 8]
+        yield {'uid': long(uid), 'flags': list(flags),
+               'filename': '%s%d_%d.%d.host,U=%d%s:2,%s' % \
+               (prefix, 1200000000 + uid, uid, os.getpid(), uid, folderstr,
+                flags)}
+
+def build(listtype, messages):
+    if listtype == 'hash':
+        messagelist = {}
+    else:
+        messagelist = MessageTable()
+    for message in messages:
+        messagelist[message['uid']] = message
+    if listtype == 'table':
+        # Sorted on first use, which is part of building it.
+        len(messagelist)
+    return messagelist
+
+def measure(listtype, kind, count):
+    """Returns (bytes per message, seconds) for building a list of count
+    messages, in a child process."""
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        gc.collect()
+        rss = getrss()
+        start = cputime()
+        messagelist = build(listtype, globals()[kind + 'messages'](count))
+        seconds = cputime() - start
+        gc.collect()
+        os.write(write, "%f %f" % (float(getrss() - rss) / count, seconds))
+        os._exit(0)
+    os.close(write)
+    result = os.read(read, 100)
+    os.close(read)
+    os.waitpid(pid, 0)
+    return [float(x) for x in result.split()]
+
+def main():
+    counts = [100000, 1000000]
+    if len(sys.argv) > 1:
+        counts = [int(x) for x in sys.argv[1:]]
+    print "%-22s %17s %17s" % ('', 'hash', 'table')
+    for count in counts:
+        for kind in ['imap', 'maildir']:
+            hashbytes, hashtime = measure('hash', kind, count)
+            tablebytes, tabletime = measure('table', kind, count)
+            print "%-22s %6d B %7.2fs %6d B %7.2fs" % \
+                  ("%d %s-like" % (count, kind), hashbytes, hashtime,
+                   tablebytes, tabletime)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# Benchmark of parsing FETCH responses
+# Copyright (C) 2002-2007 John Goerzen <jgoerzen@complete.org>
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+"""Times imaputil.parsefetch() against the imapsplit(), flags2hash()
+and options2hash() path IMAPFolder took before it, on FETCH responses
+such as '1 (FLAGS (\\Seen) UID 1)' as the message list is fetched with:
+
+    python bench/parsefetch.py [responses]
+
+50000 responses by default.  Both are timed with imap debugging off
+and on; the debug messages themselves are thrown away."""
+
+import os, sys, string
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from offlineimap import imaputil
+from offlineimap.ui import setglobalui
+
+class FakeUI:
+    def __init__(self):
+        self.debuglist = []
+    def isdebugging(self, debugtype):
+        return debugtype in self.debuglist
+    def debug(self, debugtype, msg):
+        pass
+
+flagsets = ['\\Seen', '\\Answered \\Seen', '\\Flagged \\Seen', '',
+            '\\Seen', '\\Seen $Forwarded', '\\Draft', '\\Seen']
+
+def getresponses(count):
+    return ['%d (FLAGS (%s) UID %d)' % (i, flagsets[i % 8], i + 1000) \
+            for i in xrange(1, count + 1)]
+
+def oldparse(responses):
+    """What IMAPFolder._parsemessagestr() did, but the INTERNALDATE."""
+    retval = []
+    for messagestr in responses:
+        # Discard the message number.
+        messagestr = string.split(messagestr, maxsplit = 1)[1]
+        options = imaputil.flags2hash(messagestr)
+        uid = long(options['UID'])
+        flags = imaputil.flagsimap2maildir(options['FLAGS'])
+        retval.append((uid, flags))
+    return retval
+
+def newparse(responses):
+    return [(uid, flags) for uid, flags, internaldate, size \
+            in imaputil.parsefetch(responses)]
+
+def cputime():
+    times = os.times()
+    return times[0] + times[1]
+
+def best(func, runs = 5):
+    """Returns the least CPU time func() took in runs runs."""
+    times = []
+    for i in range(runs):
+        start = cputime()
+        func()
+        times.append(cputime() - start)
+    return min(times)
+
+def main():
+    count = 50000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    responses = getresponses(count)
+    ui = FakeUI()
+    setglobalui(ui)
+    if oldparse(responses) != newparse(responses):
+        raise ValueError, "parsefetch() and the old path disagree"
+    print "%d responses" % count
+    for debuglist in [[], ['imap']]:
+        ui.debuglist = debuglist
+        print "imap debugging %-4s  old path %.3fs  parsefetch() %.3fs" % \
+              (debuglist and 'on' or 'off',
+               best(lambda: oldparse(responses)),
+               best(lambda: newparse(responses)))
+
+if __name__ == '__main__':
+    main()
@@ -47,6 +47,26 @@ class CustomConfigParser(ConfigParser):
         else:
             return default
 
+    def getfsyncgroup(self):
+        """Returns True if fsync() calls are to be grouped, that is if
+        fsync = group."""
+        return self.getdefault("general", "fsync", "").strip().lower() == \
+               "group"
+
+    def getfsync(self):
+        """Returns True if OfflineIMAP is to fsync() at all."""
+        return self.getfsyncgroup() or \
+               self.getdefaultboolean("general", "fsync", True)
+
+    def getinflightbytes(self):
+        """Returns how many bytes of downloaded messages may wait to be
+        written out, or 0 if downloads are not to be pipelined."""
+        return self.getdefaultint("general", "inflightbytes", 16777216)
+
+    def getwritethreads(self):
+        """Returns how many threads write out pipelined downloads."""
+        return self.getdefaultint("general", "writethreads", 1)
+
     def getmetadatadir(self):
         metadatadir = os.path.expanduser(self.getdefault("general", "metadata", "~/.offlineimap"))
         if not os.path.exists(metadatadir):
@@ -16,19 +16,25 @@
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
 from offlineimap import threadutil, mbnames, CustomConfig
+from offlineimap.groupcommit import GroupCommit
+from offlineimap.folderstats import FolderStats
+from offlineimap.messagetable import MessageTable
+from offlineimap.syncplan import planfolder
 import offlineimap.repository.Base, offlineimap.repository.LocalStatus
 from offlineimap.ui import getglobalui
-from offlineimap.threadutil import InstanceLimitedThread, ExitNotifyThread
+from offlineimap.threadutil import ExitNotifyThread
 from subprocess import Popen, PIPE
 from threading import Event, Lock
 import os
-from Queue import Queue, Empty
+from Queue import Queue, Empty, Full
 import sys
 
 class SigListener(Queue):
     def __init__(self):
         self.folderlock = Lock()
         self.folders = None
+        self.pushedfolders = {}
+        self.localnames = {}
         Queue.__init__(self, 20)
     def put_nowait(self, sig):
         self.folderlock.acquire()
@@ -44,18 +50,68 @@ class SigListener(Queue):
                     self.quick = False
                     return
                 # else folders have already been cleared, put signal...
+                # A full resync supersedes any pushed folders.
+                self.pushedfolders = {}
         finally:
             self.folderlock.release()
         Queue.put_nowait(self, sig)
-    def addfolders(self, remotefolders, autorefreshes, quick):
+    def queuefolder(self, foldername):
+        """Called when the server reports a change to the remote folder
+        named foldername (e.g. from IDLE).  Queues that folder only."""
+        self.folderlock.acquire()
+        try:
+            if self.folders is None or not self.autorefreshes:
+                return
+            elif self.folders:
+                for foldernr, (folder, queued) in enumerate(self.folders):
+                    if folder.getname() == foldername:
+                        # requeue folder
+                        self.folders[foldernr][1] = True
+                return
+            # else folders have already been cleared: remember the
+            # folder and wake the sleeper up, unless already done.
+            pending = len(self.pushedfolders)
+            self.pushedfolders[foldername] = 1
+            if pending:
+                return
+        finally:
+            self.folderlock.release()
+        try:
+            Queue.put_nowait(self, 3)
+        except Full:
+            pass
+    def queuelocalfolder(self, foldername):
+        """Called when the local folder named foldername changed.
+        Queues the remote folder it is synced with."""
+        self.folderlock.acquire()
+        try:
+            foldername = self.localnames.get(foldername)
+        finally:
+            self.folderlock.release()
+        if foldername != None:
+            self.queuefolder(foldername)
+    def clearpushedfolders(self):
+        """Forget about pushed folders, so that the next sync covers
+        all folders again."""
+        self.folderlock.acquire()
+        self.pushedfolders = {}
+        self.folderlock.release()
+    def addfolders(self, remotefolders, autorefreshes, quick, localnames = {}):
+        """localnames maps the names of the local folders to those of
+        the remote folders they are synced with."""
         self.folderlock.acquire()
         try:
             self.folders = []
             self.quick = quick
             self.autorefreshes = autorefreshes
+            self.localnames = localnames
             for folder in remotefolders:
-                # new folders are queued
-                self.folders.append([folder, True])
+                # new folders are queued, unless only some folders
+                # were pushed to us
+                queued = not self.pushedfolders or \
+                         self.pushedfolders.has_key(folder.getname())
+                self.folders.append([folder, queued])
+            self.pushedfolders = {}
         finally:
             self.folderlock.release()
     def clearfolders(self):
@@ -113,6 +169,7 @@ class Account(CustomConfig.ConfigHelperMixin):
         self.ui = getglobalui()
         self.refreshperiod = self.getconffloat('autorefresh', 0.0)
         self.quicknum = 0
+        self.folderstats = None
         if self.refreshperiod == 0.0:
             self.refreshperiod = None
 
@@ -131,7 +188,8 @@ class Account(CustomConfig.ConfigHelperMixin):
     def sleeper(self, siglistener):
         """Sleep handler.  Returns same value as UIBase.sleep:
         0 if timeout expired, 1 if there was a request to cancel the timer,
-        and 2 if there is a request to abort the program.
+        2 if there is a request to abort the program, and 3 if the server
+        reported changes to some of the idlefolders.
 
         Also, returns 100 if configured to not sleep at all."""
         
@@ -141,12 +199,13 @@ class Account(CustomConfig.ConfigHelperMixin):
         kaobjs = []
 
         if hasattr(self, 'localrepos'):
-            kaobjs.append(self.localrepos)
+            kaobjs.append((self.localrepos, siglistener.queuelocalfolder))
         if hasattr(self, 'remoterepos'):
-            kaobjs.append(self.remoterepos)
+            kaobjs.append((self.remoterepos, siglistener.queuefolder))
 
-        for item in kaobjs:
+        for item, callback in kaobjs:
             item.startkeepalive()
+            item.startidle(callback)
         
         refreshperiod = int(self.refreshperiod * 60)
 #         try:
@@ -162,8 +221,11 @@ class Account(CustomConfig.ConfigHelperMixin):
             self.quicknum = 0
 
         # Cancel keepalive
-        for item in kaobjs:
+        for item, callback in kaobjs:
+            item.stopidle()
             item.stopkeepalive()
+        if sleepresult != 3:
+            siglistener.clearpushedfolders()
         return sleepresult
             
 class AccountSynchronizationMixin:
@@ -216,12 +278,30 @@ class AccountSynchronizationMixin:
     def getaccountmeta(self):
         return os.path.join(self.metadatadir, 'Account-' + self.name)
 
+    def getfolderstats(self):
+        """Returns the folderstats.FolderStats of the account, which
+        schedules its folder syncs."""
+        if self.folderstats == None:
+            priorityfolders = [name.strip() for name in \
+                               self.getconf('priorityfolders',
+                                            'INBOX').split(',') \
+                               if name.strip()]
+            self.folderstats = FolderStats(os.path.join(self.getaccountmeta(),
+                                                        'folderstats'),
+                                           priorityfolders)
+        return self.folderstats
+
     def sync(self, siglistener):
         # We don't need an account lock because syncitall() goes through
         # each account once, then waits for all to finish.
 
+        # A dry run only shows what the folder syncs would do: no hooks,
+        # no new folders and no moves.
+        dryrun = self.config.getdefaultboolean('general', 'dryrun', 0)
+
         hook = self.getconf('presynchook', '')
-        self.callhook(hook)
+        if not dryrun:
+            self.callhook(hook)
 
         quickconfig = self.getconfint('quick', 0)
         if quickconfig < 0:
@@ -240,28 +320,54 @@ class AccountSynchronizationMixin:
             remoterepos = self.remoterepos
             localrepos = self.localrepos
             statusrepos = self.statusrepos
-            self.ui.syncfolders(remoterepos, localrepos)
-            remoterepos.syncfoldersto(localrepos, [statusrepos])
-
-            siglistener.addfolders(remoterepos.getfolders(), bool(self.refreshperiod), quick)
-
+            remoterepos.connect()
+            localrepos.connect()
+            if not dryrun:
+                self.ui.syncfolders(remoterepos, localrepos)
+                remoterepos.syncfoldersto(localrepos, [statusrepos])
+                if self.getconfboolean('detectmoves', 0):
+                    syncmoves(self.name, remoterepos, localrepos,
+                              statusrepos)
+
+            remotefolders = remoterepos.getfolders()
+            localnames = {}
+            for remotefolder in remotefolders:
+                localname = remotefolder.getvisiblename().\
+                            replace(remoterepos.getsep(), localrepos.getsep())
+                localnames[localname] = remotefolder.getname()
+            siglistener.addfolders(remotefolders, bool(self.refreshperiod),
+                                   quick, localnames)
+
+            # Accounts on the same server lend each other the threads
+            # they have no folders left for.
+            poolname = 'FOLDER_' + remoterepos.getname()
+            pool = threadutil.getWorkerPool(poolname)
+            servername = remoterepos.getservername()
+            if servername != None:
+                threadutil.joinWorkerPoolGroup(servername, poolname)
+            folderstats = self.getfolderstats()
             while True:
-                folderthreads = []
+                foldertasks = []
                 for remotefolder, quick in siglistener.queuedfolders():
-                    thread = InstanceLimitedThread(\
-                        instancename = 'FOLDER_' + self.remoterepos.getname(),
-                        target = syncfolder,
+                    priority = folderstats.getpriority(remotefolder.getname(),
+                                                       remotefolder.getvisiblename())
+                    task = pool.submit(syncfolder,
+                        (self.name, remoterepos, remotefolder, localrepos,
+                         statusrepos, quick, dryrun),
                         name = "Folder sync %s[%s]" % \
                         (self.name, remotefolder.getvisiblename()),
-                        args = (self.name, remoterepos, remotefolder, localrepos,
-                                statusrepos, quick))
-                    thread.setDaemon(1)
-                    thread.start()
-                    folderthreads.append(thread)
-                threadutil.threadsreset(folderthreads)
+                        accountname = self.name, priority = priority)
+                    foldertasks.append((remotefolder, task))
+                for remotefolder, task in foldertasks:
+                    task.wait()
+                    if task.getResult() != None:
+                        folderstats.record(remotefolder.getname(),
+                                           task.getRunTime(), task.getResult())
                 if siglistener.clearfolders():
                     break
-            mbnames.write()
+            if not dryrun:
+                folderstats.save()
+                mbnames.write()
             localrepos.forgetfolders()
             remoterepos.forgetfolders()
             localrepos.holdordropconnections()
@@ -270,7 +376,8 @@ class AccountSynchronizationMixin:
             pass
 
         hook = self.getconf('postsynchook', '')
-        self.callhook(hook)
+        if not dryrun:
+            self.callhook(hook)
 
     def callhook(self, cmd):
         if not cmd:
@@ -289,11 +396,127 @@ class AccountSynchronizationMixin:
 class SyncableAccount(Account, AccountSynchronizationMixin):
     pass
 
+def syncmoves(accountname, remoterepos, localrepos, statusrepos):
+    """Finds the messages that were moved from one local folder to
+    another since the last sync, and moves them on the server as well,
+    instead of uploading them to their new folder and deleting them from
+    their old one later on.
+
+    A message counts as moved if it disappeared from one local folder
+    while a new message with the same imaputil.messagekey() showed up in
+    another, and there is no other message with that key on either side.
+    Local files are renamed to their new UIDs, and the status folders
+    updated, so that the folder syncs find nothing left to do."""
+    ui = getglobalui()
+    folders = []
+    for remotefolder in remoterepos.getfolders():
+        name = remotefolder.getvisiblename()
+        localfolder = localrepos.getfolder(name.replace(remoterepos.getsep(),
+                                                        localrepos.getsep()))
+        statusfolder = statusrepos.getfolder(name.\
+                                             replace(remoterepos.getsep(),
+                                                     statusrepos.getsep()))
+        if statusfolder.isnewfolder():
+            continue
+        statusfolder.cachemessagelist()
+        localfolder.cachemessagelist()
+        localmessages = localfolder.getmessagelist()
+        gone = [uid for uid in statusfolder.getmessagelist().keys() \
+                if uid > 0 and not uid in localmessages]
+        new = [uid for uid in localmessages.keys() if uid < 0]
+        if len(gone) or len(new):
+            folders.append((remotefolder, localfolder, statusfolder,
+                            gone, new))
+    if not [f for f in folders if f[3]] or not [f for f in folders if f[4]]:
+        return
+
+    # Match up the keys of the messages gone with those of the new ones.
+    gonekeys = {}
+    newkeys = {}
+    for i in range(len(folders)):
+        remotefolder, localfolder, statusfolder, gone, new = folders[i]
+        try:
+            if len(gone) and remotefolder.isuidvalidityok():
+                for uid, key in remotefolder.getmessagekeys(gone).items():
+                    gonekeys.setdefault(key, []).append((i, uid))
+            if len(new):
+                for uid, key in localfolder.getmessagekeys(new).items():
+                    newkeys.setdefault(key, []).append((i, uid))
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            ui.warn("ERROR looking for moved messages in %s folder %s: %s" % \
+                    (accountname, remotefolder.getvisiblename(),
+                     sys.exc_info()[1]))
+    moves = {}
+    for key, sources in gonekeys.items():
+        dests = newkeys.get(key, [])
+        if len(sources) != 1 or len(dests) != 1:
+            continue
+        (source, uid), (dest, localuid) = sources[0], dests[0]
+        if source != dest:
+            moves.setdefault((source, dest), []).append((uid, localuid))
+
+    for (source, dest), pairs in moves.items():
+        remotesource, localsource, statussource = folders[source][:3]
+        remotedest, localdest, statusdest = folders[dest][:3]
+        pairs.sort()
+        ui.movingmessages([uid for uid, localuid in pairs], remotesource,
+                          remotedest)
+        try:
+            newuids = remotesource.movemessagesto([uid for uid, localuid \
+                                                   in pairs], remotedest)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            ui.warn("ERROR moving messages from %s to %s for account %s: %s" \
+                    % (remotesource.getvisiblename(),
+                       remotedest.getvisiblename(), accountname,
+                       sys.exc_info()[1]))
+            continue
+        if newuids == None:
+            # The server cannot move messages; leave it to the folder syncs.
+            return
+        statussource.doautosave = 0
+        statusdest.doautosave = 0
+        try:
+            for uid, localuid in pairs:
+                # The server copy still has the flags last synced, so
+                # that the folder sync pushes any local change.
+                flags = statussource.getmessageflags(uid)
+                newuid = newuids.get(uid, 0)
+                if newuid:
+                    localdest.changemessageuid(localuid, newuid)
+                    statusdest.savemessage(newuid, '', flags, None)
+                else:
+                    localdest.deletemessage(localuid) # It'll be re-downloaded.
+                statussource.deletemessage(uid)
+        finally:
+            statussource.doautosave = 1
+            statusdest.doautosave = 1
+            statussource.save()
+            statusdest.save()
+
+def uidvalidityok(folder, dryrun):
+    """Returns what folder.isuidvalidityok() does, without saving the
+    UID validity of a folder which has none yet if dryrun is set."""
+    if dryrun:
+        saved = folder.getsaveduidvalidity()
+        return saved == None or saved == folder.getuidvalidity()
+    return folder.isuidvalidityok()
+
 def syncfolder(accountname, remoterepos, remotefolder, localrepos,
-               statusrepos, quick):
+               statusrepos, quick, dryrun = 0):
+    """Syncs remotefolder with its local and status folders.  The whole
+    sync is planned first, with syncplan.planfolder(), and then carried
+    out; with dryrun, the plan is only shown, and nothing is changed.
+
+    Returns whether the sync changed anything, or None if the folder was
+    not synced in full."""
     global mailboxes
     ui = getglobalui()
     ui.registerthread(accountname)
+    fsyncgroup = None
     try:
         # Load local folder.
         localfolder = localrepos.\
@@ -306,12 +529,31 @@ def syncfolder(accountname, remoterepos, remotefolder, localrepos,
         statusfolder = statusrepos.getfolder(remotefolder.getvisiblename().\
                                              replace(remoterepos.getsep(),
                                                      statusrepos.getsep()))
+        statuslist = None
+        statusisnew = None
         if localfolder.getuidvalidity() == None:
             # This is a new folder, so delete the status cache to be sure
             # we don't have a conflict.
-            statusfolder.deletemessagelist()
+            if dryrun:
+                statuslist = MessageTable()
+                statusisnew = 1
+            else:
+                statusfolder.deletemessagelist()
 
         statusfolder.cachemessagelist()
+        if statuslist == None:
+            statuslist = statusfolder.getmessagelist()
+
+        config = localrepos.getconfig()
+        if config.getfsyncgroup() and not dryrun:
+            fsyncgroup = GroupCommit(config.getdefaultint("general",
+                                                          "fsyncgroupsize",
+                                                          100),
+                                     config.getdefaultint("general",
+                                                          "fsyncgroupdelay",
+                                                          1000) / 1000.0)
+            localfolder.setfsyncgroup(fsyncgroup)
+            statusfolder.setfsyncgroup(fsyncgroup)
 
         if quick:
             if not localfolder.quickchanged(statusfolder) \
@@ -323,23 +565,29 @@ def syncfolder(accountname, remoterepos, remotefolder, localrepos,
         # Load local folder
         ui.syncingfolder(remoterepos, remotefolder, localrepos, localfolder)
         ui.loadmessagelist(localrepos, localfolder)
-        localfolder.cachemessagelist()
-        ui.messagelistloaded(localrepos, localfolder, len(localfolder.getmessagelist().keys()))
+        if dryrun and localfolder.getvisiblename() not in \
+               [folder.getvisiblename() for folder in localrepos.getfolders()]:
+            # It would have been created by now.
+            locallist = MessageTable()
+        else:
+            localfolder.cachemessagelist()
+            locallist = localfolder.getmessagelist()
+        ui.messagelistloaded(localrepos, localfolder, len(locallist.keys()))
 
         # If either the local or the status folder has messages and there is a UID
         # validity problem, warn and abort.  If there are no messages, UW IMAPd
         # loses UIDVALIDITY.  But we don't really need it if both local folders are
         # empty.  So, in that case, just save it off.
-        if len(localfolder.getmessagelist()) or len(statusfolder.getmessagelist()):
-            if not localfolder.isuidvalidityok():
+        if len(locallist) or len(statuslist):
+            if not uidvalidityok(localfolder, dryrun):
                 ui.validityproblem(localfolder)
                 localrepos.restore_atime()
                 return
-            if not remotefolder.isuidvalidityok():
+            if not uidvalidityok(remotefolder, dryrun):
                 ui.validityproblem(remotefolder)
                 localrepos.restore_atime()
                 return
-        else:
+        elif not dryrun:
             localfolder.saveuidvalidity()
             remotefolder.saveuidvalidity()
 
@@ -350,32 +598,54 @@ def syncfolder(accountname, remoterepos, remotefolder, localrepos,
                              len(remotefolder.getmessagelist().keys()))
 
 
-        #
-
-        if not statusfolder.isnewfolder():
-            # Delete local copies of remote messages.  This way,
-            # if a message's flag is modified locally but it has been
-            # deleted remotely, we'll delete it locally.  Otherwise, we
-            # try to modify a deleted message's flags!  This step
-            # need only be taken if a statusfolder is present; otherwise,
-            # there is no action taken *to* the remote repository.
-
-            remotefolder.syncmessagesto_delete(localfolder, [localfolder,
-                                                             statusfolder])
-            ui.syncingmessages(localrepos, localfolder, remoterepos, remotefolder)
-            localfolder.syncmessagesto(statusfolder, [remotefolder, statusfolder])
+        # Plan the whole sync.  Messages deleted remotely are deleted
+        # locally first, so that a local flag change to one of them is
+        # not pushed to the server; local changes are then pushed, and
+        # remote ones pulled, and the status folder gets the result.
+        plans = planfolder(remotefolder, localfolder, statusfolder,
+                           locallist, statuslist, statusisnew)
+        if dryrun:
+            nbytes = 0
+            roundtrips = 0
+            for plan in plans:
+                nbytes += plan.getbytes()
+                roundtrips += plan.getroundtrips()
+            ui.syncplan(remotefolder, plans, nbytes, roundtrips)
+            localrepos.restore_atime()
+            return
 
-        # Synchronize remote changes.
-        ui.syncingmessages(remoterepos, remotefolder, localrepos, localfolder)
-        remotefolder.syncmessagesto(localfolder, [localfolder, statusfolder])
+        changed = 0
+        for plan in plans:
+            if not plan.isempty():
+                changed = 1
+
+        # The deletes and flag changes are a few bulk commands; get them
+        # out of the way before the message bodies.  The plans for the
+        # status folder on its own only count once the others are done.
+        for plan in plans[:-1]:
+            ui.syncingmessages(plan.src.getrepository(), plan.src,
+                               plan.dest.getrepository(), plan.dest)
+            plan.executechanges()
+        for plan in plans[:-1]:
+            plan.executecopies()
 
         # Make sure the status folder is up-to-date.
         ui.syncingmessages(localrepos, localfolder, statusrepos, statusfolder)
         localfolder.syncmessagesto(statusfolder)
         statusfolder.save()
+        remotefolder.savequickstatus()
         localrepos.restore_atime()
+        return changed
     except (KeyboardInterrupt, SystemExit):
         raise
     except:
         ui.warn("ERROR in syncfolder for %s folder %s: %s" % \
                 (accountname,remotefolder.getvisiblename(),sys.exc_info()[1]))
+        if fsyncgroup != None:
+            # Do not lose track of what did make it.
+            try:
+                fsyncgroup.commit()
+            except:
+                ui.warn("ERROR saving status of %s folder %s: %s" % \
+                        (accountname, remotefolder.getvisiblename(),
+                         sys.exc_info()[1]))
@@ -0,0 +1,221 @@
+# Pipelined message copies
+# Copyright (C) 2002-2007 John Goerzen <jgoerzen@complete.org>
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+import sys, time
+from collections import deque
+from threading import Lock, Condition
+from offlineimap import imaputil
+from offlineimap.threadutil import ExitNotifyThread
+
+class ByteQueue:
+    """A queue bounded by the size of what is in flight rather than by
+    the number of items.  put() blocks while an item would take the
+    bytes in flight over maxbytes; they only go down again once the
+    consumer calls release() for an item it is done with.  An item
+    larger than maxbytes on its own still gets in once nothing else is
+    in flight, so that it cannot block forever."""
+
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.cond = Condition(Lock())
+        self.items = deque()
+        self.inflight = 0
+        self.closed = 0
+
+    def put(self, item, size):
+        """Queues item, of size bytes.  Returns how many seconds it had
+        to wait for room."""
+        start = time.time()
+        self.cond.acquire()
+        try:
+            while self.inflight and self.inflight + size > self.maxbytes:
+                self.cond.wait()
+            waited = time.time() - start
+            self.items.append((item, size))
+            self.inflight += size
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+        return waited
+
+    def get(self):
+        """Returns the next (item, size), or None once the queue is closed
+        and empty."""
+        self.cond.acquire()
+        try:
+            while not len(self.items) and not self.closed:
+                self.cond.wait()
+            if not len(self.items):
+                return None
+            return self.items.popleft()
+        finally:
+            self.cond.release()
+
+    def release(self, size):
+        """Tells that an item of size bytes got from get() is done with."""
+        self.cond.acquire()
+        try:
+            self.inflight -= size
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def close(self):
+        """No more items are coming; get() returns None once the queue is
+        empty."""
+        self.cond.acquire()
+        try:
+            self.closed = 1
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+class StageCounter:
+    """Throughput of one stage of a CopyPipeline: how many messages and
+    bytes went through it, how long its threads spent on them, and how
+    long they sat waiting for the other stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = Lock()
+        self.messages = 0
+        self.bytes = 0
+        self.busy = 0.0
+        self.stalled = 0.0
+
+    def add(self, messages, nbytes, busy, stalled):
+        self.lock.acquire()
+        try:
+            self.messages += messages
+            self.bytes += nbytes
+            self.busy += busy
+            self.stalled += stalled
+        finally:
+            self.lock.release()
+
+    def getrate(self):
+        """Returns the bytes per second a thread of the stage gets
+        through, not counting the time it waits, or None if unknown."""
+        if self.busy <= 0:
+            return None
+        return self.bytes / self.busy
+
+def getsize(message):
+    """Returns the size of the file-like object message, as
+    imaputil.LineEndingFile.getsize() has it for those, which can only be
+    rewound.  Other files are left at their start."""
+    if hasattr(message, 'getsize'):
+        return message.getsize()
+    message.seek(0, 2)
+    size = message.tell()
+    message.seek(0)
+    return size
+
+class CopyPipeline:
+    """Copies messages of the folder src to the folders in applyto in
+    two stages, so that the network and the disk are busy at the same
+    time: fetch() downloads messages and queues them up, and writer
+    threads save them, as BaseFolder.copymessagesto() would.  At most
+    maxbytes of messages are between the two stages at any time, which
+    holds back fetch() when the writers fall behind.
+
+    fetchstats and writestats count what each stage got through;
+    finish() hands them to the UI."""
+
+    def __init__(self, src, applyto, maxbytes, writers):
+        self.src = src
+        self.applyto = applyto
+        self.ui = src.ui
+        self.queue = ByteQueue(maxbytes)
+        self.fetchstats = StageCounter('fetch')
+        self.writestats = StageCounter('write')
+        self.threads = []
+        for i in range(max(writers, 1)):
+            thread = ExitNotifyThread(target = self._write,
+                                      name = "Write messages from %s" % \
+                                      src.getvisiblename())
+            thread.setDaemon(1)
+            thread.start()
+            self.threads.append(thread)
+
+    def fetch(self, uidlist):
+        """Downloads the messages in uidlist, as getcopybatches() groups
+        them, and queues them up for the writers.  May be called from
+        several threads at once.
+
+        Only failures to download are warned about and passed over, as
+        copymessagesto() does; anything else is a bug, and raised."""
+        messages = self.src.getmessages(uidlist)
+        while 1:
+            start = time.time()
+            try:
+                uid, message, flags, rtime = messages.next()
+            except StopIteration:
+                break
+            except (KeyboardInterrupt):
+                raise
+            except:
+                self.ui.warn("ERROR attempting to copy messages " + \
+                             imaputil.listjoin(uidlist) + " for account " + \
+                             self.src.getaccountname() + ":" + \
+                             str(sys.exc_info()[1]))
+                break
+            busy = time.time() - start
+            try:
+                size = getsize(message)
+            except:
+                message.close()
+                raise
+            stalled = self.queue.put((uid, message, flags, rtime), size)
+            self.fetchstats.add(1, size, busy, stalled)
+
+    def _write(self):
+        self.ui.registerthread(self.src.getaccountname())
+        while 1:
+            start = time.time()
+            entry = self.queue.get()
+            if entry == None:
+                return
+            stalled = time.time() - start
+            (uid, message, flags, rtime), size = entry
+            start = time.time()
+            try:
+                try:
+                    self.ui.copyingmessage(uid, self.src, self.applyto)
+                    self.src.savemessageto(uid, message, flags, rtime,
+                                           self.applyto)
+                except (KeyboardInterrupt):
+                    raise
+                except:
+                    self.ui.warn("ERROR attempting to copy message " + \
+                                 str(uid) + " for account " + \
+                                 self.src.getaccountname() + ":" + \
+                                 str(sys.exc_info()[1]))
+            finally:
+                message.close()
+                self.queue.release(size)
+            self.writestats.add(1, size, time.time() - start, stalled)
+
+    def finish(self):
+        """Waits for the writers to save everything fetched so far, and
+        tells the UI how both stages did.  fetch() may not be called
+        anymore afterwards."""
+        self.queue.close()
+        for thread in self.threads:
+            thread.join()
+        self.ui.copythroughput(self.src, self.applyto, self.fetchstats,
+                               self.writestats)
@@ -17,11 +17,15 @@
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
 from threading import *
-from offlineimap import threadutil
+from offlineimap import threadutil, imaputil
 from offlineimap.ui import getglobalui
+from offlineimap.messagetable import diffmessagelists
+from offlineimap.syncplan import SyncPlan
+from offlineimap.copypipeline import CopyPipeline
 import os.path
 import re
 import sys
+from StringIO import StringIO
 
 class BaseFolder:
     def __init__(self):
@@ -37,14 +41,9 @@ class BaseFolder:
         false otherwise.  Probably only IMAP will return true."""
         return 0
 
-    def waitforthread(self):
-        """For threading folders, waits until there is a resource available
-        before firing off a thread.  For all others, returns immediately."""
-        pass
-
-    def getcopyinstancelimit(self):
-        """For threading folders, returns the instancelimitname for
-        InstanceLimitedThreads."""
+    def getcopypoolname(self):
+        """For threading folders, returns the name of the
+        threadutil.WorkerPool that copies are submitted to."""
         raise NotImplementedException
 
     def storesmessages(self):
@@ -120,6 +119,13 @@ class BaseFolder:
     def getuidvalidity(self):
         raise NotImplementedException
 
+    def savequickstatus(self):
+        """Called after this folder has been synced successfully.
+        Folders may save whatever lets quickchanged() tell cheaply
+        whether there is anything new next time.  The default
+        implementation will do nothing."""
+        pass
+
     def cachemessagelist(self):
         """Reads the message list from disk or network and stores it in
         memory for later use.  This list will not be re-read from disk or
@@ -135,6 +141,44 @@ class BaseFolder:
         """Returns the content of the specified message."""
         raise NotImplementedException
 
+    def getmessagefile(self, uid):
+        """Returns the content of the specified message as a file-like
+        object supporting read(), readline(), seek(0) and close().
+        Backends override this so that large messages need not be held
+        in memory as a whole; the default wraps getmessage()."""
+        return StringIO(self.getmessage(uid))
+
+    def getmessages(self, uidlist):
+        """Returns an iterator over (uid, file, flags, rtime) tuples
+        for the messages in uidlist, where file is as returned by
+        getmessagefile().  Messages that disappeared in the meantime may
+        be left out.  Backends that can fetch many messages at once
+        override this; the default calls getmessagefile() for each."""
+        for uid in uidlist:
+            yield (uid, self.getmessagefile(uid), self.getmessageflags(uid),
+                   self.getmessagetime(uid))
+
+    def getmessagesizes(self, uidlist):
+        """Returns a hash from the uids in uidlist to the sizes of their
+        messages, for those whose size is known cheaply.  The default
+        knows none."""
+        return {}
+
+    def estimateroundtrips(self, fetches = 0, uploads = 0, deletes = 0,
+                           flagchanges = 0):
+        """Estimates how many round trips to a server it takes to fetch
+        fetches batches of messages as getcopybatches() makes them,
+        to save uploads messages, to delete deletes messages and to
+        make flagchanges bulk flag changes.  The default, for folders
+        without a server, is none."""
+        return 0
+
+    def getcopybatches(self, uidlist):
+        """Splits uidlist into the batches of messages which
+        syncmessagesto_copy() hands to getmessages() in one go.  The
+        default copies one message at a time."""
+        return [[uid] for uid in uidlist]
+
     def savemessage(self, uid, content, flags, rtime):
         """Writes a new message, with the specified uid.
         If the uid is < 0, the backend should assign a new uid and return it.
@@ -154,6 +198,61 @@ class BaseFolder:
         """
         raise NotImplementedException
 
+    def savemessagefile(self, uid, file, flags, rtime):
+        """Same as savemessage(), but reads the content from file, a
+        file-like object as returned by getmessagefile().  The default
+        reads it into memory and calls savemessage()."""
+        content = ''
+        if self.storesmessages():
+            content = file.read()
+        return self.savemessage(uid, content, flags, rtime)
+
+    def getsavebatchsize(self):
+        """How many messages savemessagesfile() should preferably be
+        handed at once.  The default saves one at a time."""
+        return 1
+
+    def savemessagesfile(self, messages):
+        """Saves several messages, a list of (uid, file, flags, rtime)
+        tuples as savemessagefile() takes them.  Returns the list of
+        what savemessagefile() would have returned for each of them.
+        Backends that can store many messages at once override this;
+        the default calls savemessagefile() for each."""
+        retval = []
+        for uid, file, flags, rtime in messages:
+            file.seek(0)
+            retval.append(self.savemessagefile(uid, file, flags, rtime))
+        return retval
+
+    def getmessagekeys(self, uidlist):
+        """Returns a hash from the uids in uidlist to their
+        imaputil.messagekey(), for messages which have one.  The default
+        reads the headers of each message."""
+        retval = {}
+        for uid in uidlist:
+            message = self.getmessagefile(uid)
+            try:
+                key = imaputil.messagekey(imaputil.readheaders(message))
+            finally:
+                message.close()
+            if key != None:
+                retval[uid] = key
+        return retval
+
+    def movemessagesto(self, uidlist, dest):
+        """Moves the messages of uidlist to the folder dest of the same
+        repository, without transferring them.  Returns a hash from
+        their old to their new uids, with 0 for those whose new uid is
+        not known.  Backends which cannot do that return None, which is
+        what the default does."""
+        return None
+
+    def setfsyncgroup(self, fsyncgroup):
+        """Have the folder hand what it would fsync() to fsyncgroup, a
+        groupcommit.GroupCommit, rather than fsync() it right away.
+        The default implementation does nothing."""
+        pass
+
     def getmessagetime(self, uid):
         """Return the received time for the specified message."""
         raise NotImplementedException
@@ -201,34 +300,64 @@ class BaseFolder:
         for uid in uidlist:
             self.deletemessage(uid)
 
-    def syncmessagesto_neguid_msg(self, uid, dest, applyto, register = 1):
+    def changemessageuid(self, uid, newuid):
+        """Renumbers message uid to newuid, as when the server assigned
+        a UID to a message we found without one.  The default saves the
+        message anew under newuid and deletes the old one; backends that
+        can rename a message in place override this."""
+        message = self.getmessagefile(uid)
+        try:
+            self.savemessagefile(newuid, message, self.getmessageflags(uid),
+                                 self.getmessagetime(uid))
+        finally:
+            message.close()
+        self.deletemessage(uid)
+
+    def syncmessagesto_neguid_msg(self, uidlist, dest, applyto, register = 1):
+        """Uploads the messages of uidlist, a batch of at most
+        getsavebatchsize() of the first folder in applyto, with a single
+        savemessagesfile() call."""
         if register:
             self.ui.registerthread(self.getaccountname())
-        self.ui.copyingmessage(uid, self, applyto)
-        successobject = None
-        successuid = None
-        message = self.getmessage(uid)
-        flags = self.getmessageflags(uid)
-        rtime = self.getmessagetime(uid)
-        for tryappend in applyto:
-            successuid = tryappend.savemessage(uid, message, flags, rtime)
-            if successuid >= 0:
-                successobject = tryappend
-                break
-        # Did we succeed?
-        if successobject != None:
-            if successuid:       # Only if IMAP actually assigned a UID
-                # Copy the message to the other remote servers.
-                for appendserver in \
-                        [x for x in applyto if x != successobject]:
-                    appendserver.savemessage(successuid, message, flags, rtime)
-                    # Copy to its new name on the local server and delete
-                    # the one without a UID.
-                    self.savemessage(successuid, message, flags, rtime)
-            self.deletemessage(uid) # It'll be re-downloaded.
-        else:
-            # Did not find any server to take this message.  Ignore.
-            pass
+        messages = []
+        try:
+            for uid in uidlist:
+                self.ui.copyingmessage(uid, self, applyto)
+                messages.append((uid, self.getmessagefile(uid),
+                                 self.getmessageflags(uid),
+                                 self.getmessagetime(uid)))
+            # Each message goes to the first folder taking it.
+            pending = messages
+            successes = []
+            for tryappend in applyto:
+                if not pending:
+                    break
+                successuids = tryappend.savemessagesfile(pending)
+                left = []
+                for message, successuid in zip(pending, successuids):
+                    if successuid >= 0:
+                        successes.append((message, tryappend, successuid))
+                    else:
+                        left.append(message)
+                pending = left
+            # Messages no server would take are ignored.
+            for (uid, message, flags, rtime), successobject, successuid \
+                    in successes:
+                if successuid:       # Only if IMAP actually assigned a UID
+                    # Copy the message to the other remote servers.
+                    for appendserver in \
+                            [x for x in applyto if x != successobject]:
+                        message.seek(0)
+                        appendserver.savemessagefile(successuid, message,
+                                                     flags, rtime)
+                    # Our copy is the same message; just give it the UID.
+                    message.close()
+                    self.changemessageuid(uid, successuid)
+                else:
+                    self.deletemessage(uid) # It'll be re-downloaded.
+        finally:
+            for uid, message, flags, rtime in messages:
+                message.close()
         
 
     def syncmessagesto_neguid(self, dest, applyto):
@@ -240,27 +369,27 @@ class BaseFolder:
         add it to local for real, and delete the fake one."""
 
         uidlist = [uid for uid in self.getmessagelist().keys() if uid < 0]
-        threads = []
+        tasks = []
 
-        usethread = None
+        pool = None
+        batchsize = 1
         if applyto != None:
-            usethread = applyto[0]
+            if applyto[0].suggeststhreads():
+                pool = threadutil.getWorkerPool(applyto[0].getcopypoolname())
+            batchsize = applyto[0].getsavebatchsize()
         
-        for uid in uidlist:
-            if usethread and usethread.suggeststhreads():
-                usethread.waitforthread()
-                thread = threadutil.InstanceLimitedThread(\
-                    usethread.getcopyinstancelimit(),
-                    target = self.syncmessagesto_neguid_msg,
+        for i in range(0, len(uidlist), batchsize):
+            batch = uidlist[i:i + batchsize]
+            if pool:
+                tasks.append(pool.submit(self.syncmessagesto_neguid_msg,
+                    (batch, dest, applyto), {'register': 0},
                     name = "New msg sync from %s" % self.getvisiblename(),
-                    args = (uid, dest, applyto))
-                thread.setDaemon(1)
-                thread.start()
-                threads.append(thread)
+                    accountname = self.getaccountname()))
             else:
-                self.syncmessagesto_neguid_msg(uid, dest, applyto, register = 0)
-        for thread in threads:
-            thread.join()
+                self.syncmessagesto_neguid_msg(batch, dest, applyto,
+                                               register = 0)
+        for task in tasks:
+            task.wait()
 
     def copymessageto(self, uid, applyto, register = 1):
         # Sometimes, it could be the case that if a sync takes awhile,
@@ -272,76 +401,139 @@ class BaseFolder:
             if register:
                 self.ui.registerthread(self.getaccountname())
             self.ui.copyingmessage(uid, self, applyto)
-            message = ''
+            message = None
             # If any of the destinations actually stores the message body,
             # load it up.
             
             for object in applyto:
                 if object.storesmessages():
-                    message = self.getmessage(uid)
+                    message = self.getmessagefile(uid)
                     break
-            flags = self.getmessageflags(uid)
-            rtime = self.getmessagetime(uid)
-            for object in applyto:
-                newuid = object.savemessage(uid, message, flags, rtime)
-                if newuid > 0 and newuid != uid:
-                    # Change the local uid.
-                    self.savemessage(newuid, message, flags, rtime)
-                    self.deletemessage(uid)
-                    uid = newuid
+            if message == None:
+                message = StringIO('')
+            try:
+                flags = self.getmessageflags(uid)
+                rtime = self.getmessagetime(uid)
+                self.savemessageto(uid, message, flags, rtime, applyto)
+            finally:
+                message.close()
         except (KeyboardInterrupt):
             raise
         except:
             self.ui.warn("ERROR attempting to copy message " + str(uid) \
                  + " for account " + self.getaccountname() + ":" + str(sys.exc_info()[1]))
-        
 
-    def syncmessagesto_copy(self, dest, applyto):
+    def savemessageto(self, uid, message, flags, rtime, applyto):
+        """Saves a message of self, read from the file-like object
+        message, to each folder in applyto."""
+        for object in applyto:
+            message.seek(0)
+            newuid = object.savemessagefile(uid, message, flags, rtime)
+            if newuid > 0 and newuid != uid:
+                # Change the local uid.
+                message.seek(0)
+                self.savemessagefile(newuid, message, flags, rtime)
+                self.deletemessage(uid)
+                uid = newuid
+
+    def copymessagesto(self, uidlist, applyto, register = 1):
+        """Copies a batch of messages, as returned by getcopybatches(),
+        fetching all of them with a single getmessages() call."""
+        storesmessages = 0
+        for object in applyto:
+            if object.storesmessages():
+                storesmessages = 1
+                break
+        if len(uidlist) == 1 or not storesmessages:
+            # No point in fetching bodies in bulk.
+            for uid in uidlist:
+                self.copymessageto(uid, applyto, register)
+                register = 0
+            return
+        try:
+            if register:
+                self.ui.registerthread(self.getaccountname())
+            for uid, message, flags, rtime in self.getmessages(uidlist):
+                try:
+                    self.ui.copyingmessage(uid, self, applyto)
+                    self.savemessageto(uid, message, flags, rtime, applyto)
+                except (KeyboardInterrupt):
+                    raise
+                except:
+                    self.ui.warn("ERROR attempting to copy message " + \
+                                 str(uid) + " for account " + \
+                                 self.getaccountname() + ":" + \
+                                 str(sys.exc_info()[1]))
+                message.close()
+        except (KeyboardInterrupt):
+            raise
+        except:
+            self.ui.warn("ERROR attempting to copy messages " + \
+                         imaputil.listjoin(uidlist) + " for account " + \
+                         self.getaccountname() + ":" + str(sys.exc_info()[1]))
+
+    def getsyncdiff(self, dest):
+        """Returns what passes 2 to 4 of a sync to dest have to do, as
+        messagetable.diffmessagelists() does."""
+        return diffmessagelists(self.getmessagelist(), dest.getmessagelist())
+
+    def syncmessagesto_copy(self, dest, applyto, diff = None):
         """Pass 2 of folder synchronization.
 
         Look for messages present in self but not in dest.  If any, add
         them to dest."""
-        threads = []
+        tasks = []
         
-	dest_messagelist = dest.getmessagelist()
-        for uid in self.getmessagelist().keys():
-            if uid < 0:                 # Ignore messages that pass 1 missed.
-                continue
-            if not uid in dest_messagelist:
-                if self.suggeststhreads():
-                    self.waitforthread()
-                    thread = threadutil.InstanceLimitedThread(\
-                        self.getcopyinstancelimit(),
-                        target = self.copymessageto,
-                        name = "Copy message %d from %s" % (uid,
-                                                            self.getvisiblename()),
-                        args = (uid, applyto))
-                    thread.setDaemon(1)
-                    thread.start()
-                    threads.append(thread)
-                else:
-                    self.copymessageto(uid, applyto, register = 0)
-        for thread in threads:
-            thread.join()
+        if diff == None:
+            diff = self.getsyncdiff(dest)
+        copylist = diff[0]
+        if not len(copylist):
+            return
+        pool = None
+        if self.suggeststhreads():
+            pool = threadutil.getWorkerPool(self.getcopypoolname())
+        # Saving the bodies is left to the writer threads of a pipeline,
+        # while pool fetches the next ones.
+        pipeline = None
+        maxbytes = self.config.getinflightbytes()
+        if maxbytes > 0:
+            for object in applyto:
+                if object.storesmessages():
+                    pipeline = CopyPipeline(self, applyto, maxbytes,
+                                            self.config.getwritethreads())
+                    break
+        for uidlist in self.getcopybatches(copylist):
+            if pipeline:
+                target, args, kwargs = pipeline.fetch, (uidlist,), {}
+            else:
+                target, args, kwargs = self.copymessagesto, \
+                                       (uidlist, applyto), {'register': 0}
+            if pool:
+                tasks.append(pool.submit(target, args, kwargs,
+                    name = "Copy messages %s from %s" % \
+                    (imaputil.listjoin(uidlist), self.getvisiblename()),
+                    accountname = self.getaccountname()))
+            else:
+                apply(target, args, kwargs)
+        for task in tasks:
+            task.wait()
+        if pipeline:
+            pipeline.finish()
 
-    def syncmessagesto_delete(self, dest, applyto):
+    def syncmessagesto_delete(self, dest, applyto, diff = None):
         """Pass 3 of folder synchronization.
 
         Look for message present in dest but not in self.
         If any, delete them."""
-        deletelist = []
-	self_messagelist = self.getmessagelist()
-        for uid in dest.getmessagelist().keys():
-            if uid < 0:
-                continue
-            if not uid in self_messagelist:
-                deletelist.append(uid)
+        if diff == None:
+            diff = self.getsyncdiff(dest)
+        deletelist = diff[1]
         if len(deletelist):
             self.ui.deletingmessages(deletelist, applyto)
             for object in applyto:
                 object.deletemessages(deletelist)
 
-    def syncmessagesto_flags(self, dest, applyto):
+    def syncmessagesto_flags(self, dest, applyto, diff = None):
         """Pass 4 of folder synchronization.
 
         Look for any flag matching issues -- set dest message to have the
@@ -354,27 +546,9 @@ class BaseFolder:
         # call per message as before.  This should result in some significant
         # performance improvements.
 
-        addflaglist = {}
-        delflaglist = {}
-        
-        for uid in self.getmessagelist().keys():
-            if uid < 0:                 # Ignore messages missed by pass 1
-                continue
-            selfflags = self.getmessageflags(uid)
-            destflags = dest.getmessageflags(uid)
-
-            addflags = [x for x in selfflags if x not in destflags]
-
-            for flag in addflags:
-                if not flag in addflaglist:
-                    addflaglist[flag] = []
-                addflaglist[flag].append(uid)
-
-            delflags = [x for x in destflags if x not in selfflags]
-            for flag in delflags:
-                if not flag in delflaglist:
-                    delflaglist[flag] = []
-                delflaglist[flag].append(uid)
+        if diff == None:
+            diff = self.getsyncdiff(dest)
+        addflaglist, delflaglist = diff[2:]
 
         for object in applyto:
             for flag in addflaglist.keys():
@@ -390,39 +564,9 @@ class BaseFolder:
         to include dest!) to which all write actions should be applied.
         It defaults to [dest] if not specified.  It is important that
         the UID generator be listed first in applyto; that is, the other
-        applyto ones should be the ones that "copy" the main action."""
-        if applyto == None:
-            applyto = [dest]
+        applyto ones should be the ones that "copy" the main action.
 
-        try:
-            self.syncmessagesto_neguid(dest, applyto)
-        except (KeyboardInterrupt):
-            raise
-        except:
-            self.ui.warn("ERROR attempting to handle negative uids " \
-                + "for account " + self.getaccountname() + ":" + str(sys.exc_info()[1]))
-
-        #all threads launched here are in try / except clauses when they copy anyway...
-        self.syncmessagesto_copy(dest, applyto)
-
-        try:
-            self.syncmessagesto_delete(dest, applyto)
-        except (KeyboardInterrupt):
-            raise
-        except:
-            self.ui.warn("ERROR attempting to delete messages " \
-                + "for account " + self.getaccountname() + ":" + str(sys.exc_info()[1]))
-
-        # Now, the message lists should be identical wrt the uids present.
-        # (except for potential negative uids that couldn't be placed
-        # anywhere)
-
-        try:
-            self.syncmessagesto_flags(dest, applyto)
-        except (KeyboardInterrupt):
-            raise
-        except:
-            self.ui.warn("ERROR attempting to sync flags " \
-                + "for account " + self.getaccountname() + ":" + str(sys.exc_info()[1]))
-        
+        The four passes are planned up front, as a SyncPlan; the deletes
+        and flag changes are then carried out before the copies."""
+        SyncPlan(self, dest, applyto).execute()
             
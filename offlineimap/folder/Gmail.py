@@ -23,7 +23,6 @@ from IMAP import IMAPFolder
 import imaplib
 from offlineimap import imaputil, imaplibutil
 from offlineimap.ui import UIBase
-from copy import copy
 
 
 class GmailFolder(IMAPFolder):
@@ -53,7 +52,7 @@ class GmailFolder(IMAPFolder):
             # IMAP expunge is just "remove label" in this folder,
             # so map the request into a "move into Trash"
 
-            imapobj = self.imapserver.acquireconnection()
+            imapobj = self.imapserver.acquireconnection(self.getfullname())
             try:
                 imapobj.select(self.getfullname())
                 result = imapobj.uid('copy',
@@ -63,8 +62,7 @@ class GmailFolder(IMAPFolder):
                        "Bad IMAPlib result: %s" % result[0]
             finally:
                 self.imapserver.releaseconnection(imapobj)
-            for uid in uidlist:
-                del self.messagelist[uid]
+            self.messagelist.deletekeys(uidlist)
         else:
             IMAPFolder.deletemessages_noconvert(self, uidlist)
             
@@ -82,7 +80,7 @@ class GmailFolder(IMAPFolder):
             self.processmessagesflags(operation, uidlist[100:], flags)
             return
         
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
         try:
             imapobj.select(self.getfullname())
             r = imapobj.uid('store',
@@ -93,31 +91,4 @@ class GmailFolder(IMAPFolder):
             r = r[1]
         finally:
             self.imapserver.releaseconnection(imapobj)
-
-        needupdate = copy(uidlist)
-        for result in r:
-            if result == None:
-                # Compensate for servers that don't return anything from
-                # STORE.
-                continue
-            attributehash = imaputil.flags2hash(imaputil.imapsplit(result)[1])
-            if not ('UID' in attributehash and 'FLAGS' in attributehash):
-                # Compensate for servers that don't return a UID attribute.
-                continue
-            flags = attributehash['FLAGS']
-            uid = long(attributehash['UID'])
-            self.messagelist[uid]['flags'] = imaputil.flagsimap2maildir(flags)
-            try:
-                needupdate.remove(uid)
-            except ValueError:          # Let it slide if it's not in the list
-                pass
-        for uid in needupdate:
-            if operation == '+':
-                for flag in flags:
-                    if not flag in self.messagelist[uid]['flags']:
-                        self.messagelist[uid]['flags'].append(flag)
-                    self.messagelist[uid]['flags'].sort()
-            elif operation == '-':
-                for flag in flags:
-                    if flag in self.messagelist[uid]['flags']:
-                        self.messagelist[uid]['flags'].remove(flag)
+        self.processmessagesflags_update(operation, uidlist, flags, r)
@@ -18,15 +18,18 @@
 
 import imaplib
 import rfc822
-import string
 import random
 import binascii
 import re
 import time
+import os
 from StringIO import StringIO
 from copy import copy
 from Base import BaseFolder
 from offlineimap import imaputil, imaplibutil, __version__
+from offlineimap.messagetable import MessageTable
+
+modseqmagicline = "OFFLINEIMAP ModSeq CACHE DATA - DO NOT MODIFY - FORMAT 1"
 
 class IMAPFolder(BaseFolder):
     def __init__(self, imapserver, name, visiblename, accountname, repository):
@@ -41,6 +44,8 @@ class IMAPFolder(BaseFolder):
         self.accountname = accountname
         self.repository = repository
         self.randomgenerator = random.Random()
+        # The caches of what the server holds are left alone too.
+        self.dryrun = self.config.getdefaultboolean('general', 'dryrun', 0)
         BaseFolder.__init__(self)
         #self.ui is set in BaseFolder
 
@@ -60,29 +65,55 @@ class IMAPFolder(BaseFolder):
     def suggeststhreads(self):
         return 1
 
-    def waitforthread(self):
-        self.imapserver.connectionwait()
-
-    def getcopyinstancelimit(self):
+    def getcopypoolname(self):
         return 'MSGCOPY_' + self.repository.getname()
 
     def getvisiblename(self):
         return self.visiblename
 
     def getuidvalidity(self):
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
         try:
             # Primes untagged_responses
             self.selectro(imapobj)
-            return long(imapobj.untagged_responses['UIDVALIDITY'][0])
+            return self.getuidvalidity_selected(imapobj)
         finally:
             self.imapserver.releaseconnection(imapobj)
+
+    def getuidvalidity_selected(self, imapobj):
+        """Returns the UIDVALIDITY reported when imapobj selected
+        this folder."""
+        return long(imapobj.untagged_responses['UIDVALIDITY'][0])
     
     def quickchanged(self, statusfolder):
+        status = self.repository.getfolderstatus(self.getfullname())
+        saved = self._loadquickstatus()
+        if status != None and saved != None:
+            # Compare with what the folder looked like when we last
+            # synced it.
+            for name in ('MESSAGES', 'UIDNEXT', 'UIDVALIDITY'):
+                if status.get(name) == None or \
+                       status.get(name) != saved.get(name):
+                    return True
+            if status.has_key('HIGHESTMODSEQ') and \
+                   saved.has_key('HIGHESTMODSEQ'):
+                # Flag changes are visible, too.
+                return status['HIGHESTMODSEQ'] != saved['HIGHESTMODSEQ']
+            return False
+
+        changed = self._quickchanged_select(statusfolder)
+        if not changed and status != None:
+            # Nothing saved yet, but the folder is known to be in sync
+            # now; have the next run rely on the status.
+            self.quickstatus = status
+            self.savequickstatus()
+        return changed
+
+    def _quickchanged_select(self, statusfolder):
         # An IMAP folder has definitely changed if the number of
         # messages or the UID of the last message have changed.  Otherwise
         # only flag changes could have occurred.
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
         try:
             # Primes untagged_responses
             imapobj.select(self.getfullname(), readonly = 1, force = 1)
@@ -110,12 +141,9 @@ class IMAPFolder(BaseFolder):
         finally:
             self.imapserver.releaseconnection(imapobj)
 
-        # Discard the message number.
-        messagestr = string.split(response[0], maxsplit = 1)[1]
-        options = imaputil.flags2hash(messagestr)
-        if not options.has_key('UID'):
+        uid = imaputil.parsefetch(response)[0][0]
+        if uid == None:
             return True
-        uid = long(options['UID'])
         saveduids = statusfolder.getmessagelist().keys()
         saveduids.sort()
         if uid != saveduids[-1]:
@@ -123,18 +151,196 @@ class IMAPFolder(BaseFolder):
 
         return False
 
+    def _getquickstatusfilename(self):
+        return os.path.join(self.repository.getquickstatusdir(),
+                            self.getfolderbasename())
+
+    def _loadquickstatus(self):
+        """Returns the status saved by savequickstatus(), or None."""
+        filename = self._getquickstatusfilename()
+        if not os.path.exists(filename):
+            return None
+        file = open(filename, "rt")
+        try:
+            line = file.readline().strip()
+        finally:
+            file.close()
+        status = {}
+        for name, value in imaputil.flags2hash('(%s)' % line).items():
+            status[name] = long(value)
+        return status
+
+    def savequickstatus(self):
+        """Saves the status of the folder as of the start of the last
+        sync, in STATUS format."""
+        status = getattr(self, 'quickstatus', None)
+        if not status or self.dryrun:
+            return
+        filename = self._getquickstatusfilename()
+        file = open(filename + ".tmp", "wt")
+        file.write(' '.join(['%s %d' % item \
+                             for item in sorted(status.items())]))
+        file.write("\n")
+        file.close()
+        os.rename(filename + ".tmp", filename)
+
+    def _getselectstatus(self, imapobj):
+        """Returns the STATUS items of the folder just selected by
+        imapobj."""
+        untagged = imapobj.untagged_responses
+        status = {'MESSAGES': self._getmaxmsgid(imapobj),
+                  'UIDVALIDITY': self.getuidvalidity_selected(imapobj)}
+        if untagged.has_key('UIDNEXT'):
+            status['UIDNEXT'] = long(untagged['UIDNEXT'][-1])
+        highestmodseq = self._gethighestmodseq(imapobj)
+        if highestmodseq != None:
+            status['HIGHESTMODSEQ'] = highestmodseq
+        return status
+
+    def _getmodseqfilename(self):
+        return os.path.join(self.repository.getmodseqdir(),
+                            self.getfolderbasename())
+
+    def _loadmodseqcache(self):
+        """Returns (uidvalidity, highestmodseq, messagelist) as saved by
+        a previous cachemessagelist(), or None if nothing was saved."""
+        filename = self._getmodseqfilename()
+        if not os.path.exists(filename):
+            return None
+        file = open(filename, "rt")
+        try:
+            if file.readline().strip() != modseqmagicline:
+                return None
+            uidvalidity, highestmodseq = \
+                         [long(x) for x in file.readline().split()]
+            messagelist = MessageTable()
+            for line in file.xreadlines():
+                uid, flags = line.strip().split(':')
+                uid = long(uid)
+                messagelist[uid] = {'uid': uid, 'flags': [x for x in flags],
+                                    'time': None}
+            return (uidvalidity, highestmodseq, messagelist)
+        finally:
+            file.close()
+
+    def _savemodseqcache(self, uidvalidity, highestmodseq):
+        """Saves the current message list along with the mailbox
+        HIGHESTMODSEQ it corresponds to."""
+        if self.dryrun:
+            return
+        filename = self._getmodseqfilename()
+        file = open(filename + ".tmp", "wt")
+        file.write(modseqmagicline + "\n")
+        file.write("%d %d\n" % (uidvalidity, highestmodseq))
+        for msg in self.messagelist.values():
+            file.write("%d:%s\n" % (msg['uid'], ''.join(msg['flags'])))
+        file.close()
+        os.rename(filename + ".tmp", filename)
+
+    def _gethighestmodseq(self, imapobj):
+        """Returns the HIGHESTMODSEQ of the selected folder, or None if
+        the folder does not support mod-sequences."""
+        if not imapobj.untagged_responses.has_key('HIGHESTMODSEQ'):
+            return None
+        return long(imapobj.untagged_responses['HIGHESTMODSEQ'][-1])
+
+    def _getmaxmsgid(self, imapobj):
+        # 1. Some mail servers do not return an EXISTS response
+        # if the folder is empty.  2. ZIMBRA servers can return
+        # multiple EXISTS replies in the form 500, 1000, 1500,
+        # 1623 so check for potentially multiple replies.
+        maxmsgid = 0
+        for msgid in imapobj.untagged_responses.get('EXISTS', []):
+            maxmsgid = max(long(msgid), maxmsgid)
+        return maxmsgid
+
+    def _parsemessagelist(self, responses):
+        """Parses FETCH responses such as '1 (FLAGS (\\Seen) UID 3)'
+        into message list entries."""
+        retval = []
+        for uid, flags, internaldate, size in imaputil.parsefetch(responses):
+            if uid == None:
+                self.ui.warn('No UID in message with flags %s' % \
+                             str(flags), minor = 1)
+                continue
+            if flags == None:
+                flags = []
+            rtime = None
+            if internaldate != None:
+                rtime = imaplibutil.Internaldate2epoch('INTERNALDATE "%s"' % \
+                                                       internaldate)
+            retval.append({'uid': uid, 'flags': flags, 'time': rtime})
+        return retval
+
+    def cachemessagelist_qresync(self, imapobj):
+        """Updates the message list saved by the previous run with the
+        changes the server reports since then (RFC 5162 QRESYNC).  Only
+        the changed messages cross the wire, rather than the flags of
+        the whole folder.
+
+        Returns True on success.  Returns False if there is no usable
+        saved state, in which case the caller must fetch the full list."""
+        if not getattr(imapobj, 'qresync', False):
+            return False
+        saved = self._loadmodseqcache()
+        if saved == None:
+            return False
+        uidvalidity, highestmodseq, messagelist = saved
+
+        imapobj.select(self.getfullname(), readonly = 1, force = 1,
+                       qresync = (uidvalidity, highestmodseq))
+        untagged = imapobj.untagged_responses
+        # Don't leave these around for the next FETCH on this connection.
+        vanishedlist = untagged.pop('VANISHED', [])
+        fetchlist = untagged.pop('FETCH', [])
+        if untagged.has_key('NOMODSEQ') or \
+               long(untagged.get('UIDVALIDITY', [-1])[0]) != uidvalidity:
+            return False
+        self.quickstatus = self._getselectstatus(imapobj)
+
+        for vanished in vanishedlist:
+            # Either "(EARLIER) 41,43:116" or just "41,43:116"
+            for uid in imaputil.listsplit(vanished.split()[-1]):
+                if messagelist.has_key(uid):
+                    del messagelist[uid]
+        for msg in self._parsemessagelist(fetchlist):
+            messagelist[msg['uid']] = msg
+
+        if len(messagelist) != self._getmaxmsgid(imapobj):
+            # Something got out of sync; better check everything.
+            self.ui.debug('imap', 'cachemessagelist_qresync: message count '
+                          'mismatch in %s, doing a full fetch' % \
+                          self.getfullname())
+            return False
+
+        self.messagelist = messagelist
+        newmodseq = self._gethighestmodseq(imapobj)
+        if newmodseq != None and newmodseq != highestmodseq:
+            self._savemodseqcache(uidvalidity, newmodseq)
+        return True
+
     # TODO: Make this so that it can define a date that would be the oldest messages etc.
     def cachemessagelist(self):
-        imapobj = self.imapserver.acquireconnection()
-        self.messagelist = {}
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
+        self.messagelist = MessageTable()
 
         try:
-            # Primes untagged_responses
-            imapobj.select(self.getfullname(), readonly = 1, force = 1)
-
             maxage = self.config.getdefaultint("Account " + self.accountname, "maxage", -1)
             maxsize = self.config.getdefaultint("Account " + self.accountname, "maxsize", -1)
 
+            # A partial message list is no base for incremental updates.
+            usemodseq = (maxage == -1) and (maxsize == -1) and \
+                        getattr(imapobj, 'qresync', False)
+            if usemodseq and self.cachemessagelist_qresync(imapobj):
+                return
+
+            # Primes untagged_responses
+            imapobj.select(self.getfullname(), readonly = 1, force = 1)
+            self.quickstatus = self._getselectstatus(imapobj)
+            highestmodseq = None
+            if usemodseq:
+                highestmodseq = self._gethighestmodseq(imapobj)
+
             if (maxage != -1) | (maxsize != -1):
                 try:
                     search_condition = "(";
@@ -172,45 +378,30 @@ class IMAPFolder(BaseFolder):
                     # No messages; return
                     return
             else:
-                try:
-                    # 1. Some mail servers do not return an EXISTS response
-                    # if the folder is empty.  2. ZIMBRA servers can return
-                    # multiple EXISTS replies in the form 500, 1000, 1500,
-                    # 1623 so check for potentially multiple replies.
-                    maxmsgid = 0
-                    for msgid in imapobj.untagged_responses['EXISTS']:
-                        maxmsgid = max(long(msgid), maxmsgid)
-                    messagesToFetch = '1:%d' % maxmsgid;
-                except KeyError:
-                    return
+                maxmsgid = self._getmaxmsgid(imapobj)
                 if maxmsgid < 1:
                     #no messages; return
                     return
+                messagesToFetch = '1:%d' % maxmsgid;
+            if highestmodseq != None:
+                uidvalidity = self.getuidvalidity_selected(imapobj)
             # Now, get the flags and UIDs for these.
             # We could conceivably get rid of maxmsgid and just say
             # '1:*' here.
             response = imapobj.fetch(messagesToFetch, '(FLAGS UID)')[1]
         finally:
             self.imapserver.releaseconnection(imapobj)
-        for messagestr in response:
-            # Discard the message number.
-            messagestr = string.split(messagestr, maxsplit = 1)[1]
-            options = imaputil.flags2hash(messagestr)
-            if not options.has_key('UID'):
-                self.ui.warn('No UID in message with options %s' %\
-                                          str(options),
-                                          minor = 1)
-            else:
-                uid = long(options['UID'])
-                flags = imaputil.flagsimap2maildir(options['FLAGS'])
-                rtime = imaplibutil.Internaldate2epoch(messagestr)
-                self.messagelist[uid] = {'uid': uid, 'flags': flags, 'time': rtime}
+        for msg in self._parsemessagelist(response):
+            self.messagelist[msg['uid']] = msg
+        if highestmodseq != None:
+            # Lets the next run only ask for what changed since now.
+            self._savemodseqcache(uidvalidity, highestmodseq)
 
     def getmessagelist(self):
         return self.messagelist
 
     def getmessage(self, uid):
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
         try:
             imapobj.select(self.getfullname(), readonly = 1)
             initialresult = imapobj.uid('fetch', '%d' % uid, '(BODY.PEEK[])')
@@ -221,15 +412,211 @@ class IMAPFolder(BaseFolder):
         finally:
             self.imapserver.releaseconnection(imapobj)
 
+    def getmessagefile(self, uid):
+        message = None
+        for fetcheduid, file, flags, rtime in self.getmessages([uid]):
+            message = file
+        if message == None:
+            raise ValueError, "Message %d not found in %s" % \
+                  (uid, self.getfullname())
+        return message
+
+    def getmessages(self, uidlist):
+        """Fetches all of uidlist with a single UID FETCH.  Each message
+        is handed on as soon as its body has arrived.  Large bodies are
+        spooled to a temporary file, so memory use stays bounded even
+        for huge attachments."""
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
+        try:
+            imapobj.select(self.getfullname(), readonly = 1)
+            for attributes, content in imapobj.fetchiter(
+                imaputil.listjoin(uidlist),
+                '(UID FLAGS INTERNALDATE BODY.PEEK[])', spool = 1):
+                if content == None:
+                    # Unsolicited FETCH, eg. a flag change.
+                    continue
+                uid, flags, internaldate, size = \
+                     imaputil.parsefetch([attributes])[0]
+                if uid == None or not self.messagelist.has_key(uid):
+                    continue
+                if flags != None:
+                    self.messagelist[uid]['flags'] = flags
+                rtime = None
+                if internaldate != None:
+                    rtime = imaplibutil.Internaldate2epoch(
+                        'INTERNALDATE "%s"' % internaldate)
+                if type(content) == type(''):
+                    content = StringIO(content)
+                yield (uid, imaputil.LineEndingFile(content, "\n"),
+                       self.messagelist[uid]['flags'], rtime)
+        finally:
+            self.imapserver.releaseconnection(imapobj)
+
+    def getmessagesizes(self, uidlist):
+        """Returns a hash of the RFC822.SIZE of the messages in uidlist."""
+        sizes = {}
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
+        try:
+            imapobj.select(self.getfullname(), readonly = 1)
+            # Keep the command line reasonably short.
+            for i in range(0, len(uidlist), 1000):
+                response = imapobj.uid('fetch',
+                                       imaputil.listjoin(uidlist[i:i + 1000]),
+                                       '(RFC822.SIZE)')[1]
+                for uid, flags, internaldate, size in \
+                        imaputil.parsefetch(response):
+                    if uid != None and size != None:
+                        sizes[uid] = size
+        finally:
+            self.imapserver.releaseconnection(imapobj)
+        return sizes
+
+    def estimateroundtrips(self, fetches = 0, uploads = 0, deletes = 0,
+                           flagchanges = 0):
+        """One UID FETCH per batch, one APPEND per batch of uploads plus
+        a CHECK and a search for their UIDs, a STORE and an EXPUNGE for
+        deletes, and one pipelined STORE per flag change.  SELECTs are
+        not counted."""
+        trips = fetches + flagchanges
+        if uploads:
+            batchsize = self.getsavebatchsize()
+            trips += (uploads + batchsize - 1) / batchsize + 2
+        if deletes:
+            trips += 2
+        return trips
+
+    def getmessagekeys(self, uidlist):
+        """Fetches the headers that make up the key of each message, for
+        1000 messages per UID FETCH."""
+        retval = {}
+        items = '(UID BODY.PEEK[HEADER.FIELDS (%s)])' % \
+                ' '.join(imaputil.keyheaders).upper()
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
+        try:
+            imapobj.select(self.getfullname(), readonly = 1)
+            for i in range(0, len(uidlist), 1000):
+                response = imapobj.uid('fetch',
+                                       imaputil.listjoin(uidlist[i:i + 1000]),
+                                       items)[1]
+                for j in range(len(response)):
+                    if type(response[j]) != type(()):
+                        continue
+                    # The UID may come before or after the literal.
+                    attributes = response[j][0]
+                    if j + 1 < len(response) and \
+                           type(response[j + 1]) == type(''):
+                        attributes += response[j + 1]
+                    uidmatch = re.search('UID (\d+)', attributes)
+                    if not uidmatch:
+                        continue
+                    key = imaputil.messagekey(response[j][1])
+                    if key != None:
+                        retval[long(uidmatch.group(1))] = key
+        finally:
+            self.imapserver.releaseconnection(imapobj)
+        return retval
+
+    def movemessagesto(self, uidlist, dest):
+        """Moves the messages with UID MOVE (RFC 6851) or, if the server
+        lacks it, with UID COPY followed by flagging them \\Deleted and
+        expunging.  The new UIDs come from COPYUID (RFC 4315).  Without
+        UIDPLUS, they are the UIDs dest handed out from its UIDNEXT on,
+        if there are as many of them as messages moved."""
+        uidlist = uidlist[:]
+        uidlist.sort()
+        uidset = imaputil.listjoin(uidlist)
+        retval = dict([(uid, 0) for uid in uidlist])
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
+        try:
+            uidnext = None
+            if not 'UIDPLUS' in imapobj.capabilities:
+                typ, dat = imapobj.status(dest.getfullname(), '(UIDNEXT)')
+                uidnextmatch = re.search('UIDNEXT (\d+)', str(dat[-1]))
+                if typ == 'OK' and uidnextmatch:
+                    uidnext = long(uidnextmatch.group(1))
+            imapobj.select(self.getfullname())
+            if imapobj.untagged_responses.has_key('COPYUID'):
+                del imapobj.untagged_responses['COPYUID']
+            if 'MOVE' in imapobj.capabilities:
+                assert(imapobj.uid('MOVE', uidset,
+                                   dest.getfullname())[0] == 'OK')
+            else:
+                # Only flag the originals once we know they were copied.
+                assert(imapobj.uid('COPY', uidset,
+                                   dest.getfullname())[0] == 'OK')
+                pipeline = imaplibutil.CommandPipeline(imapobj)
+                try:
+                    store = pipeline.uid('STORE', uidset, '+FLAGS.SILENT',
+                                         '(\\Deleted)')
+                    if 'UIDPLUS' in imapobj.capabilities:
+                        expunge = pipeline.uid('EXPUNGE', uidset)
+                    elif self.expunge:
+                        expunge = pipeline.command('EXPUNGE')
+                    else:
+                        expunge = None
+                    assert(store.result()[0] == 'OK')
+                    if expunge != None:
+                        assert(expunge.result()[0] == 'OK')
+                finally:
+                    pipeline.flush()
+            copyuid = imapobj.untagged_responses.pop('COPYUID', [None])[-1]
+            if copyuid:
+                # uidvalidity source-uids dest-uids
+                copyuid = copyuid.split(' ')
+                olduids = imaputil.listsplit(copyuid[1])
+                newuids = imaputil.listsplit(copyuid[2])
+                if len(olduids) == len(newuids):
+                    retval.update(dict(zip(olduids, newuids)))
+            elif uidnext != None:
+                imapobj.select(dest.getfullname(), readonly = 1)
+                typ, dat = imapobj.uid('SEARCH', 'UID', '%d:*' % uidnext)
+                newuids = [long(x) for x in (dat[-1] or '').split()]
+                # n:* always matches the last message, even below n.
+                newuids = [uid for uid in newuids if uid >= uidnext]
+                newuids.sort()
+                if typ == 'OK' and len(newuids) == len(uidlist):
+                    retval.update(dict(zip(uidlist, newuids)))
+        finally:
+            self.imapserver.releaseconnection(imapobj)
+        self.ui.debug('imap', 'movemessagesto: %s to %s: %s' % \
+                      (uidset, dest.getfullname(), repr(retval)))
+        return retval
+
+    def getcopybatches(self, uidlist):
+        """Groups uidlist into batches of up to fetchbatchsize bytes, so
+        that each batch can be downloaded with a single UID FETCH."""
+        maxbytes = self.repository.getfetchbatchsize()
+        if maxbytes <= 0 or len(uidlist) < 2:
+            return BaseFolder.getcopybatches(self, uidlist)
+        sizes = self.getmessagesizes(uidlist)
+        retval = []
+        batch = []
+        batchbytes = 0
+        for uid in uidlist:
+            size = sizes.get(uid, 0)
+            # Hack for those IMAP servers with a limited line length
+            if len(batch) and (batchbytes + size > maxbytes or \
+                               len(batch) >= 100):
+                retval.append(batch)
+                batch = []
+                batchbytes = 0
+            batch.append(uid)
+            batchbytes += size
+        if len(batch):
+            retval.append(batch)
+        return retval
+
     def getmessagetime(self, uid):
         return self.messagelist[uid]['time']
     
     def getmessageflags(self, uid):
         return self.messagelist[uid]['flags']
 
-    def savemessage_getnewheader(self, content):
+    def savemessage_getnewheader(self, crc):
+        """Returns a unique header to find the message by, given the
+        CRC32 of its content."""
         headername = 'X-OfflineIMAP'
-        headervalue = '%s-' % str(binascii.crc32(content)).replace('-', 'x')
+        headervalue = '%s-' % str(crc).replace('-', 'x')
         headervalue += binascii.hexlify(self.repository.getname()) + '-'
         headervalue += binascii.hexlify(self.getname())
         headervalue += '-%d-' % long(time.time())
@@ -237,26 +624,32 @@ class IMAPFolder(BaseFolder):
         headervalue += '-v' + __version__
         return (headername, headervalue)
 
-    def savemessage_addheader(self, content, headername, headervalue):
+    def savemessage_addheader(self, content, length, headername,
+                              headervalue):
+        """Inserts the header after the first line of content, a file-like
+        object of length bytes with CRLF line endings.  Returns the result
+        as a file-like object, as appendfile() wants it."""
         self.ui.debug('imap',
                  'savemessage_addheader: called to add %s: %s' % (headername,
                                                                   headervalue))
-        insertionpoint = content.find("\r\n")
-        self.ui.debug('imap', 'savemessage_addheader: insertionpoint = %d' % insertionpoint)
-        leader = content[0:insertionpoint]
+        leader = content.readline()
         self.ui.debug('imap', 'savemessage_addheader: leader = %s' % repr(leader))
-        if insertionpoint == 0 or insertionpoint == -1:
-            newline = ''
-            insertionpoint = 0
+        length -= len(leader)
+        newline = "%s: %s" % (headername, headervalue)
+        if leader.endswith("\r\n") and leader != "\r\n":
+            leader = leader[:-2] + "\r\n" + newline + "\r\n"
         else:
-            newline = "\r\n"
-        newline += "%s: %s" % (headername, headervalue)
-        self.ui.debug('imap', 'savemessage_addheader: newline = ' + repr(newline))
-        trailer = content[insertionpoint:]
-        self.ui.debug('imap', 'savemessage_addheader: trailer = ' + repr(trailer))
-        return leader + newline + trailer
-
-    def savemessage_searchforheader(self, imapobj, headername, headervalue):
+            # No headers, or no line ending at all: put it in front.
+            leader = newline + leader
+        self.ui.debug('imap', 'savemessage_addheader: new leader = ' + repr(leader))
+        return imaputil.ConcatFile([StringIO(leader), content],
+                                   len(leader) + length)
+
+    def savemessage_searchforheader(self, imapobj, headername, headervalue,
+                                    search = None):
+        """Returns the UID of the message with the given header, or 0.
+        search may be the CommandFuture of a UID SEARCH for it that was
+        already sent."""
         if imapobj.untagged_responses.has_key('APPENDUID'):
             return long(imapobj.untagged_responses['APPENDUID'][-1].split(' ')[1])
 
@@ -265,7 +658,12 @@ class IMAPFolder(BaseFolder):
         # Now find the UID it got.
         headervalue = imapobj._quote(headervalue)
         try:
-            matchinguids = imapobj.uid('search', 'HEADER', headername, headervalue)[1][0]
+            if search == None:
+                search = imapobj.uid('search', 'HEADER', headername,
+                                     headervalue)
+            else:
+                search = search.result()
+            matchinguids = search[1][0]
         except imapobj.error, err:
             # IMAP server doesn't implement search or had a problem.
             self.ui.debug('imap', "savemessage_searchforheader: got IMAP error '%s' while attempting to UID SEARCH for message with header %s" % (err, headername))
@@ -285,7 +683,69 @@ class IMAPFolder(BaseFolder):
         return long(matchinguids[0])
 
     def savemessage(self, uid, content, flags, rtime):
-        imapobj = self.imapserver.acquireconnection()
+        return self.savemessagefile(uid, StringIO(content), flags, rtime)
+
+    def savemessage_prepare(self, content, rtime):
+        """Works out the internal date and the X-OfflineIMAP header of a
+        message to upload, read from the file-like object content.
+        Returns (date, headername, headervalue, content) where content
+        now carries the header, has CRLF line endings and a len()."""
+        message = rfc822.Message(content, 0)
+        datetuple_msg = rfc822.parsedate(message.getheader('Date'))
+        # Will be None if missing or not in a valid format.
+
+        # If time isn't known
+        if rtime == None and datetuple_msg == None:
+            datetuple = time.localtime()
+        elif rtime == None:
+            datetuple = datetuple_msg
+        else:
+            datetuple = time.localtime(rtime)
+
+        try:
+            if datetuple[0] < 1981:
+                raise ValueError
+
+            # Check for invalid date
+            datetuple_check = time.localtime(time.mktime(datetuple))
+            if datetuple[:2] != datetuple_check[:2]:
+                raise ValueError
+
+            # This could raise a value error if it's not a valid format.
+            date = imaplib.Time2Internaldate(datetuple) 
+        except (ValueError, OverflowError):
+            # Argh, sometimes it's a valid format but year is 0102
+            # or something.  Argh.  It seems that Time2Internaldate
+            # will rause a ValueError if the year is 0102 but not 1902,
+            # but some IMAP servers nonetheless choke on 1902.
+            date = imaplib.Time2Internaldate(time.localtime())
+
+        self.ui.debug('imap', 'savemessage: using date ' + str(date))
+        content.seek(0)
+        content = imaputil.LineEndingFile(content, "\r\n")
+        # The header depends on the whole content, and APPEND wants
+        # to know the size up front: have a first look at it.
+        length = 0
+        crc = 0
+        while 1:
+            data = content.read(65536)
+            if not data:
+                break
+            length += len(data)
+            crc = binascii.crc32(data, crc)
+        content.seek(0)
+
+        (headername, headervalue) = self.savemessage_getnewheader(crc)
+        self.ui.debug('imap', 'savemessage: new headers are: %s: %s' % \
+                 (headername, headervalue))
+        content = self.savemessage_addheader(content, length, headername,
+                                             headervalue)
+        self.ui.debug('imap', 'savemessage: new content length is ' + \
+                 str(len(content)))
+        return (date, headername, headervalue, content)
+
+    def savemessagefile(self, uid, content, flags, rtime):
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
         self.ui.debug('imap', 'savemessage: called')
         try:
             try:
@@ -298,61 +758,32 @@ class IMAPFolder(BaseFolder):
             
             # This backend always assigns a new uid, so the uid arg is ignored.
             # In order to get the new uid, we need to save off the message ID.
+            (date, headername, headervalue, content) = \
+                   self.savemessage_prepare(content, rtime)
 
-            message = rfc822.Message(StringIO(content))
-            datetuple_msg = rfc822.parsedate(message.getheader('Date'))
-            # Will be None if missing or not in a valid format.
-
-            # If time isn't known
-            if rtime == None and datetuple_msg == None:
-                datetuple = time.localtime()
-            elif rtime == None:
-                datetuple = datetuple_msg
-            else:
-                datetuple = time.localtime(rtime)
-
+            # Send the checkpoint and, unless the server tells us the
+            # new UID itself, the search for it right behind the message
+            # instead of waiting for each answer in turn.
+            pipeline = imaplibutil.CommandPipeline(imapobj)
             try:
-                if datetuple[0] < 1981:
-                    raise ValueError
-
-                # Check for invalid date
-                datetuple_check = time.localtime(time.mktime(datetuple))
-                if datetuple[:2] != datetuple_check[:2]:
-                    raise ValueError
-
-                # This could raise a value error if it's not a valid format.
-                date = imaplib.Time2Internaldate(datetuple) 
-            except (ValueError, OverflowError):
-                # Argh, sometimes it's a valid format but year is 0102
-                # or something.  Argh.  It seems that Time2Internaldate
-                # will rause a ValueError if the year is 0102 but not 1902,
-                # but some IMAP servers nonetheless choke on 1902.
-                date = imaplib.Time2Internaldate(time.localtime())
-
-            self.ui.debug('imap', 'savemessage: using date ' + str(date))
-            content = re.sub("(?<!\r)\n", "\r\n", content)
-            self.ui.debug('imap', 'savemessage: initial content is: ' + repr(content))
-
-            (headername, headervalue) = self.savemessage_getnewheader(content)
-            self.ui.debug('imap', 'savemessage: new headers are: %s: %s' % \
-                     (headername, headervalue))
-            content = self.savemessage_addheader(content, headername,
-                                                 headervalue)
-            self.ui.debug('imap', 'savemessage: new content is: ' + repr(content))
-            self.ui.debug('imap', 'savemessage: new content length is ' + \
-                     str(len(content)))
-
-            assert(imapobj.append(self.getfullname(),
-                                       imaputil.flagsmaildir2imap(flags),
-                                       date, content)[0] == 'OK')
-
-            # Checkpoint.  Let it write out the messages, etc.
-            assert(imapobj.check()[0] == 'OK')
+                append = pipeline.append(self.getfullname(),
+                                         imaputil.flagsmaildir2imap(flags),
+                                         date, content)
+                # Checkpoint.  Let it write out the messages, etc.
+                check = pipeline.command('CHECK')
+                search = None
+                if not 'UIDPLUS' in imapobj.capabilities:
+                    search = pipeline.uid('SEARCH', 'HEADER', headername,
+                                          imapobj._quote(headervalue))
+                assert(append.result()[0] == 'OK')
+                assert(check.result()[0] == 'OK')
+            finally:
+                pipeline.flush()
 
             # Keep trying until we get the UID.
             self.ui.debug('imap', 'savemessage: first attempt to get new UID')
             uid = self.savemessage_searchforheader(imapobj, headername,
-                                                   headervalue)
+                                                   headervalue, search)
             # See docs for savemessage in Base.py for explanation of this and other return values
             if uid <= 0:
                 self.ui.debug('imap', 'savemessage: first attempt to get new UID failed.  Going to run a NOOP and try again.')
@@ -368,8 +799,150 @@ class IMAPFolder(BaseFolder):
         self.ui.debug('imap', 'savemessage: returning %d' % uid)
         return uid
 
+    def getsavebatchsize(self):
+        """100 messages per MULTIAPPEND.  Without MULTIAPPEND each
+        message takes an APPEND of its own anyway, and saving them one
+        at a time spreads them over the connections."""
+        if self.repository.getappendbatchsize() <= 0:
+            return 1
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
+        try:
+            if not 'MULTIAPPEND' in imapobj.capabilities:
+                return 1
+        finally:
+            self.imapserver.releaseconnection(imapobj)
+        return 100
+
+    def savemessagesfile(self, messages):
+        """Uploads messages with as few MULTIAPPEND (RFC 3502) commands
+        as appendbatchsize allows, and a single CHECK for all of them.
+        The new UIDs come from APPENDUID if the server has UIDPLUS,
+        otherwise from a search for all of the X-OfflineIMAP headers at
+        once.  Servers without MULTIAPPEND get one APPEND per message."""
+        maxbytes = self.repository.getappendbatchsize()
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
+        try:
+            if maxbytes <= 0 or \
+                   not 'MULTIAPPEND' in imapobj.capabilities:
+                self.imapserver.releaseconnection(imapobj)
+                imapobj = None
+                return BaseFolder.savemessagesfile(self, messages)
+            try:
+                imapobj.select(self.getfullname()) # Needed for search
+            except imapobj.readonly:
+                for uid, content, flags, rtime in messages:
+                    self.ui.msgtoreadonly(self, uid, content, flags)
+                return [0] * len(messages)
+
+            prepared = []
+            for uid, content, flags, rtime in messages:
+                prepared.append((imaputil.flagsmaildir2imap(flags),) + \
+                                self.savemessage_prepare(content, rtime))
+
+            uids = []
+            batch = []
+            batchbytes = 0
+            for message in prepared:
+                size = len(message[4])
+                if len(batch) and batchbytes + size > maxbytes:
+                    uids.extend(self.savemessages_append(imapobj, batch))
+                    batch = []
+                    batchbytes = 0
+                batch.append(message)
+                batchbytes += size
+            if len(batch):
+                uids.extend(self.savemessages_append(imapobj, batch))
+
+            # Checkpoint, and look for the UIDs APPENDUID did not tell us.
+            missing = [(prepared[i][2], prepared[i][3]) \
+                       for i in range(len(prepared)) if not uids[i]]
+            pipeline = imaplibutil.CommandPipeline(imapobj)
+            try:
+                check = pipeline.command('CHECK')
+                searches = []
+                for i in range(0, len(missing), 25):
+                    searches.append(self.savemessages_searchforheaders(
+                        imapobj, pipeline, missing[i:i + 25]))
+                assert(check.result()[0] == 'OK')
+                found = {}
+                for search in searches:
+                    found.update(search())
+            finally:
+                pipeline.flush()
+            for i in range(len(prepared)):
+                if not uids[i]:
+                    uids[i] = found.get(prepared[i][3], 0)
+                if not uids[i]:
+                    # Eg. the server changed the message: go on the slow
+                    # way, as savemessagefile() would.
+                    self.ui.debug('imap', 'savemessagesfile: no UID for %s,' \
+                                  ' trying again after a NOOP' % \
+                                  prepared[i][3])
+                    if imapobj.noop()[0] == 'OK':
+                        uids[i] = self.savemessage_searchforheader(
+                            imapobj, prepared[i][2], prepared[i][3])
+        finally:
+            if imapobj != None:
+                self.imapserver.releaseconnection(imapobj)
+
+        for i in range(len(messages)):
+            if uids[i]: # avoid UID FETCH 0 crash happening later on
+                self.messagelist[uids[i]] = {'uid': uids[i],
+                                             'flags': messages[i][2]}
+        self.ui.debug('imap', 'savemessagesfile: returning %s' % repr(uids))
+        return uids
+
+    def savemessages_append(self, imapobj, batch):
+        """Sends batch, a list of (flags, date, headername, headervalue,
+        content) tuples from savemessagesfile(), with one MULTIAPPEND.
+        Returns their new UIDs, or 0s where APPENDUID did not tell."""
+        self.ui.debug('imap', 'savemessages_append: %d messages, %d bytes' % \
+                      (len(batch), sum([len(m[4]) for m in batch])))
+        typ, dat = imapobj.multiappend(self.getfullname(),
+                                       [(m[0], m[1], m[4]) for m in batch])
+        assert(typ == 'OK')
+        typ, appenduid = imapobj._untagged_response(typ, dat, 'APPENDUID')
+        if appenduid[-1]:
+            uids = imaputil.listsplit(appenduid[-1].split(' ')[1])
+            if len(uids) == len(batch):
+                return uids
+            self.ui.debug('imap', 'savemessages_append: APPENDUID %s does' \
+                          ' not match %d messages' % (appenduid[-1],
+                                                      len(batch)))
+        return [0] * len(batch)
+
+    def savemessages_searchforheaders(self, imapobj, pipeline, headers):
+        """Sends a single UID SEARCH for any of headers, a list of
+        (headername, headervalue), on pipeline.  Returns a function
+        which waits for the answer and returns a hash from the header
+        values to the UIDs of their messages.  As UIDs grow in the order
+        the messages were appended, that is their order in headers; if
+        the number of matches is wrong, the hash is left empty."""
+        criteria = ['OR'] * (len(headers) - 1)
+        for headername, headervalue in headers:
+            criteria.extend(['HEADER', headername,
+                             imapobj._quote(headervalue)])
+        search = pipeline.uid('SEARCH', *criteria)
+        def result():
+            try:
+                matchinguids = search.result()[1][0]
+            except imapobj.error, err:
+                # IMAP server doesn't implement search or had a problem.
+                self.ui.debug('imap', "savemessages_searchforheaders: got" \
+                              " IMAP error '%s'" % err)
+                return {}
+            self.ui.debug('imap', 'savemessages_searchforheaders got ' + \
+                          repr(matchinguids))
+            matchinguids = [long(x) for x in (matchinguids or '').split()]
+            if len(matchinguids) != len(headers):
+                return {}
+            matchinguids.sort()
+            return dict([(headers[i][1], matchinguids[i]) \
+                         for i in range(len(headers))])
+        return result
+
     def savemessageflags(self, uid, flags):
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
         try:
             try:
                 imapobj.select(self.getfullname())
@@ -382,11 +955,11 @@ class IMAPFolder(BaseFolder):
         finally:
             self.imapserver.releaseconnection(imapobj)
         result = result[1][0]
-        if not result:
-            self.messagelist[uid]['flags'] = flags
-        else:
-            flags = imaputil.flags2hash(imaputil.imapsplit(result)[1])['FLAGS']
-            self.messagelist[uid]['flags'] = imaputil.flagsimap2maildir(flags)
+        if result:
+            newflags = imaputil.parsefetch([result])[0][1]
+            if newflags != None:
+                flags = newflags
+        self.messagelist[uid]['flags'] = flags
 
     def addmessageflags(self, uid, flags):
         self.addmessagesflags([uid], flags)
@@ -407,57 +980,66 @@ class IMAPFolder(BaseFolder):
         self.processmessagesflags('-', uidlist, flags)
 
     def processmessagesflags(self, operation, uidlist, flags):
-        if len(uidlist) > 101:
-            # Hack for those IMAP ervers with a limited line length
-            self.processmessagesflags(operation, uidlist[:100], flags)
-            self.processmessagesflags(operation, uidlist[100:], flags)
-            return
-        
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
         try:
             try:
                 imapobj.select(self.getfullname())
             except imapobj.readonly:
                 self.ui.flagstoreadonly(self, uidlist, flags)
                 return
-            r = imapobj.uid('store',
-                            imaputil.listjoin(uidlist),
-                            operation + 'FLAGS',
-                            imaputil.flagsmaildir2imap(flags))
-            assert r[0] == 'OK', 'Error with store: ' + '. '.join(r[1])
-            r = r[1]
+            # Hack for those IMAP ervers with a limited line length: at
+            # most 100 UIDs per STORE.  All of them are sent at once.
+            pipeline = imaplibutil.CommandPipeline(imapobj)
+            try:
+                futures = []
+                for i in range(0, len(uidlist), 100):
+                    futures.append(pipeline.uid('store',
+                                   imaputil.listjoin(uidlist[i:i + 100]),
+                                   operation + 'FLAGS',
+                                   imaputil.flagsmaildir2imap(flags)))
+                r = []
+                for future in futures:
+                    result = future.result()
+                    assert result[0] == 'OK', \
+                           'Error with store: ' + '. '.join(result[1])
+                    r.extend(result[1])
+            finally:
+                pipeline.flush()
         finally:
             self.imapserver.releaseconnection(imapobj)
+        self.processmessagesflags_update(operation, uidlist, flags, r)
+
+    def processmessagesflags_update(self, operation, uidlist, flags, r):
+        """Updates the message list with the results r of a STORE."""
         # Some IMAP servers do not always return a result.  Therefore,
         # only update the ones that it talks about, and manually fix
         # the others.
         needupdate = copy(uidlist)
-        for result in r:
-            if result == None:
-                # Compensate for servers that don't return anything from
-                # STORE.
-                continue
-            attributehash = imaputil.flags2hash(imaputil.imapsplit(result)[1])
-            if not ('UID' in attributehash and 'FLAGS' in attributehash):
+        # Compensate for servers that don't return anything from STORE.
+        r = [result for result in r if result != None]
+        for uid, lflags, internaldate, size in imaputil.parsefetch(r):
+            if uid == None or lflags == None:
                 # Compensate for servers that don't return a UID attribute.
                 continue
-            lflags = attributehash['FLAGS']
-            uid = long(attributehash['UID'])
-            self.messagelist[uid]['flags'] = imaputil.flagsimap2maildir(lflags)
+            self.messagelist[uid]['flags'] = lflags
             try:
                 needupdate.remove(uid)
             except ValueError:          # Let it slide if it's not in the list
                 pass
         for uid in needupdate:
+            # The message list hands out copies of the flags, so they
+            # have to be stored back.
+            msgflags = self.messagelist[uid]['flags']
             if operation == '+':
                 for flag in flags:
-                    if not flag in self.messagelist[uid]['flags']:
-                        self.messagelist[uid]['flags'].append(flag)
-                    self.messagelist[uid]['flags'].sort()
+                    if not flag in msgflags:
+                        msgflags.append(flag)
+                msgflags.sort()
             elif operation == '-':
                 for flag in flags:
-                    if flag in self.messagelist[uid]['flags']:
-                        self.messagelist[uid]['flags'].remove(flag)
+                    if flag in msgflags:
+                        msgflags.remove(flag)
+            self.messagelist[uid]['flags'] = msgflags
 
     def deletemessage(self, uid):
         self.deletemessages_noconvert([uid])
@@ -472,7 +1054,7 @@ class IMAPFolder(BaseFolder):
             return        
 
         self.addmessagesflags_noconvert(uidlist, ['T'])
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
         try:
             try:
                 imapobj.select(self.getfullname())
@@ -483,7 +1065,6 @@ class IMAPFolder(BaseFolder):
                 assert(imapobj.expunge()[0] == 'OK')
         finally:
             self.imapserver.releaseconnection(imapobj)
-        for uid in uidlist:
-            del self.messagelist[uid]
+        self.messagelist.deletekeys(uidlist)
         
         
@@ -18,6 +18,7 @@
 
 from Base import BaseFolder
 import os, threading
+from offlineimap.messagetable import MessageTable
 
 magicline = "OFFLINEIMAP LocalStatus CACHE DATA - DO NOT MODIFY - FORMAT 1"
 
@@ -27,7 +28,8 @@ class LocalStatusFolder(BaseFolder):
         self.root = root
         self.sep = '.'
         self.config = config
-        self.dofsync = config.getdefaultboolean("general", "fsync", True)
+        self.dofsync = config.getfsync()
+        self.fsyncgroup = None
         self.filename = os.path.join(root, name)
         self.filename = repository.getfolderfilename(name)
         self.messagelist = None
@@ -64,10 +66,10 @@ class LocalStatusFolder(BaseFolder):
 
     def cachemessagelist(self):
         if self.isnewfolder():
-            self.messagelist = {}
+            self.messagelist = MessageTable()
             return
         file = open(self.filename, "rt")
-        self.messagelist = {}
+        self.messagelist = MessageTable()
         line = file.readline().strip()
         if not line and not line.read():
             # The status file is empty - should not have happened,
@@ -83,20 +85,41 @@ class LocalStatusFolder(BaseFolder):
             self.messagelist[uid] = {'uid': uid, 'flags': flags}
         file.close()
 
+    def setfsyncgroup(self, fsyncgroup):
+        self.fsyncgroup = fsyncgroup
+
     def autosave(self):
         if self.doautosave:
-            self.save()
+            if self.fsyncgroup != None:
+                self.fsyncgroup.addstatus(self)
+            else:
+                self.save()
 
     def save(self):
+        if self.fsyncgroup != None:
+            # Only written once what it lists is on disk.
+            self.fsyncgroup.addstatus(self)
+            self.fsyncgroup.commit()
+        else:
+            self.savedata(self.getsavedata())
+
+    def getsavedata(self):
+        """Returns what save() writes to the status file."""
+        lines = [magicline + "\n"]
+        for msg in self.messagelist.values():
+            flags = msg['flags']
+            flags.sort()
+            flags = ''.join(flags)
+            lines.append("%s:%s\n" % (msg['uid'], flags))
+        return ''.join(lines)
+
+    def savedata(self, data):
+        """Writes data, as returned by getsavedata(), to the status
+        file."""
         self.savelock.acquire()
         try:
             file = open(self.filename + ".tmp", "wt")
-            file.write(magicline + "\n")
-            for msg in self.messagelist.values():
-                flags = msg['flags']
-                flags.sort()
-                flags = ''.join(flags)
-                file.write("%s:%s\n" % (msg['uid'], flags))
+            file.write(data)
             file.flush()
             if self.dofsync:
                 os.fsync(file.fileno())
@@ -146,6 +169,5 @@ class LocalStatusFolder(BaseFolder):
         if not len(uidlist):
             return
 
-        for uid in uidlist:
-            del(self.messagelist[uid])
+        self.messagelist.deletekeys(uidlist)
         self.autosave()
@@ -0,0 +1,230 @@
+# Local status cache virtual folder, kept in SQLite
+# Copyright (C) 2002 - 2008 John Goerzen
+# <jgoerzen@complete.org>
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+from LocalStatus import LocalStatusFolder
+from offlineimap.messagetable import MessageTable
+import os, threading
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+schemaversion = 1
+
+class LocalStatusSQLiteFolder(LocalStatusFolder):
+    """The same as LocalStatusFolder, but kept in an SQLite database, one
+    per folder, so that a change to the status of a message writes out
+    that message's row only rather than the whole status.
+
+    Changes are queued up as they are made and written out in a single
+    transaction by save() or autosave().  A folder still in the plain
+    text format is converted the first time it is looked at."""
+
+    def __init__(self, root, name, repository, accountname, config):
+        if sqlite3 == None:
+            raise Exception, "The sqlite status backend needs Python's " \
+                  "sqlite3 module"
+        LocalStatusFolder.__init__(self, root, name, repository,
+                                   accountname, config)
+        self.plainfilename = repository.getplainfolderfilename(name)
+        self.dryrun = config.getdefaultboolean('general', 'dryrun', 0)
+        self.connection = None
+        self.pending = []
+        self.pendinglock = threading.Lock()
+
+    def isnewfolder(self):
+        return not os.path.exists(self.filename) and \
+               not os.path.exists(self.plainfilename)
+
+    def _connect(self):
+        """Opens the database, creating it first if need be."""
+        if self.connection != None:
+            return
+        if self._isplaincurrent():
+            # The plain text status was used after the database was last
+            # written, with status_backend = plain, if there is one: the
+            # database is stale, and would have messages uploaded again.
+            self._removedatabase()
+        elif os.path.exists(self.plainfilename) and not self.dryrun:
+            # Converted already, but not removed.
+            os.unlink(self.plainfilename)
+        if not os.path.exists(self.filename):
+            self._create()
+        connection = sqlite3.connect(self.filename, check_same_thread = False)
+        connection.execute("PRAGMA journal_mode = WAL")
+        if self.dofsync:
+            connection.execute("PRAGMA synchronous = FULL")
+        else:
+            connection.execute("PRAGMA synchronous = OFF")
+        version = connection.execute("SELECT value FROM metadata WHERE " \
+                                     "key = 'schemaversion'").fetchone()
+        if version == None or int(version[0]) != schemaversion:
+            connection.close()
+            raise ValueError, "Unknown status database format in %s" % \
+                  self.filename
+        self.connection = connection
+
+    def _isplaincurrent(self):
+        """Whether the plain text status is the one to go by: it is
+        there and the database is not, or is older."""
+        if not os.path.exists(self.plainfilename):
+            return False
+        if not os.path.exists(self.filename):
+            return True
+        return os.path.getmtime(self.plainfilename) > \
+               self._getdatabasemtime()
+
+    def _getplainfolder(self):
+        """Returns a LocalStatusFolder reading the plain text status."""
+        plain = LocalStatusFolder(self.root, self.name, self.repository,
+                                  self.accountname, self.config)
+        plain.filename = self.plainfilename
+        return plain
+
+    def _create(self):
+        """Creates the database, with the FORMAT 1 plain text status in it
+        if there is one.  It is built under a temporary name, so that it
+        is complete once it exists, and the plain text status is then
+        removed, so that it cannot turn stale."""
+        tmpname = self.filename + ".tmp"
+        for filename in [tmpname, tmpname + "-journal"]:
+            if os.path.exists(filename):
+                os.unlink(filename)
+        connection = sqlite3.connect(tmpname)
+        try:
+            connection.execute("CREATE TABLE metadata " \
+                               "(key TEXT PRIMARY KEY, value TEXT)")
+            connection.execute("CREATE TABLE status " \
+                               "(uid INTEGER PRIMARY KEY, flags TEXT)")
+            connection.execute("INSERT INTO metadata VALUES " \
+                               "('schemaversion', ?)", (str(schemaversion),))
+            if os.path.exists(self.plainfilename):
+                plain = self._getplainfolder()
+                plain.cachemessagelist()
+                connection.executemany("INSERT INTO status VALUES (?, ?)",
+                                       [(uid, ''.join(sorted(msg['flags']))) \
+                                        for uid, msg \
+                                        in plain.getmessagelist().iteritems()])
+            connection.commit()
+        finally:
+            connection.close()
+        os.rename(tmpname, self.filename)
+        if self.dofsync:
+            fd = os.open(os.path.dirname(self.filename), os.O_RDONLY)
+            os.fsync(fd)
+            os.close(fd)
+        if os.path.exists(self.plainfilename):
+            os.unlink(self.plainfilename)
+
+    def _getdatabasemtime(self):
+        """When the database was last written to, counting what is still
+        in its write-ahead log."""
+        mtime = os.path.getmtime(self.filename)
+        if os.path.exists(self.filename + "-wal"):
+            mtime = max(mtime, os.path.getmtime(self.filename + "-wal"))
+        return mtime
+
+    def _removedatabase(self):
+        for filename in [self.filename, self.filename + "-wal",
+                         self.filename + "-shm"]:
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+    def deletemessagelist(self):
+        if self.connection != None:
+            self.connection.close()
+            self.connection = None
+        self._removedatabase()
+        if os.path.exists(self.plainfilename):
+            os.unlink(self.plainfilename)
+        self.pendinglock.acquire()
+        self.pending = []
+        self.pendinglock.release()
+
+    def cachemessagelist(self):
+        self.messagelist = MessageTable()
+        if self.isnewfolder():
+            return
+        if self.dryrun and self._isplaincurrent():
+            # Converting it would change things; only read it.
+            plain = self._getplainfolder()
+            plain.cachemessagelist()
+            self.messagelist = plain.getmessagelist()
+            return
+        self.savelock.acquire()
+        try:
+            self._connect()
+            for uid, flags in self.connection.execute("SELECT uid, flags " \
+                                                      "FROM status"):
+                uid = long(uid)
+                self.messagelist[uid] = {'uid': uid, 'flags': list(flags)}
+        finally:
+            self.savelock.release()
+
+    def _queue(self, statement, args):
+        self.pendinglock.acquire()
+        self.pending.append((statement, args))
+        self.pendinglock.release()
+
+    def getsavedata(self):
+        """Returns the changes not written out yet, and forgets about
+        them."""
+        self.pendinglock.acquire()
+        try:
+            pending = self.pending
+            self.pending = []
+        finally:
+            self.pendinglock.release()
+        return pending
+
+    def savedata(self, data):
+        """Writes out the changes returned by getsavedata() in a single
+        transaction."""
+        self.savelock.acquire()
+        try:
+            # Even with no changes, so that the folder is not new anymore.
+            self._connect()
+            if not len(data):
+                return
+            try:
+                for statement, args in data:
+                    self.connection.execute(statement, args)
+                self.connection.commit()
+            except:
+                self.connection.rollback()
+                raise
+        finally:
+            self.savelock.release()
+
+    def savemessage(self, uid, content, flags, rtime):
+        if uid > 0 and not uid in self.messagelist:
+            self._queue("INSERT OR REPLACE INTO status VALUES (?, ?)",
+                        (uid, ''.join(sorted(flags))))
+        return LocalStatusFolder.savemessage(self, uid, content, flags, rtime)
+
+    def savemessageflags(self, uid, flags):
+        self._queue("INSERT OR REPLACE INTO status VALUES (?, ?)",
+                    (uid, ''.join(sorted(flags))))
+        LocalStatusFolder.savemessageflags(self, uid, flags)
+
+    def deletemessages(self, uidlist):
+        for uid in uidlist:
+            if uid in self.messagelist:
+                self._queue("DELETE FROM status WHERE uid = ?", (uid,))
+        LocalStatusFolder.deletemessages(self, uidlist)
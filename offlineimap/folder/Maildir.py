@@ -19,7 +19,9 @@
 import os.path, os, re, time, socket
 from Base import BaseFolder
 from offlineimap import imaputil
+from offlineimap.messagetable import MessageTable
 from threading import Lock
+from StringIO import StringIO
 
 try:
     from hashlib import md5
@@ -30,6 +32,8 @@ uidmatchre = re.compile(',U=(\d+)')
 flagmatchre = re.compile(':.*2,([A-Z]+)')
 timestampmatchre = re.compile('(\d+)');
 
+indexmagicline = "OFFLINEIMAP Maildir INDEX DATA - DO NOT MODIFY - FORMAT 2"
+
 timeseq = 0
 lasttime = long(0)
 timelock = Lock()
@@ -53,7 +57,12 @@ class MaildirFolder(BaseFolder):
     def __init__(self, root, name, sep, repository, accountname, config):
         self.name = name
         self.config = config
-        self.dofsync = config.getdefaultboolean("general", "fsync", True)
+        self.dofsync = config.getfsync()
+        self.fsyncgroup = None
+        self.maxage = config.getdefaultint("Account " + accountname,
+                                           "maxage", -1)
+        self.maxsize = config.getdefaultint("Account " + accountname,
+                                            "maxsize", -1)
         self.root = root
         self.sep = sep
         self.messagelist = None
@@ -95,6 +104,106 @@ class MaildirFolder(BaseFolder):
             return True
 
 
+    def _getindexfilename(self):
+        return os.path.join(self.repository.getscanindexdir(),
+                            self.getfolderbasename())
+
+    def _loadindex(self):
+        """Returns the index kept by _saveindex(), and how many records
+        its file holds: the index is a hash from 'new' and 'cur' to
+        (mtime, entries), entries being a hash from the file names in
+        that directory to what _parsefilename() said about them.  The
+        index is empty if there is no usable one."""
+        index = {}
+        if not self.repository.getscanindex():
+            return (index, 0)
+        filename = self._getindexfilename()
+        if not os.path.exists(filename):
+            return (index, 0)
+        file = open(filename, "rt")
+        try:
+            lines = file.read().split('\n')
+        finally:
+            file.close()
+        if lines[0] != indexmagicline:
+            return ({}, 0)
+        # The last line is empty, or torn by a crash while appending.
+        lines = lines[1:-1]
+        mtimes = {}
+        entries = {'new': {}, 'cur': {}}
+        try:
+            for line in lines:
+                fields = line.split('\t')
+                if fields[0] == '+':
+                    uid = fields[3]
+                    if uid:
+                        uid = long(uid)
+                    else:
+                        uid = None
+                    entries[fields[1]][fields[2]] = (uid, fields[4],
+                                                     int(fields[5]))
+                elif fields[0] == '-':
+                    del entries[fields[1]][fields[2]]
+                elif fields[0] == 'M':
+                    entries[fields[1]]
+                    mtimes[fields[1]] = float(fields[2])
+                else:
+                    raise ValueError, "bad record %s" % fields[0]
+        except (ValueError, KeyError, IndexError):
+            # Garbled; start over.
+            self.ui.debug('maildir', '_loadindex: ignoring broken %s' % \
+                          filename)
+            return ({}, 0)
+        if len(mtimes) != 2:
+            return ({}, 0)
+        for dirannex in ['new', 'cur']:
+            index[dirannex] = (mtimes[dirannex], entries[dirannex])
+        return (index, len(lines))
+
+    def _formatentry(self, dirannex, name, entry):
+        uid, flags, size = entry
+        return "+\t%s\t%s\t%s\t%s\t%d\n" % (dirannex, name, uid or '', flags,
+                                             size)
+
+    def _saveindex(self, index, records, journal):
+        """Saves the changes to index listed in journal, records that
+        _loadindex() reads back.  The index file is a journal itself:
+        they are appended to it, unless it is new or has grown to more
+        than twice the records it needs, when it is written out anew
+        with just those."""
+        filename = self._getindexfilename()
+        live = len(index['new'][1]) + len(index['cur'][1]) + 2
+        if records and records + len(journal) <= 2 * live + 1000:
+            file = open(filename, "at")
+            file.write(''.join(journal))
+            file.close()
+            return
+        file = open(filename + ".tmp", "wt")
+        file.write(indexmagicline + "\n")
+        for dirannex in ['new', 'cur']:
+            mtime, entries = index[dirannex]
+            file.write("M\t%s\t%r\n" % (dirannex, mtime))
+            file.write(''.join([self._formatentry(dirannex, name, entry) \
+                                for name, entry in entries.iteritems()]))
+        file.close()
+        os.rename(filename + ".tmp", filename)
+
+    def _parsefilename(self, messagename, folderstr):
+        """Returns (uid, flags, size) for a message file name: the UID
+        it carries, if it is one of ours, its flags as a sorted string and
+        -1 as the size is not known yet."""
+        uid = None
+        if messagename.find(folderstr) != -1:
+            # It comes from our folder.
+            uidmatch = uidmatchre.search(messagename)
+            if uidmatch:
+                uid = long(uidmatch.group(1))
+        flags = ''
+        flagmatch = flagmatchre.search(messagename)
+        if flagmatch:
+            flags = ''.join(sorted(flagmatch.group(1)))
+        return (uid, flags, -1)
+
     def _scanfolder(self):
         """Cache the message list.  Maildir flags are:
         R (replied)
@@ -102,61 +211,100 @@ class MaildirFolder(BaseFolder):
         T (trashed)
         D (draft)
         F (flagged)
-        and must occur in ASCII order."""
-        retval = {}
-        files = []
+        and must occur in ASCII order.
+
+        What we found is kept in an index along with the mtimes of new/
+        and cur/.  A directory whose mtime did not change since is not
+        even listed, and only the names of files that are new to the
+        index are looked at.  If the repository watches the folder for
+        changes and saw none, the directories are not even stat()ed."""
+        try:
+            return self._scanfolder_index()
+        except:
+            self.repository.markchanged(self.getname())
+            raise
+
+    def _scanfolder_index(self):
+        retval = MessageTable()
         nouidcounter = -1               # Messages without UIDs get
                                         # negative UID numbers.
         foldermd5 = md5(self.getvisiblename()).hexdigest()
         folderstr = ',FMD5=' + foldermd5
+        unchanged = self.repository.checkunchanged(self.getname())
+        scanindex = self.repository.getscanindex()
+        index, records = self._loadindex()
+        journal = []                    # records for _saveindex()
         for dirannex in ['new', 'cur']:
             fulldirname = os.path.join(self.getfullname(), dirannex)
-            files.extend(os.path.join(fulldirname, filename) for
-                         filename in os.listdir(fulldirname))
-        for file in files:
-            messagename = os.path.basename(file)
-
-            #check if there is a parameter for maxage / maxsize - then see if this
-            #message should be considered or not
-            maxage = self.config.getdefaultint("Account " + self.accountname, "maxage", -1)
-            maxsize = self.config.getdefaultint("Account " + self.accountname, "maxsize", -1)
-
-            if(maxage != -1):
-                isnewenough = self._iswithinmaxage(messagename, maxage)
-                if(isnewenough != True):
-                    #this message is older than we should consider....
-                    continue
-
-            #Check and see if the message is too big if the maxsize for this account is set
-            if(maxsize != -1):
-                filesize = os.path.getsize(file)
-                if(filesize > maxsize):
-                    continue
-            
+            if not index.has_key(dirannex):
+                index[dirannex] = (None, {})
+            oldmtime, entries = index[dirannex]
+            if unchanged and oldmtime != None and oldmtime >= 0:
+                continue
+            mtime = os.stat(fulldirname).st_mtime
+            if mtime == oldmtime:
+                continue
+            self.ui.debug('maildir', '_scanfolder: %s changed, listing it' % \
+                          fulldirname)
+            # Only the names that came or went since are looked at.
+            names = set(os.listdir(fulldirname))
+            for messagename in set(entries).difference(names):
+                del entries[messagename]
+                journal.append("-\t%s\t%s\n" % (dirannex, messagename))
+            for messagename in names.difference(entries):
+                entry = self._parsefilename(messagename, folderstr)
+                entries[messagename] = entry
+                if '\t' in messagename or '\n' in messagename:
+                    # Cannot be stored; have the directory listed again.
+                    mtime = -1.0
+                elif scanindex:
+                    journal.append(self._formatentry(dirannex, messagename,
+                                                     entry))
+            # A file added later on in the same tick would not change the
+            # mtime, so do not trust a recent one next time.
+            if mtime >= 0 and time.time() - mtime < 2:
+                mtime = 0.0
+            index[dirannex] = (mtime, entries)
+            journal.append("M\t%s\t%r\n" % (dirannex, mtime))
 
-            foldermatch = messagename.find(folderstr) != -1
-            if not foldermatch:
-                # If there is no folder MD5 specified, or if it mismatches,
-                # assume it is a foreign (new) message and generate a
-                # negative uid for it
-                uid = nouidcounter
-                nouidcounter -= 1
-            else:                       # It comes from our folder.
-                uidmatch = uidmatchre.search(messagename)
-                uid = None
-                if not uidmatch:
+        maxage = self.maxage
+        maxsize = self.maxsize
+        for dirannex in ['new', 'cur']:
+            fulldirname = os.path.join(self.getfullname(), dirannex)
+            prefix = os.path.join(fulldirname, '')
+            entries = index[dirannex][1]
+            for messagename, (uid, flags, size) in entries.iteritems():
+                #check if there is a parameter for maxage / maxsize - then see if this
+                #message should be considered or not
+                if(maxage != -1):
+                    isnewenough = self._iswithinmaxage(messagename, maxage)
+                    if(isnewenough != True):
+                        #this message is older than we should consider....
+                        continue
+
+                #Check and see if the message is too big if the maxsize for this account is set
+                if(maxsize != -1):
+                    if size < 0:
+                        size = os.path.getsize(os.path.join(fulldirname,
+                                                            messagename))
+                        entries[messagename] = (uid, flags, size)
+                        if not ('\t' in messagename or '\n' in messagename):
+                            journal.append(self._formatentry(dirannex,
+                                messagename, entries[messagename]))
+                    if(size > maxsize):
+                        continue
+
+                if uid == None:
+                    # If there is no folder MD5 specified, or if it mismatches,
+                    # assume it is a foreign (new) message and generate a
+                    # negative uid for it
                     uid = nouidcounter
                     nouidcounter -= 1
-                else:
-                    uid = long(uidmatch.group(1))
-            flagmatch = flagmatchre.search(messagename)
-            flags = []
-            if flagmatch:
-                flags = [x for x in flagmatch.group(1)]
-            flags.sort()
-            retval[uid] = {'uid': uid,
-                           'flags': flags,
-                           'filename': file}
+                retval[uid] = {'uid': uid,
+                               'flags': list(flags),
+                               'filename': prefix + messagename}
+        if len(journal) and scanindex:
+            self._saveindex(index, records, journal)
         return retval
 
     def quickchanged(self, statusfolder):
@@ -185,16 +333,32 @@ class MaildirFolder(BaseFolder):
         file.close()
         return retval.replace("\r\n", "\n")
 
+    def getmessagefile(self, uid):
+        filename = self.messagelist[uid]['filename']
+        return imaputil.LineEndingFile(open(filename, 'rb'), "\n")
+
+    def getmessagesizes(self, uidlist):
+        sizes = {}
+        for uid in uidlist:
+            try:
+                sizes[uid] = os.path.getsize(self.messagelist[uid]['filename'])
+            except OSError:
+                pass                    # Gone in the meantime
+        return sizes
+
     def getmessagetime( self, uid ):
         filename = self.messagelist[uid]['filename']
         st = os.stat(filename)
         return st.st_mtime
 
     def savemessage(self, uid, content, flags, rtime):
+        return self.savemessagefile(uid, StringIO(content), flags, rtime)
+
+    def savemessagefile(self, uid, content, flags, rtime):
         # This function only ever saves to tmp/,
         # but it calls savemessageflags() to actually save to cur/ or new/.
-        self.ui.debug('maildir', 'savemessage: called to write with flags %s and content %s' % \
-                 (repr(flags), repr(content)))
+        self.ui.debug('maildir', 'savemessage: called to write with flags %s' % \
+                 repr(flags))
         if uid < 0:
             # We cannot assign a new uid.
             return uid
@@ -227,11 +391,17 @@ class MaildirFolder(BaseFolder):
         tmpmessagename = messagename.split(',')[0]
         self.ui.debug('maildir', 'savemessage: using temporary name %s' % tmpmessagename)
         file = open(os.path.join(tmpdir, tmpmessagename), "wt")
-        file.write(content)
+        while 1:
+            data = content.read(65536)
+            if not data:
+                break
+            file.write(data)
 
         # Make sure the data hits the disk
         file.flush()
-        if self.dofsync:
+        if self.fsyncgroup != None:
+            self.fsyncgroup.addfile(file.fileno())
+        elif self.dofsync:
             os.fsync(file.fileno())
 
         file.close()
@@ -243,7 +413,9 @@ class MaildirFolder(BaseFolder):
             os.rename(os.path.join(tmpdir, tmpmessagename),
                     os.path.join(tmpdir, messagename))
 
-        if self.dofsync:
+        if self.fsyncgroup != None:
+            self.fsyncgroup.adddir(tmpdir)
+        elif self.dofsync:
             try:
                 # fsync the directory (safer semantics in Linux)
                 fd = os.open(tmpdir, os.O_RDONLY)
@@ -258,6 +430,9 @@ class MaildirFolder(BaseFolder):
         self.ui.debug('maildir', 'savemessage: returning uid %d' % uid)
         return uid
         
+    def setfsyncgroup(self, fsyncgroup):
+        self.fsyncgroup = fsyncgroup
+
     def getmessageflags(self, uid):
         return self.messagelist[uid]['flags']
 
@@ -286,22 +461,63 @@ class MaildirFolder(BaseFolder):
             os.rename(oldfilename, newfilename)
             self.messagelist[uid]['flags'] = flags
             self.messagelist[uid]['filename'] = newfilename
+            if self.fsyncgroup != None:
+                self.fsyncgroup.adddir(newpath)
 
         # By now, the message had better not be in tmp/ land!
         final_dir, final_name = os.path.split(self.messagelist[uid]['filename'])
         assert final_dir != tmpdir
 
-    def deletemessage(self, uid):
-        if not uid in self.messagelist:
+    def changemessageuid(self, uid, newuid):
+        """Renames the file of message uid so that it carries newuid,
+        and our folder MD5 so that it is recognized as ours."""
+        if newuid in self.messagelist:
+            # We already have it.
+            self.deletemessage(uid)
             return
-        filename = self.messagelist[uid]['filename']
-        try:
-            os.unlink(filename)
-        except OSError:
-            # Can't find the file -- maybe already deleted?
-            newmsglist = self._scanfolder()
-            if uid in newmsglist:       # Nope, try new filename.
-                os.unlink(newmsglist[uid]['filename'])
-            # Yep -- return.
-        del(self.messagelist[uid])
+        oldfilename = self.messagelist[uid]['filename']
+        dirname, newname = os.path.split(oldfilename)
+        infostr = ''
+        if ':' in newname:
+            newname, infostr = newname.split(':', 1)
+            infostr = ':' + infostr
+        newname = re.sub(',(U|FMD5)=[^,]*', '', newname)
+        newname += ',U=%d,FMD5=%s' % (newuid,
+                                      md5(self.getvisiblename()).hexdigest())
+        newfilename = os.path.join(dirname, newname + infostr)
+        self.ui.debug('maildir', 'changemessageuid: moving from %s to %s' % \
+                      (oldfilename, newfilename))
+        os.rename(oldfilename, newfilename)
+        if self.fsyncgroup != None:
+            self.fsyncgroup.adddir(dirname)
+        elif self.dofsync:
+            try:
+                # fsync the directory (safer semantics in Linux)
+                fd = os.open(dirname, os.O_RDONLY)
+                os.fsync(fd)
+                os.close(fd)
+            except:
+                pass
+        self.messagelist[newuid] = self.messagelist[uid]
+        self.messagelist[newuid]['uid'] = newuid
+        self.messagelist[newuid]['filename'] = newfilename
+        del self.messagelist[uid]
+
+    def deletemessage(self, uid):
+        self.deletemessages([uid])
+
+    def deletemessages(self, uidlist):
+        uidlist = [uid for uid in uidlist if uid in self.messagelist]
+        for uid in uidlist:
+            filename = self.messagelist[uid]['filename']
+            try:
+                os.unlink(filename)
+            except OSError:
+                # Can't find the file -- maybe already deleted?
+                newmsglist = self._scanfolder()
+                if uid in newmsglist:       # Nope, try new filename.
+                    os.unlink(newmsglist[uid]['filename'])
+                # Yep -- go on.
+        # All at once, which the message table does much faster.
+        self.messagelist.deletekeys(uidlist)
         
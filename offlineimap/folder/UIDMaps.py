@@ -18,10 +18,17 @@
 
 from threading import *
 from offlineimap import threadutil
+from offlineimap.messagetable import MessageTable
 from offlineimap.threadutil import InstanceLimitedThread
 from offlineimap.ui import UIBase
 from IMAP import IMAPFolder
+from Base import BaseFolder
 import os.path, re
+from StringIO import StringIO
+
+# How many records more than twice those needed the map file may have
+# before it gets compacted.
+mapcompactslack = 1000
 
 class MappingFolderMixIn:
     def _initmapping(self):
@@ -34,40 +41,103 @@ class MappingFolderMixIn:
                             self.getfolderbasename())
         
     def _loadmaps(self):
+        """Replays the map file, which is a journal: "luid:ruid" maps luid
+        to ruid, in place of whatever either was mapped to before, and
+        "Dluid:ruid" drops that mapping.  A torn last record, as left by
+        a crash, is cut off.  The file is compacted if there are records
+        which no longer count."""
         self.maplock.acquire()
         try:
+            self.maprecords = 0
             mapfilename = self._getmapfilename()
             if not os.path.exists(mapfilename):
                 return ({}, {})
-            file = open(mapfilename, 'rt')
+            file = open(mapfilename, 'rb')
             r2l = {}
             l2r = {}
-            while 1:
-                line = file.readline()
-                if not len(line):
-                    break
-                line = line.strip()
-                (str1, str2) = line.split(':')
-                loc = long(str1)
-                rem = long(str2)
-                r2l[rem] = loc
-                l2r[loc] = rem
+            good = 0
+            torn = 0
+            try:
+                while 1:
+                    line = file.readline()
+                    if not len(line):
+                        break
+                    try:
+                        if not line.endswith("\n"):
+                            raise ValueError, "incomplete record"
+                        self._replaymaprecord(line, r2l, l2r)
+                    except ValueError:
+                        if len(file.readline()):
+                            # Not the last one, so not a torn write.
+                            raise
+                        torn = 1
+                        break
+                    good += len(line)
+                    self.maprecords += 1
+            finally:
+                file.close()
+            if torn:
+                self.ui.debug('imap', '_loadmaps: cutting off torn record ' \
+                              'of %s' % mapfilename)
+                file = open(mapfilename, 'r+b')
+                file.truncate(good)
+                file.close()
+            if self.maprecords != len(l2r):
+                self.diskl2r = l2r
+                self._savemaps(dolock = 0)
             return (r2l, l2r)
         finally:
             self.maplock.release()
 
+    def _replaymaprecord(self, line, r2l, l2r):
+        line = line.strip()
+        delete = line.startswith('D')
+        if delete:
+            line = line[1:]
+        (str1, str2) = line.split(':')
+        loc = long(str1)
+        rem = long(str2)
+        if delete:
+            if l2r.get(loc) == rem:
+                del l2r[loc]
+                del r2l[rem]
+            return
+        if loc in l2r:
+            del r2l[l2r[loc]]
+        if rem in r2l:
+            del l2r[r2l[rem]]
+        r2l[rem] = loc
+        l2r[loc] = rem
+
     def _savemaps(self, dolock = 1):
+        """Writes out the whole map, as a journal without anything that
+        does not count any more."""
         mapfilename = self._getmapfilename()
         if dolock: self.maplock.acquire()
         try:
             file = open(mapfilename + ".tmp", 'wt')
-            for (key, value) in self.diskl2r.iteritems():
-                file.write("%d:%d\n" % (key, value))
+            file.write(''.join(["%d:%d\n" % (key, value) \
+                                for (key, value) in self.diskl2r.iteritems()]))
             file.close()
             os.rename(mapfilename + '.tmp', mapfilename)
+            self.maprecords = len(self.diskl2r)
         finally:
             if dolock: self.maplock.release()
 
+    def _appendmaps(self, added, deleted):
+        """Appends records for the (luid, ruid) pairs that were added to
+        and deleted from the disk maps to the map file, compacting it
+        instead once it is more than twice as long as need be.  Must be
+        called with maplock held."""
+        self.maprecords += len(added) + len(deleted)
+        if self.maprecords > 2 * len(self.diskl2r) + mapcompactslack:
+            self._savemaps(dolock = 0)
+            return
+        file = open(self._getmapfilename(), 'at')
+        file.write(''.join(["D%d:%d\n" % pair for pair in deleted] + \
+                           ["%d:%d\n" % pair for pair in added]))
+        file.close()
+
     def _uidlist(self, mapping, items):
         return [mapping[x] for x in items]
 
@@ -80,14 +150,17 @@ class MappingFolderMixIn:
             # OK.  Now we've got a nice list.  First, delete things from the
             # summary that have been deleted from the folder.
 
+            deleted = []
             for luid in self.diskl2r.keys():
                 if not reallist.has_key(luid):
                     ruid = self.diskl2r[luid]
                     del self.diskr2l[ruid]
                     del self.diskl2r[luid]
+                    deleted.append((luid, ruid))
+            if len(deleted):
+                self._appendmaps([], deleted)
 
             # Now, assign negative UIDs to local items.
-            self._savemaps(dolock = 0)
             nextneg = -1
 
             self.r2l = self.diskr2l.copy()
@@ -106,7 +179,7 @@ class MappingFolderMixIn:
         """Gets the current message list.
         You must call cachemessagelist() before calling this function!"""
 
-        retval = {}
+        retval = MessageTable()
         localhash = self._mb.getmessagelist(self)
         self.maplock.acquire()
         try:
@@ -130,6 +203,24 @@ class MappingFolderMixIn:
         """Returns the content of the specified message."""
         return self._mb.getmessage(self, self.r2l[uid])
 
+    def getmessagefile(self, uid):
+        return self._mb.getmessagefile(self, self.r2l[uid])
+
+    def getmessages(self, uidlist):
+        for luid, content, flags, rtime in \
+                self._mb.getmessages(self, self._uidlist(self.r2l, uidlist)):
+            yield (self.l2r[luid], content, flags, rtime)
+
+    def getmessagesizes(self, uidlist):
+        sizes = self._mb.getmessagesizes(self,
+                                         self._uidlist(self.r2l, uidlist))
+        return dict([(self.l2r[luid], size) for luid, size in sizes.items()])
+
+    def getcopybatches(self, uidlist):
+        batches = self._mb.getcopybatches(self,
+                                          self._uidlist(self.r2l, uidlist))
+        return [self._uidlist(self.l2r, batch) for batch in batches]
+
     def savemessage(self, uid, content, flags, rtime):
         """Writes a new message, with the specified uid.
         If the uid is < 0, the backend should assign a new uid and return it.
@@ -147,13 +238,16 @@ class MappingFolderMixIn:
         If it cannot set the uid to that, it will save it anyway.
         It will return the uid assigned in any case.
         """
+        return self.savemessagefile(uid, StringIO(content), flags, rtime)
+
+    def savemessagefile(self, uid, content, flags, rtime):
         if uid < 0:
             # We cannot assign a new uid.
             return uid
         if uid in self.r2l:
             self.savemessageflags(uid, flags)
             return uid
-        newluid = self._mb.savemessage(self, -1, content, flags, rtime)
+        newluid = self._mb.savemessagefile(self, -1, content, flags, rtime)
         if newluid < 1:
             raise ValueError, "Backend could not find uid for message"
         self.maplock.acquire()
@@ -162,10 +256,16 @@ class MappingFolderMixIn:
             self.diskr2l[uid] = newluid
             self.l2r[newluid] = uid
             self.r2l[uid] = newluid
-            self._savemaps(dolock = 0)
+            self._appendmaps([(newluid, uid)], [])
         finally:
             self.maplock.release()
 
+    def getsavebatchsize(self):
+        return BaseFolder.getsavebatchsize(self)
+
+    def savemessagesfile(self, messages):
+        return BaseFolder.savemessagesfile(self, messages)
+
     def getmessageflags(self, uid):
         return self._mb.getmessageflags(self, self.r2l[uid])
 
@@ -185,7 +285,7 @@ class MappingFolderMixIn:
     def _mapped_delete(self, uidlist):
         self.maplock.acquire()
         try:
-            needssave = 0
+            deleted = []
             for ruid in uidlist:
                 luid = self.r2l[ruid]
                 del self.r2l[ruid]
@@ -193,9 +293,26 @@ class MappingFolderMixIn:
                 if ruid > 0:
                     del self.diskr2l[ruid]
                     del self.diskl2r[luid]
-                    needssave = 1
-            if needssave:
-                self._savemaps(dolock = 0)
+                    deleted.append((luid, ruid))
+            if len(deleted):
+                self._appendmaps([], deleted)
+        finally:
+            self.maplock.release()
+
+    def changemessageuid(self, uid, newuid):
+        """Maps the local message of uid to newuid instead."""
+        self.maplock.acquire()
+        try:
+            luid = self.r2l[uid]
+            del self.r2l[uid]
+            if uid > 0:
+                del self.diskr2l[uid]
+            self.diskl2r[luid] = newuid
+            self.diskr2l[newuid] = luid
+            self.l2r[luid] = newuid
+            self.r2l[newuid] = luid
+            # Replaying this drops the old mapping of luid as well.
+            self._appendmaps([(luid, newuid)], [])
         finally:
             self.maplock.release()
 
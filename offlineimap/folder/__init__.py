@@ -1,2 +1 @@
-import Base, Gmail, IMAP, Maildir, LocalStatus
-
+import Base, Gmail, IMAP, Maildir, LocalStatus, LocalStatusSQLite
@@ -0,0 +1,105 @@
+# Scheduling folder syncs from what they took before
+# Copyright (C) 2002-2007 John Goerzen <jgoerzen@complete.org>
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+import os, time
+from threading import Lock
+
+magicline = "OFFLINEIMAP FolderStats DATA - DO NOT MODIFY - FORMAT 1"
+
+class FolderStats:
+    """How long the last sync of each folder of an account took, and
+    when a sync last changed anything in it, kept in the file filename
+    so that the next run can schedule the folders with it.
+
+    getpriority() orders the folders: those listed in priorityfolders
+    first, in that order, then those whose last sync changed something,
+    then the others, the quickest first within each of these, and last
+    the folders never synced before, whose cost is unknown."""
+
+    def __init__(self, filename, priorityfolders = []):
+        self.filename = filename
+        self.priorityfolders = priorityfolders
+        self.lock = Lock()
+        # foldername -> [seconds, last sync, last sync changing it]
+        self.stats = {}
+        self.load()
+
+    def load(self):
+        self.stats = {}
+        if not os.path.exists(self.filename):
+            return
+        file = open(self.filename, "rt")
+        try:
+            if file.readline().strip() != magicline:
+                # Only ever a hint: start over rather than fail.
+                return
+            for line in file.xreadlines():
+                line = line.rstrip('\n')
+                try:
+                    seconds, lastsync, lastchange, foldername = \
+                             line.split('\t', 3)
+                    self.stats[foldername] = [float(seconds), float(lastsync),
+                                              float(lastchange)]
+                except ValueError:
+                    continue
+        finally:
+            file.close()
+
+    def save(self):
+        self.lock.acquire()
+        try:
+            file = open(self.filename + ".tmp", "wt")
+            file.write(magicline + "\n")
+            for foldername, stats in self.stats.items():
+                file.write("%f\t%f\t%f\t%s\n" % tuple(stats + [foldername]))
+            file.close()
+            os.rename(self.filename + ".tmp", self.filename)
+        finally:
+            self.lock.release()
+
+    def record(self, foldername, seconds, changed):
+        """Records that syncing foldername took seconds, and changed
+        something in it if changed is true."""
+        self.lock.acquire()
+        try:
+            now = time.time()
+            lastchange = 0.0
+            if changed:
+                lastchange = now
+            elif self.stats.has_key(foldername):
+                lastchange = self.stats[foldername][2]
+            self.stats[foldername] = [seconds, now, lastchange]
+        finally:
+            self.lock.release()
+
+    def getpriority(self, foldername, visiblename = None):
+        """Returns the priority of the sync of foldername, which
+        priorityfolders may list under visiblename instead, as
+        threadutil.WorkerPool.submit() takes it: lower goes first."""
+        for name in [foldername, visiblename]:
+            if name in self.priorityfolders:
+                return (0, self.priorityfolders.index(name))
+        self.lock.acquire()
+        try:
+            if not self.stats.has_key(foldername):
+                return (3, 0)
+            seconds, lastsync, lastchange = self.stats[foldername]
+        finally:
+            self.lock.release()
+        if lastchange == lastsync:
+            return (1, seconds)
+        return (2, seconds)
@@ -0,0 +1,116 @@
+# Group commit of local writes
+# Copyright (C) 2002-2007 John Goerzen <jgoerzen@complete.org>
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+import os, time
+from threading import Lock
+
+class GroupCommit:
+    """Puts off the fsync() calls of a folder sync, for fsync = group.
+
+    Folders hand the files and directories they would fsync() to
+    addfile() and adddir(), and the status folder its saves to
+    addstatus().  commit() then fsync()s all of them at once, and only
+    afterwards writes out the status as it was when the commit started,
+    so that the status never lists a message which is not safely on
+    disk.  addstatus() commits by itself once maxcount files or maxdelay
+    seconds have piled up."""
+
+    def __init__(self, maxcount, maxdelay):
+        self.maxcount = maxcount
+        self.maxdelay = maxdelay
+        self.lock = Lock()              # for what is pending
+        self.commitlock = Lock()        # one commit at a time, in order
+        self.fds = []
+        self.dirs = {}
+        self.statusfolders = {}
+        self.since = None
+
+    def _pending(self):
+        if self.since == None:
+            self.since = time.time()
+
+    def addfile(self, fileno):
+        """Have the file open as fileno fsync()ed at the next commit.
+        Takes a copy of the descriptor, so the caller may close it."""
+        fd = os.dup(fileno)
+        self.lock.acquire()
+        try:
+            self._pending()
+            self.fds.append(fd)
+        finally:
+            self.lock.release()
+
+    def adddir(self, dirname):
+        """Have the directory dirname fsync()ed at the next commit."""
+        self.lock.acquire()
+        try:
+            self._pending()
+            self.dirs[dirname] = 1
+        finally:
+            self.lock.release()
+
+    def addstatus(self, statusfolder):
+        """Have statusfolder saved after the next commit, and commit if
+        it is time to."""
+        self.lock.acquire()
+        try:
+            self._pending()
+            self.statusfolders[statusfolder] = 1
+            due = len(self.fds) >= self.maxcount or \
+                  time.time() - self.since >= self.maxdelay
+        finally:
+            self.lock.release()
+        if due:
+            self.commit()
+
+    def commit(self):
+        """fsync()s everything added so far, then saves the status
+        folders."""
+        self.commitlock.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                fds = self.fds
+                dirs = self.dirs.keys()
+                # Whatever these mention was added before, so is in fds
+                # and dirs.
+                statuses = [(statusfolder, statusfolder.getsavedata()) \
+                            for statusfolder in self.statusfolders.keys()]
+                self.fds = []
+                self.dirs = {}
+                self.statusfolders = {}
+                self.since = None
+            finally:
+                self.lock.release()
+            try:
+                for fd in fds:
+                    os.fsync(fd)
+            finally:
+                for fd in fds:
+                    os.close(fd)
+            for dirname in dirs:
+                try:
+                    # fsync the directory (safer semantics in Linux)
+                    fd = os.open(dirname, os.O_RDONLY)
+                    os.fsync(fd)
+                    os.close(fd)
+                except OSError:
+                    pass
+            for statusfolder, data in statuses:
+                statusfolder.savedata(data)
+        finally:
+            self.commitlock.release()
@@ -15,7 +15,8 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
-import re, socket, time, subprocess
+import re, socket, time, subprocess, os, zlib
+import imaplib
 from offlineimap.ui import getglobalui
 from imaplib import *
 
@@ -28,7 +29,217 @@ except ImportError:
     #fails on python <2.6
     pass
 
-class IMAP4_Tunnel(IMAP4):
+# Teach imaplib about the extension commands we use, so that it does
+# not refuse to send them.
+imaplib.Commands.setdefault('ENABLE', ('AUTH',))
+imaplib.Commands.setdefault('IDLE', ('SELECTED',))
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+imaplib.Commands.setdefault('MOVE', ('SELECTED',))
+
+class DeflateMixIn:
+    """COMPRESS=DEFLATE (RFC 4978) support for the IMAP4 classes below.
+
+    Once startcompressing() has been called, their read(), readline()
+    and send() go through the _inflate*() and _deflatesend() methods
+    here.  Those use the _rawread() and _rawsend() methods of the
+    class to talk to the connection itself."""
+    compressor = None
+
+    def beforecompressing(self):
+        """Called before issuing COMPRESS.  Nothing may be buffered
+        beyond the tagged response, as the rest is compressed."""
+        pass
+
+    def aftercompressing(self, ok):
+        """Called with the outcome of COMPRESS.  If it failed, we go on
+        uncompressed."""
+        if ok:
+            self.startcompressing()
+
+    def startcompressing(self):
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                           zlib.DEFLATED, -15)
+        self.decompressor = zlib.decompressobj(-15)
+        self._inflatebuf = ''
+        self.compressedin = self.uncompressedin = 0
+        self.compressedout = self.uncompressedout = 0
+
+    def compressionstats(self):
+        """Returns a human-readable summary of the bytes transferred
+        since compression was started, or None if it was not."""
+        if self.compressor == None:
+            return None
+        def ratio(compressed, uncompressed):
+            if not compressed:
+                return 0.0
+            return float(uncompressed) / compressed
+        return "read %d bytes (%d uncompressed, %.1fx), " \
+               "sent %d bytes (%d uncompressed, %.1fx)" % \
+               (self.compressedin, self.uncompressedin,
+                ratio(self.compressedin, self.uncompressedin),
+                self.compressedout, self.uncompressedout,
+                ratio(self.compressedout, self.uncompressedout))
+
+    def _inflatemore(self):
+        """Fills _inflatebuf.  Returns false at end of file."""
+        while not self._inflatebuf:
+            data = self._rawread(16384)
+            if not data:
+                return 0
+            self.compressedin += len(data)
+            self._inflatebuf = self.decompressor.decompress(data)
+            self.uncompressedin += len(self._inflatebuf)
+        return 1
+
+    def _inflateread(self, size):
+        chunks = []
+        while size > 0:
+            if not self._inflatebuf and not self._inflatemore():
+                break
+            chunk = self._inflatebuf[:size]
+            self._inflatebuf = self._inflatebuf[size:]
+            chunks.append(chunk)
+            size -= len(chunk)
+        return ''.join(chunks)
+
+    def _inflatereadline(self):
+        chunks = []
+        while 1:
+            if not self._inflatebuf and not self._inflatemore():
+                break
+            nlindex = self._inflatebuf.find("\n")
+            if nlindex != -1:
+                chunks.append(self._inflatebuf[:nlindex + 1])
+                self._inflatebuf = self._inflatebuf[nlindex + 1:]
+                break
+            chunks.append(self._inflatebuf)
+            self._inflatebuf = ''
+        return ''.join(chunks)
+
+    def _deflatesend(self, data):
+        self.uncompressedout += len(data)
+        data = self.compressor.compress(data) + \
+               self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.compressedout += len(data)
+        self._rawsend(data)
+
+class CommandFuture:
+    """The outcome of a command sent through a CommandPipeline."""
+    def __init__(self, pipeline, name, tag, untagged):
+        self.pipeline = pipeline
+        self.name = name
+        self.tag = tag
+        self.untagged = untagged
+        self.done = 0
+        self.value = None
+        self.exception = None
+
+    def isdone(self):
+        return self.done
+
+    def result(self):
+        """Waits for the command to complete and returns (typ, dat) the
+        way the imaplib command methods do: dat holds the untagged
+        responses the command is expected to produce, if any.  Raises
+        the imaplib exception the command ended with."""
+        if not self.done:
+            self.pipeline.waitfor(self)
+        if self.exception:
+            raise self.exception
+        return self.value
+
+    def _complete(self, imapobj):
+        try:
+            typ, dat = imapobj._command_complete(self.name, self.tag)
+            if self.untagged:
+                typ, dat = imapobj._untagged_response(typ, dat, self.untagged)
+            self.value = (typ, dat)
+        except imapobj.abort:
+            raise
+        except imapobj.error, e:
+            self.exception = e
+        self.done = 1
+
+class CommandPipeline:
+    """Sends commands on a connection without waiting for the answer to
+    the previous one, so that a batch of commands costs about one round
+    trip rather than one each.  Every command returns a CommandFuture.
+
+    Commands complete in the order they were issued, and as servers
+    answer in order too, the untagged responses read up to a command's
+    tagged response are that command's.  Up to window commands are
+    outstanding at a time; keep their responses small, as nothing is
+    read while we are sending.
+
+    The pipeline must be flush()ed before the connection is released."""
+    def __init__(self, imapobj, window = 32):
+        self.imapobj = imapobj
+        self.window = window
+        self.pending = []
+
+    def command(self, name, *args):
+        """Issues an arbitrary command, e.g. command('CHECK')."""
+        return self._issue(name, None, args)
+
+    def uid(self, command, *args):
+        """Same as imaplib.IMAP4.uid()."""
+        command = command.upper()
+        if command in ('SEARCH', 'SORT', 'THREAD'):
+            untagged = command
+        else:
+            untagged = 'FETCH'
+        return self._issue('UID', untagged, (command,) + args)
+
+    def append(self, mailbox, flags, date_time, literal):
+        """Same as appendfile() of the connection.  The literal still
+        waits for the server's continuation request."""
+        if flags:
+            if (flags[0], flags[-1]) != ('(', ')'):
+                flags = '(%s)' % flags
+        else:
+            flags = None
+        self.imapobj.literal = literal
+        return self._issue('APPEND', None, (mailbox, flags, date_time))
+
+    def _issue(self, name, untagged, args):
+        while len(self.pending) >= self.window:
+            self._completenext()
+        try:
+            tag = self.imapobj._command(name, *args)
+        except self.imapobj.abort, e:
+            self._abort(e)
+            raise
+        future = CommandFuture(self, name, tag, untagged)
+        self.pending.append(future)
+        return future
+
+    def _completenext(self):
+        future = self.pending.pop(0)
+        try:
+            future._complete(self.imapobj)
+        except self.imapobj.abort, e:
+            future.exception = e
+            future.done = 1
+            self._abort(e)
+            raise
+
+    def _abort(self, e):
+        """The connection is gone; so are the answers we waited for."""
+        for future in self.pending:
+            future.exception = e
+            future.done = 1
+        self.pending = []
+
+    def waitfor(self, future):
+        while not future.done:
+            self._completenext()
+
+    def flush(self):
+        """Waits for all outstanding commands."""
+        while self.pending:
+            self._completenext()
+
+class IMAP4_Tunnel(DeflateMixIn, IMAP4):
     """IMAP4 client class over a tunnel
 
     Instantiate with: IMAP4_Tunnel(tunnelcmd)
@@ -46,15 +257,28 @@ class IMAP4_Tunnel(IMAP4):
         (self.outfd, self.infd) = (self.process.stdin, self.process.stdout)
 
     def read(self, size):
+        if self.compressor:
+            return self._inflateread(size)
         retval = ''
         while len(retval) < size:
             retval += self.infd.read(size - len(retval))
         return retval
 
     def readline(self):
+        if self.compressor:
+            return self._inflatereadline()
         return self.infd.readline()
 
     def send(self, data):
+        if self.compressor:
+            return self._deflatesend(data)
+        self.outfd.write(data)
+
+    def _rawread(self, size):
+        # The pipe is unbuffered, so nothing is left behind in infd.
+        return os.read(self.infd.fileno(), size)
+
+    def _rawsend(self, data):
         self.outfd.write(data)
 
     def shutdown(self):
@@ -69,14 +293,23 @@ def new_mesg(self, s, secs=None):
             tm = time.strftime('%M:%S', time.localtime(secs))
             getglobalui().debug('imap', '  %s.%02d %s' % (tm, (secs*100)%100, s))
 
-class WrappedIMAP4_SSL(IMAP4_SSL):
+class WrappedIMAP4_SSL(DeflateMixIn, IMAP4_SSL):
     """Provides an improved version of the standard IMAP4_SSL
 
     It provides a better readline() implementation as impaplib's
     readline() is extremly inefficient. It can also connect to IPv6
-    addresses."""
+    addresses.
+
+    What we received but did not hand out yet lives in _readbuf,
+    starting at _readpos.  Consuming data only moves _readpos along, so
+    reading a response line by line does not copy the rest of the
+    buffer each time."""
+    # How much to ask the SSL layer for at once.
+    readsize = 65536
+
     def __init__(self, *args, **kwargs):
-        self._readbuf = ''
+        self._readbuf = bytearray()
+        self._readpos = 0
         self._cacertfile = kwargs.get('cacertfile', None)
         if kwargs.has_key('cacertfile'):
             del kwargs['cacertfile']
@@ -166,50 +399,93 @@ class WrappedIMAP4_SSL(IMAP4_SSL):
                 return ('certificate is for %s') % certname
         return ('no commonName found in certificate')
 
+    def _fillbuf(self):
+        """Appends the next data from the server to _readbuf.  Returns
+        false at EOF."""
+        data = self.sslobj.read(self.readsize)
+        if not data:
+            return 0
+        if self._readpos:
+            # Drop what was handed out already before growing.
+            del self._readbuf[:self._readpos]
+            self._readpos = 0
+        self._readbuf += data
+        return 1
+
+    def _takebuf(self, n):
+        """Hands out up to n bytes from _readbuf."""
+        end = min(self._readpos + n, len(self._readbuf))
+        retval = str(self._readbuf[self._readpos:end])
+        if end == len(self._readbuf):
+            del self._readbuf[:]
+            self._readpos = 0
+        else:
+            self._readpos = end
+        return retval
+
     def _read_upto (self, n):
         """Read up to n bytes, emptying existing _readbuffer first"""
-        bytesfrombuf = min(n, len(self._readbuf))
-        if bytesfrombuf:
+        if self._readpos < len(self._readbuf):
             # Return the stuff in readbuf, even if less than n.
             # It might contain the rest of the line, and if we try to
             # read more, might block waiting for data that is not
             # coming to arrive.
-            retval = self._readbuf[:bytesfrombuf]
-            self._readbuf = self._readbuf[bytesfrombuf:]
-            return retval
-        return self.sslobj.read(min(n, 16384))
+            return self._takebuf(n)
+        # The SSL layer allocates all of n up front, whatever it
+        # returns; n may be the size of a whole literal.
+        return self.sslobj.read(min(n, self.readsize))
 
     def read(self, n):
         """Read exactly n bytes
 
         As done in IMAP4_SSL.read() API. If read returns less than n
         bytes, things break left and right."""
+        if self.compressor:
+            return self._inflateread(n)
         chunks = []
         read = 0
         while read < n:
+            # Anything beyond the buffer goes straight from the SSL
+            # layer to the result.
             data = self._read_upto (n-read)
+            if not data:
+                raise self.abort('socket error: EOF')
             read += len(data)
             chunks.append(data)
-
+        if len(chunks) == 1:
+            return chunks[0]
         return ''.join(chunks)
 
     def readline(self):
         """Get the next line. This implementation is more efficient
         than IMAP4_SSL.readline() which reads one char at a time and
         reassembles the string by appending those chars. Uggh."""
-        retval = ''
+        if self.compressor:
+            return self._inflatereadline()
+        searched = 0
         while 1:
-            linebuf = self._read_upto(1024)
-            nlindex = linebuf.find("\n")
+            nlindex = self._readbuf.find("\n", self._readpos + searched)
             if nlindex != -1:
-                retval += linebuf[:nlindex + 1]
-                self._readbuf = linebuf[nlindex + 1:] + self._readbuf
-                return retval
-            else:
-                retval += linebuf
+                return self._takebuf(nlindex + 1 - self._readpos)
+            searched = len(self._readbuf) - self._readpos
+            if not self._fillbuf():
+                # EOF; imaplib will complain about the partial line.
+                return self._takebuf(searched)
+
+    def send(self, data):
+        if self.compressor:
+            return self._deflatesend(data)
+        return IMAP4_SSL.send(self, data)
+
+    def _rawread(self, size):
+        # Compressed data may already sit in _readbuf.
+        return self._read_upto(size)
+
+    def _rawsend(self, data):
+        IMAP4_SSL.send(self, data)
 
 
-class WrappedIMAP4(IMAP4):
+class WrappedIMAP4(DeflateMixIn, IMAP4):
     """Improved version of imaplib.IMAP4 that can also connect to IPv6"""
 
     def open(self, host = '', port = IMAP4_PORT):
@@ -239,6 +515,37 @@ class WrappedIMAP4(IMAP4):
             raise socket.error(last_error)
         self.file = self.sock.makefile('rb')
 
+    def read(self, size):
+        if self.compressor:
+            return self._inflateread(size)
+        return IMAP4.read(self, size)
+
+    def readline(self):
+        if self.compressor:
+            return self._inflatereadline()
+        return IMAP4.readline(self)
+
+    def send(self, data):
+        if self.compressor:
+            return self._deflatesend(data)
+        return IMAP4.send(self, data)
+
+    def beforecompressing(self):
+        # The buffered file might read ahead past the response to
+        # COMPRESS; read it unbuffered instead.
+        self.file = self.sock.makefile('rb', 0)
+
+    def aftercompressing(self, ok):
+        if not ok:
+            self.file = self.sock.makefile('rb')
+        DeflateMixIn.aftercompressing(self, ok)
+
+    def _rawread(self, size):
+        return self.sock.recv(size)
+
+    def _rawsend(self, data):
+        self.sock.sendall(data)
+
 mustquote = re.compile(r"[^\w!#$%&'+,.:;<=>?^`|~-]")
 
 def Internaldate2epoch(resp):
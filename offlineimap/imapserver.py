@@ -20,7 +20,7 @@ import imaplib
 from offlineimap import imaplibutil, imaputil, threadutil
 from offlineimap.ui import getglobalui
 from threading import *
-import thread, hmac, os, time
+import thread, hmac, os, time, re, sys, tempfile, socket
 import base64
 
 from StringIO import StringIO
@@ -36,6 +36,24 @@ except ImportError:
     pass
 
 class UsefulIMAPMixIn:
+    def __init__(self, *args, **kwargs):
+        """Takes the same arguments as the IMAP4 class we are mixed into,
+        plus capabilities: what the server answered to CAPABILITY on
+        an earlier connection, so that we need not ask again."""
+        self.knowncapabilities = kwargs.pop('capabilities', None)
+        self.__class__.__bases__[1].__init__(self, *args, **kwargs)
+
+    def capability(self):
+        """Same as imaplib.IMAP4.capability(), but does not ask the server
+        if we know the answer already: from the capabilities passed to the
+        constructor, or because the server sent them along unasked."""
+        known, self.knowncapabilities = self.knowncapabilities, None
+        if self.untagged_responses.has_key('CAPABILITY'):
+            return 'OK', self.untagged_responses.pop('CAPABILITY')
+        if known:
+            return 'OK', [known]
+        return self.__class__.__bases__[1].capability(self)
+
     def getstate(self):
         return self.state
     def getselectedfolder(self):
@@ -43,12 +61,29 @@ class UsefulIMAPMixIn:
             return self.selectedfolder
         return None
 
-    def select(self, mailbox='INBOX', readonly=None, force = 0):
+    def select(self, mailbox='INBOX', readonly=None, force = 0,
+               qresync = None):
+        """Select mailbox, unless it is already selected.
+
+        qresync may be a (uidvalidity, highestmodseq) tuple as saved
+        from a previous session (RFC 5162).  The server will then send
+        VANISHED and FETCH responses for everything that changed since,
+        which end up in untagged_responses.
+
+        A read-write selection is good enough for readonly callers too,
+        so going back and forth between the two does not cost SELECTs."""
         if (not force) and self.getselectedfolder() == mailbox \
-           and self.is_readonly == readonly:
+           and (readonly or not self.is_readonly):
             # No change; return.
             return
-        result = self.__class__.__bases__[1].select(self, mailbox, readonly)
+        # Until we know better; a failed SELECT leaves the connection
+        # without a selected mailbox.
+        self.selectedfolder = None
+        if qresync:
+            result = self._select_qresync(mailbox, readonly, qresync)
+        else:
+            result = self.__class__.__bases__[1].select(self, mailbox,
+                                                        readonly)
         if result[0] != 'OK':
             raise ValueError, "Error from select: %s" % str(result)
         if self.getstate() == 'SELECTED':
@@ -56,41 +91,318 @@ class UsefulIMAPMixIn:
         else:
             self.selectedfolder = None
 
-    def _mesg(self, s, secs=None):
-        imaplibutil.new_mesg(self, s, secs)
+    def _select_qresync(self, mailbox, readonly, qresync):
+        """Same as imaplib.IMAP4.select(), but passing the QRESYNC
+        select parameter along."""
+        self.untagged_responses = {}    # Flush old responses.
+        self.is_readonly = readonly
+        if readonly:
+            name = 'EXAMINE'
+        else:
+            name = 'SELECT'
+        typ, dat = self._simple_command(name, mailbox,
+                                        '(QRESYNC (%d %d))' % qresync)
+        if typ != 'OK':
+            self.state = 'AUTH'     # Might have been 'SELECTED'
+            return typ, dat
+        self.state = 'SELECTED'
+        if 'READ-ONLY' in self.untagged_responses and not readonly:
+            raise self.readonly('%s is not writable' % mailbox)
+        return typ, self.untagged_responses.get('EXISTS', [None])
+
+    def enable(self, capability):
+        """Enable a server extension (RFC 5161)."""
+        typ, dat = self._simple_command('ENABLE', capability)
+        return self._untagged_response(typ, dat, 'ENABLED')
+
+    def refreshcapabilities(self, known = None):
+        """Re-read the server capabilities.  Many servers only announce
+        extensions once we are authenticated.  known may be what another
+        connection to the same server found, which is used unless the
+        server tells us along with the tagged OK of the authentication."""
+        if known and not self.untagged_responses.has_key('CAPABILITY'):
+            self.knowncapabilities = known
+        typ, dat = self.capability()
+        if dat and dat[-1]:
+            self.capabilities = tuple(dat[-1].upper().split())
+
+    def fetchiter(self, uidset, items, spool = 0):
+        """Issues UID FETCH uidset items and yields each FETCH response
+        as soon as it has been read, rather than collecting all of them
+        in memory first as uid('FETCH', ...) does.
+
+        Yields (attributes, literal) tuples: the response text with the
+        literal and its item name cut out, and the literal itself (None
+        if the response had no literal).  If spool is true, large
+        literals are returned as temporary files instead of strings."""
+        tag = self._command('UID', 'FETCH', uidset, items)
+        done = 0
+        self.spoolliterals = spool
+        try:
+            while self.tagged_commands[tag] == None:
+                self._get_response()
+                attributes = ''
+                literal = None
+                for item in self.untagged_responses.pop('FETCH', []):
+                    if type(item) == type(()):
+                        # ('1 (UID 3 BODY[] {42}', literal), the rest of
+                        # the response follows as the next item.
+                        attributes += re.sub('\S+ \{\d+\}$', '', item[0])
+                        literal = item[1]
+                    else:
+                        yield (attributes + item, literal)
+                        attributes = ''
+                        literal = None
+            done = 1
+        finally:
+            if not done:
+                # Our consumer gave up early.  Make sure the rest of the
+                # response is read before the connection is used again.
+                while self.tagged_commands.get(tag, 1) == None:
+                    self._get_response()
+                    self.untagged_responses.pop('FETCH', None)
+                self.tagged_commands.pop(tag, None)
+            self.spoolliterals = 0
+        typ, dat = self._command_complete('UID', tag)
+        if typ != 'OK':
+            raise self.error('UID FETCH %s failed: %s' % (uidset, dat))
+
+    def compress(self):
+        """Start compressing this connection (RFC 4978)."""
+        self.beforecompressing()
+        typ = None
+        try:
+            typ, dat = self._simple_command('COMPRESS', 'DEFLATE')
+        finally:
+            self.aftercompressing(typ == 'OK')
+        if typ != 'OK':
+            raise self.error('COMPRESS failed: %s' % dat)
+        return typ, dat
+
+    def liststatus(self, reference, pattern, items):
+        """LIST with the STATUS return option (RFC 5819): returns the
+        status items of all matching mailboxes in a single command, in
+        the same format as multistatus()."""
+        typ, dat = self._simple_command('LIST', reference, pattern,
+                                        'RETURN', '(STATUS %s)' % items)
+        self.untagged_responses.pop('LIST', None)
+        if typ != 'OK':
+            self.untagged_responses.pop('STATUS', None)
+            raise self.error('LIST-STATUS failed: %s' % dat)
+        return self._popstatus()
+
+    def multistatus(self, mailboxes, items, window = 100):
+        """Issues STATUS mailbox items for each of mailboxes.  Up to
+        window commands are sent before waiting for their responses, so
+        that we don't pay a round trip per mailbox.
+
+        Returns a dictionary mapping mailbox names to dictionaries of
+        status items.  Mailboxes the server refused are left out."""
+        pipeline = imaplibutil.CommandPipeline(self, window)
+        futures = [pipeline.command('STATUS', mailbox, items) \
+                   for mailbox in mailboxes]
+        for future in futures:
+            try:
+                future.result()
+            except self.abort:
+                raise
+            except self.error:
+                # BAD, e.g. an odd mailbox name; try the others.
+                pass
+        return self._popstatus()
+
+    def _popstatus(self):
+        """Parses and removes the untagged STATUS responses."""
+        result = {}
+        mailbox = None
+        for item in self.untagged_responses.pop('STATUS', []):
+            if type(item) == type(()):
+                # Mailbox name sent as a literal; the items follow as
+                # the next response item.
+                mailbox = item[1]
+                continue
+            if mailbox == None:
+                mailbox, item = imaputil.imapsplit(item)
+                mailbox = imaputil.dequote(mailbox)
+            status = {}
+            for name, value in imaputil.flags2hash(item.strip()).items():
+                status[name.upper()] = long(value)
+            result[mailbox] = status
+            mailbox = None
+        return result
+
+    def idle(self, timeout, event):
+        """Issues IDLE (RFC 2177) on the selected mailbox and waits until
+        the server reports a change, timeout seconds have passed, or
+        idle_done() is called from another thread after setting event.
+
+        Returns true if the mailbox has changed."""
+        for typ in self.idlechanges:
+            self.untagged_responses.pop(typ, None)
+        self.idlelock = Lock()
+        self.idling = 0
+        tag = self._command('IDLE')
+        # Wait for the continuation request before we are allowed to
+        # send DONE.  A tagged response here means the server refused.
+        while self._get_response() != None:
+            if self.tagged_commands[tag] != None:
+                typ, dat = self._command_complete('IDLE', tag)
+                raise self.error('IDLE failed: %s' % dat)
+        self.idlelock.acquire()
+        try:
+            self.idling = 1
+            if event.isSet():
+                self._idle_done()
+        finally:
+            self.idlelock.release()
+
+        # Nothing but DONE may be sent while idling, and a blocking read
+        # would be cut short by the socket timeout otherwise.
+        sockets = [getattr(self, attr, None) for attr in ('sock', 'sslobj')]
+        sockets = [s for s in sockets if hasattr(s, 'settimeout')]
+        timeouts = [s.gettimeout() for s in sockets]
+        for s in sockets:
+            s.settimeout(None)
+        timer = Timer(timeout, self.idle_done)
+        timer.setDaemon(1)
+        timer.start()
+        changed = 0
+        try:
+            while self.tagged_commands[tag] == None:
+                self._get_response()
+                for typ in self.idlechanges:
+                    if self.untagged_responses.has_key(typ):
+                        changed = 1
+                if changed:
+                    self.idle_done()
+        finally:
+            timer.cancel()
+            for s, t in zip(sockets, timeouts):
+                s.settimeout(t)
+        typ, dat = self._command_complete('IDLE', tag)
+        if typ != 'OK':
+            raise self.error('IDLE failed: %s' % dat)
+        return changed
+
+    idlechanges = ('EXISTS', 'EXPUNGE', 'FETCH', 'VANISHED')
+
+    def idle_done(self):
+        """Ends a running idle(), if any."""
+        lock = getattr(self, 'idlelock', None)
+        if lock == None:
+            return
+        lock.acquire()
+        try:
+            self._idle_done()
+        finally:
+            lock.release()
+
+    def _idle_done(self):
+        # Must be called with idlelock held.
+        if self.idling:
+            self.idling = 0
+            self.send('DONE' + imaplib.CRLF)
+
+    def appendfile(self, mailbox, flags, date_time, literal):
+        """Same as imaplib.IMAP4.append(), but the message is sent from
+        literal, a file-like object whose len() is its size in bytes.
+        It must already have CRLF line endings."""
+        if flags:
+            if (flags[0], flags[-1]) != ('(', ')'):
+                flags = '(%s)' % flags
+        else:
+            flags = None
+        self.literal = literal
+        return self._simple_command('APPEND', mailbox, flags, date_time)
+
+    def multiappend(self, mailbox, messages):
+        """Appends several messages with one MULTIAPPEND (RFC 3502)
+        command.  messages is a list of (flags, date_time, literal)
+        tuples as appendfile() takes them.  If the server has LITERAL+
+        (RFC 2088), all of it is sent without waiting for continuation
+        requests.  Either all messages are appended or none; the
+        APPENDUID of all of them is left in untagged_responses."""
+        if self.state not in imaplib.Commands['APPEND']:
+            raise self.error("command APPEND illegal in state %s" % \
+                             self.state)
+        for typ in ('OK', 'NO', 'BAD', 'APPENDUID'):
+            if self.untagged_responses.has_key(typ):
+                del self.untagged_responses[typ]
+        literalplus = 'LITERAL+' in self.capabilities
+        tag = self._new_tag()
+        data = '%s APPEND %s' % (tag, self._checkquote(mailbox))
+        try:
+            for flags, date_time, literal in messages:
+                if flags:
+                    if (flags[0], flags[-1]) != ('(', ')'):
+                        flags = '(%s)' % flags
+                    data = '%s %s' % (data, flags)
+                data = '%s %s' % (data, self._checkquote(date_time))
+                if literalplus:
+                    self.send('%s {%d+}%s' % (data, len(literal),
+                                              imaplib.CRLF))
+                else:
+                    self.send('%s {%d}%s' % (data, len(literal),
+                                             imaplib.CRLF))
+                    while self._get_response():
+                        if self.tagged_commands[tag]:   # BAD/NO?
+                            return self._command_complete('APPEND', tag)
+                self.send(literal)
+                data = ''
+            self.send(imaplib.CRLF)
+        except (socket.error, OSError), val:
+            raise self.abort('socket error: %s' % val)
+        return self._command_complete('APPEND', tag)
+
+    def send(self, data):
+        if hasattr(data, 'read'):
+            # A literal from appendfile().
+            while 1:
+                chunk = data.read(65536)
+                if not chunk:
+                    break
+                self.__class__.__bases__[1].send(self, chunk)
+        else:
+            self.__class__.__bases__[1].send(self, data)
 
-class UsefulIMAP4(UsefulIMAPMixIn, imaplibutil.WrappedIMAP4):
+    # Literals larger than this are read into a temporary file rather
+    # than a string while spoolliterals is set.
+    spoolsize = 65536
+    spoolliterals = 0
+
+    def read(self, size):
+        if self.spoolliterals and size > self.spoolsize:
+            file = tempfile.TemporaryFile()
+            while size > 0:
+                data = self._read(min(size, 65536))
+                file.write(data)
+                size -= len(data)
+            file.seek(0)
+            return file
+        return self._read(size)
 
     # This is a hack around Darwin's implementation of realloc() (which
     # Python uses inside the socket code). On Darwin, we split the
     # message into 100k chunks, which should be small enough - smaller
     # might start seriously hurting performance ...
-    def read(self, size):
+    def _read(self, size):
         if (system() == 'Darwin') and (size>0) :
             read = 0
             io = StringIO()
             while read < size:
-                data = imaplib.IMAP4.read (self, min(size-read,8192))
+                data = self.__class__.__bases__[1].read (self, min(size-read,8192))
                 read += len(data)
                 io.write(data)
             return io.getvalue()
         else:
-            return imaplib.IMAP4.read (self, size)
+            return self.__class__.__bases__[1].read (self, size)
 
-class UsefulIMAP4_SSL(UsefulIMAPMixIn, imaplibutil.WrappedIMAP4_SSL):
-    # This is the same hack as above, to be used in the case of an SSL
-    # connexion.
-    def read(self, size):
-        if (system() == 'Darwin') and (size>0) :
-            read = 0
-            io = StringIO()
-            while read < size:
-                data = imaplibutil.WrappedIMAP4_SSL.read (self, min(size-read,8192))
-                read += len(data)
-                io.write(data)
-            return io.getvalue()
-        else:
-            return imaplibutil.WrappedIMAP4_SSL.read (self,size)
+    def _mesg(self, s, secs=None):
+        imaplibutil.new_mesg(self, s, secs)
+
+class UsefulIMAP4(UsefulIMAPMixIn, imaplibutil.WrappedIMAP4): pass
+
+class UsefulIMAP4_SSL(UsefulIMAPMixIn, imaplibutil.WrappedIMAP4_SSL): pass
 
 class UsefulIMAP4_Tunnel(UsefulIMAPMixIn, imaplibutil.IMAP4_Tunnel): pass
 
@@ -101,7 +413,8 @@ class IMAPServer:
                  username = None, password = None, hostname = None,
                  port = None, ssl = 1, maxconnections = 1, tunnel = None,
                  reference = '""', sslclientcert = None, sslclientkey = None,
-                 sslcacertfile= None):
+                 sslcacertfile= None, qresync = False, compress = False,
+                 idletimeout = 0, checkinterval = 60):
         self.ui = getglobalui()
         self.reposname = reposname
         self.config = config
@@ -127,26 +440,46 @@ class IMAPServer:
         self.availableconnections = []
         self.assignedconnections = []
         self.lastowner = {}
+        self.lastused = {}
+        self.idletimeout = idletimeout
+        self.checkinterval = checkinterval
+        self.poolstats = {'hits': 0, 'misses': 0, 'opened': 0,
+                          'reconnects': 0, 'expired': 0}
         self.semaphore = BoundedSemaphore(self.maxconnections)
         self.connectionlock = Lock()
+        self.idleconnections = []
         self.reference = reference
+        # What CAPABILITY said before and after authentication on the
+        # first connection; later ones need not ask again.
+        self.greetingcapabilities = None
+        self.authcapabilities = None
+        # Connections may be opened by several threads at once.
+        self.passwordlock = Lock()
+        self.gsslock = Lock()
+        self.delimlock = Lock()
         self.gss_step = self.GSS_STATE_STEP
         self.gss_vc = None
         self.gssapi = False
+        self.qresync = qresync
+        self.compress = compress
 
     def getpassword(self):
-        if self.goodpassword != None:
-            return self.goodpassword
+        self.passwordlock.acquire()
+        try:
+            if self.goodpassword != None:
+                return self.goodpassword
 
-        if self.password != None and self.passworderror == None:
-            return self.password
+            if self.password != None and self.passworderror == None:
+                return self.password
 
-        self.password = self.ui.getpass(self.reposname,
-                                                     self.config,
-                                                     self.passworderror)
-        self.passworderror = None
+            self.password = self.ui.getpass(self.reposname,
+                                                         self.config,
+                                                         self.passworderror)
+            self.passworderror = None
 
-        return self.password
+            return self.password
+        finally:
+            self.passwordlock.release()
 
     def getdelim(self):
         """Returns this server's folder delimiter.  Can only be called
@@ -159,13 +492,25 @@ class IMAPServer:
         return self.root
 
 
-    def releaseconnection(self, connection):
-        """Releases a connection, returning it to the pool."""
+    def releaseconnection(self, connection, drop = 0):
+        """Releases a connection, returning it to the pool.  If drop is
+        true, the connection is known to be unusable and is discarded
+        instead."""
         self.connectionlock.acquire()
         self.assignedconnections.remove(connection)
-        self.availableconnections.append(connection)
+        if drop:
+            self.lastowner.pop(connection, None)
+            self.lastused.pop(connection, None)
+        else:
+            self.lastused[connection] = time.time()
+            self.availableconnections.append(connection)
         self.connectionlock.release()
         self.semaphore.release()
+        if drop:
+            try:
+                connection.shutdown()
+            except:
+                pass
 
     def md5handler(self, response):
         challenge = response.strip()
@@ -207,37 +552,124 @@ class IMAPServer:
             response = ''
         return base64.b64decode(response)
 
-    def acquireconnection(self):
+    def _expireconnections(self):
+        """Takes the connections that have not been used for idletimeout
+        seconds out of the pool, and returns them.  Must be called with
+        connectionlock held."""
+        if not self.idletimeout:
+            return []
+        limit = time.time() - self.idletimeout
+        expired = [imapobj for imapobj in self.availableconnections \
+                   if self.lastused.get(imapobj, 0) < limit]
+        for imapobj in expired:
+            self.availableconnections.remove(imapobj)
+            self.lastowner.pop(imapobj, None)
+            self.lastused.pop(imapobj, None)
+            self.poolstats['expired'] += 1
+        return expired
+
+    def _pickconnection(self, mailbox):
+        """Takes the best available connection out of the pool: one that
+        has mailbox selected already, else the one this thread used
+        last, else the oldest.  Returns None if there is none.  Must be
+        called with connectionlock held."""
+        if not len(self.availableconnections):
+            return None
+        threadid = thread.get_ident()
+        pick = None
+        # Start from the back since that's where they're popped on.
+        for i in range(len(self.availableconnections) - 1, -1, -1):
+            tryobj = self.availableconnections[i]
+            if mailbox != None and tryobj.getselectedfolder() == mailbox:
+                pick = i
+                break
+            if pick == None and self.lastowner[tryobj] == threadid:
+                pick = i
+        if pick == None:
+            pick = 0
+        return self.availableconnections.pop(pick)
+
+    def _checkconnection(self, imapobj):
+        """Makes sure that a connection which has been sitting in the
+        pool for a while still works.  A dead one is discarded, and
+        false returned."""
+        if not self.checkinterval or \
+           time.time() - self.lastused.get(imapobj, 0) < self.checkinterval:
+            return 1
+        try:
+            imapobj.noop()
+            return 1
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.ui.debug('imap', 'Discarding dead connection: %s' % \
+                          str(sys.exc_info()[1]))
+        self.connectionlock.acquire()
+        self.lastowner.pop(imapobj, None)
+        self.lastused.pop(imapobj, None)
+        self.poolstats['reconnects'] += 1
+        self.connectionlock.release()
+        try:
+            imapobj.shutdown()
+        except:
+            pass
+        return 0
+
+    def _assignconnection(self, imapobj, mailbox):
+        """Hands imapobj out to the current thread.  Must be called with
+        connectionlock held."""
+        if mailbox != None:
+            if imapobj.getselectedfolder() == mailbox:
+                self.poolstats['hits'] += 1
+            else:
+                self.poolstats['misses'] += 1
+        self.assignedconnections.append(imapobj)
+        self.lastowner[imapobj] = thread.get_ident()
+        self.lastused[imapobj] = time.time()
+
+    def getpoolstats(self):
+        """Returns a dictionary counting how often a connection that
+        already had the requested mailbox selected could be handed out
+        (hits) or not (misses), and how many connections were opened,
+        replaced after failing their health check (reconnects), or
+        closed for having been idle too long (expired)."""
+        self.connectionlock.acquire()
+        try:
+            return self.poolstats.copy()
+        finally:
+            self.connectionlock.release()
+
+    def acquireconnection(self, mailbox = None):
         """Fetches a connection from the pool, making sure to create a new one
         if needed, to obey the maximum connection limits, etc.
         Opens a connection to the server and returns an appropriate
-        object."""
+        object.
+
+        If mailbox is given, a connection that has it selected already
+        is preferred, so that the caller's select() is free."""
 
         self.semaphore.acquire()
         self.connectionlock.acquire()
-        imapobj = None
-
-        if len(self.availableconnections): # One is available.
-            # Try to find one that previously belonged to this thread
-            # as an optimization.  Start from the back since that's where
-            # they're popped on.
-            threadid = thread.get_ident()
-            imapobj = None
-            for i in range(len(self.availableconnections) - 1, -1, -1):
-                tryobj = self.availableconnections[i]
-                if self.lastowner[tryobj] == threadid:
-                    imapobj = tryobj
-                    del(self.availableconnections[i])
-                    break
-            if not imapobj:
-                imapobj = self.availableconnections[0]
-                del(self.availableconnections[0])
-            self.assignedconnections.append(imapobj)
-            self.lastowner[imapobj] = thread.get_ident()
+        expired = self._expireconnections()
+        self.connectionlock.release()
+        for imapobj in expired:
+            self.ui.debug('imap', 'Closing idle connection')
+            try:
+                imapobj.logout()
+            except:
+                pass
+
+        while 1:
+            self.connectionlock.acquire()
+            imapobj = self._pickconnection(mailbox)
             self.connectionlock.release()
-            return imapobj
-        
-        self.connectionlock.release()   # Release until need to modify data
+            if imapobj == None:
+                break
+            if self._checkconnection(imapobj):
+                self.connectionlock.acquire()
+                self._assignconnection(imapobj, mailbox)
+                self.connectionlock.release()
+                return imapobj
 
         """ Must be careful here that if we fail we should bail out gracefully
         and release locks / threads so that the next attempt can try...
@@ -248,18 +680,23 @@ class IMAPServer:
                 # Generate a new connection.
                 if self.tunnel:
                     self.ui.connecting('tunnel', self.tunnel)
-                    imapobj = UsefulIMAP4_Tunnel(self.tunnel)
+                    imapobj = UsefulIMAP4_Tunnel(self.tunnel,
+                                   capabilities = self.greetingcapabilities)
                     success = 1
                 elif self.usessl:
                     self.ui.connecting(self.hostname, self.port)
                     imapobj = UsefulIMAP4_SSL(self.hostname, self.port,
                                               self.sslclientkey, self.sslclientcert, 
-                                              cacertfile = self.sslcacertfile)
+                                              cacertfile = self.sslcacertfile,
+                                   capabilities = self.greetingcapabilities)
                 else:
                     self.ui.connecting(self.hostname, self.port)
-                    imapobj = UsefulIMAP4(self.hostname, self.port)
+                    imapobj = UsefulIMAP4(self.hostname, self.port,
+                                   capabilities = self.greetingcapabilities)
 
                 imapobj.mustquote = imaplibutil.mustquote
+                if self.greetingcapabilities == None:
+                    self.greetingcapabilities = ' '.join(imapobj.capabilities)
 
                 if not self.tunnel:
                     try:
@@ -267,16 +704,23 @@ class IMAPServer:
                         if 'AUTH=GSSAPI' in imapobj.capabilities and have_gss:
                             self.ui.debug('imap',
                                 'Attempting GSSAPI authentication')
+                            # gssauth() keeps its state in self.
+                            self.gsslock.acquire()
                             try:
-                                imapobj.authenticate('GSSAPI', self.gssauth)
-                            except imapobj.error, val:
-                                self.gssapi = False
-                                self.ui.debug('imap',
-                                    'GSSAPI Authentication failed')
-                            else:
-                                self.gssapi = True
-                                #if we do self.password = None then the next attempt cannot try...
-                                #self.password = None
+                                self.gss_step = self.GSS_STATE_STEP
+                                self.gss_vc = None
+                                try:
+                                    imapobj.authenticate('GSSAPI', self.gssauth)
+                                except imapobj.error, val:
+                                    self.gssapi = False
+                                    self.ui.debug('imap',
+                                        'GSSAPI Authentication failed')
+                                else:
+                                    self.gssapi = True
+                                    #if we do self.password = None then the next attempt cannot try...
+                                    #self.password = None
+                            finally:
+                                self.gsslock.release()
 
                         if not self.gssapi:
                             if 'AUTH=CRAM-MD5' in imapobj.capabilities:
@@ -295,21 +739,37 @@ class IMAPServer:
                         self.passworderror = str(val)
                         raise
                         #self.password = None
+                    imapobj.refreshcapabilities(self.authcapabilities)
+                    self.authcapabilities = ' '.join(imapobj.capabilities)
+
+            if self.compress and 'COMPRESS=DEFLATE' in imapobj.capabilities:
+                try:
+                    imapobj.compress()
+                except imapobj.error, val:
+                    self.ui.debug('imap', 'Could not enable COMPRESS: %s' % \
+                                  str(val))
+
+            imapobj.qresync = False
+            if self.qresync and 'QRESYNC' in imapobj.capabilities:
+                try:
+                    imapobj.enable('QRESYNC')
+                    imapobj.qresync = True
+                except imapobj.error, val:
+                    self.ui.debug('imap', 'Could not enable QRESYNC: %s' % \
+                                  str(val))
 
             if self.delim == None:
-                listres = imapobj.list(self.reference, '""')[1]
-                if listres == [None] or listres == None:
-                    # Some buggy IMAP servers do not respond well to LIST "" ""
-                    # Work around them.
-                    listres = imapobj.list(self.reference, '"*"')[1]
-                self.delim, self.root = \
-                            imaputil.imapsplit(listres[0])[1:]
-                self.delim = imaputil.dequote(self.delim)
-                self.root = imaputil.dequote(self.root)
+                self.delimlock.acquire()
+                try:
+                    # Another connection may have found out meanwhile.
+                    if self.delim == None:
+                        self.finddelim(imapobj)
+                finally:
+                    self.delimlock.release()
 
             self.connectionlock.acquire()
-            self.assignedconnections.append(imapobj)
-            self.lastowner[imapobj] = thread.get_ident()
+            self.poolstats['opened'] += 1
+            self._assignconnection(imapobj, mailbox)
             self.connectionlock.release()
             return imapobj
         except:
@@ -319,30 +779,74 @@ class IMAPServer:
 
             #Make sure that this can be retried the next time...
             self.passworderror = None
-            if(self.connectionlock.locked()):
-                self.connectionlock.release()
             raise
-    
-    def connectionwait(self):
-        """Waits until there is a connection available.  Note that between
-        the time that a connection becomes available and the time it is
-        requested, another thread may have grabbed it.  This function is
-        mainly present as a way to avoid spawning thousands of threads
-        to copy messages, then have them all wait for 3 available connections.
-        It's OK if we have maxconnections + 1 or 2 threads, which is what
-        this will help us do."""
-        threadutil.semaphorewait(self.semaphore)
 
+    def finddelim(self, imapobj):
+        """Asks the server for its folder delimiter and root."""
+        listres = imapobj.list(self.reference, '""')[1]
+        if listres == [None] or listres == None:
+            # Some buggy IMAP servers do not respond well to LIST "" ""
+            # Work around them.
+            listres = imapobj.list(self.reference, '"*"')[1]
+        delim, root = imaputil.imapsplit(listres[0])[1:]
+        self.root = imaputil.dequote(root)
+        self.delim = imaputil.dequote(delim)
+
+    def warmup(self, count):
+        """Opens up to count connections at once and leaves them in the
+        pool, so that the first folder threads do not each have to wait
+        for a connection to be set up in turn.  Failures are only raised
+        if not a single connection could be opened."""
+        self.connectionlock.acquire()
+        count = min(count, self.maxconnections) - \
+                len(self.availableconnections) - len(self.assignedconnections)
+        self.connectionlock.release()
+        if count <= 0:
+            return
+        self.ui.debug('imap', 'warmup: opening %d connections' % count)
+        results = []
+        def open():
+            try:
+                results.append(self.acquireconnection())
+            except:
+                results.append(sys.exc_info())
+        threads = []
+        for i in range(count):
+            thr = threadutil.ExitNotifyThread(target = open,
+                                              name = 'Connect %s' % \
+                                              self.reposname)
+            thr.setDaemon(1)
+            thr.start()
+            threads.append(thr)
+        for thr in threads:
+            thr.join()
+        errors = [r for r in results if type(r) == type(())]
+        for imapobj in results:
+            if type(imapobj) != type(()):
+                self.releaseconnection(imapobj)
+        if errors and len(errors) == len(results):
+            raise errors[0][0], errors[0][1], errors[0][2]
+        for error in errors:
+            self.ui.debug('imap', 'warmup: %s' % str(error[1]))
+    
     def close(self):
         # Make sure I own all the semaphores.  Let the threads finish
         # their stuff.  This is a blocking method.
         self.connectionlock.acquire()
         threadutil.semaphorereset(self.semaphore, self.maxconnections)
         for imapobj in self.assignedconnections + self.availableconnections:
+            stats = imapobj.compressionstats()
+            if stats:
+                self.ui.debug('imap', 'COMPRESS: %s' % stats)
             imapobj.logout()
+        self.ui.debug('imap', 'Connection pool: %(hits)d hits, '
+                      '%(misses)d misses, %(opened)d opened, '
+                      '%(reconnects)d reconnects, %(expired)d expired' % \
+                      self.poolstats)
         self.assignedconnections = []
         self.availableconnections = []
         self.lastowner = {}
+        self.lastused = {}
         # reset kerberos state
         self.gss_step = self.GSS_STATE_STEP
         self.gss_vc = None
@@ -396,6 +900,60 @@ class IMAPServer:
 
             self.ui.debug('imap', 'keepalive: bottom of loop')
 
+    def idle(self, foldername, event, callback, timeout = 29 * 60):
+        """Keeps a connection IDLE on foldername until the Event object
+        as passed is set, calling callback(foldername) whenever the server
+        reports a change to it.  Re-issues IDLE every timeout seconds, as
+        servers may drop idle clients after 30 minutes.  This method is
+        expected to be invoked in a separate thread; stopidle() ends it."""
+        self.ui.debug('imap', 'idle: thread started for %s' % foldername)
+        try:
+            imapobj = self.acquireconnection(foldername)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.ui.warn("Cannot idle on %s: %s" % \
+                         (foldername, sys.exc_info()[1]))
+            return
+        self.connectionlock.acquire()
+        self.idleconnections.append(imapobj)
+        self.connectionlock.release()
+        drop = 0
+        try:
+            try:
+                if not 'IDLE' in imapobj.capabilities:
+                    self.ui.debug('imap', 'idle: server does not support IDLE')
+                    return
+                while not event.isSet():
+                    imapobj.select(foldername, readonly = 1, force = 1)
+                    if imapobj.idle(timeout, event) and not event.isSet():
+                        self.ui.debug('imap', 'idle: %s changed' % foldername)
+                        callback(foldername)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                # The connection is in an unknown state; the next sync
+                # will open a fresh one.
+                drop = 1
+                self.ui.warn("Error while idling on %s: %s" % \
+                             (foldername, sys.exc_info()[1]))
+        finally:
+            self.connectionlock.acquire()
+            self.idleconnections.remove(imapobj)
+            self.connectionlock.release()
+            self.releaseconnection(imapobj, drop)
+            self.ui.debug('imap', 'idle: thread for %s exiting' % foldername)
+
+    def stopidle(self):
+        """Ends all running idle() calls.  The Event object passed to
+        them must have been set beforehand."""
+        self.connectionlock.acquire()
+        try:
+            for imapobj in self.idleconnections:
+                imapobj.idle_done()
+        finally:
+            self.connectionlock.release()
+
 class ConfigedIMAPServer(IMAPServer):
     """This class is designed for easier initialization given a ConfigParser
     object and an account name.  The passwordhash is used if
@@ -427,7 +985,11 @@ class ConfigedIMAPServer(IMAPServer):
             IMAPServer.__init__(self, self.config, self.repos.getname(),
                                 tunnel = usetunnel,
                                 reference = reference,
-                                maxconnections = self.repos.getmaxconnections())
+                                maxconnections = self.repos.getmaxconnections(),
+                                qresync = self.repos.getqresync(),
+                                compress = self.repos.getcompress(),
+                                idletimeout = self.repos.getconnectionidletimeout(),
+                                checkinterval = self.repos.getconnectioncheckinterval())
         else:
             if not password:
                 password = self.repos.getpassword()
@@ -437,4 +999,8 @@ class ConfigedIMAPServer(IMAPServer):
                                 reference = reference,
                                 sslclientcert = sslclientcert,
                                 sslclientkey = sslclientkey,
-                                sslcacertfile = sslcacertfile)
+                                sslcacertfile = sslcacertfile,
+                                qresync = self.repos.getqresync(),
+                                compress = self.repos.getcompress(),
+                                idletimeout = self.repos.getconnectionidletimeout(),
+                                checkinterval = self.repos.getconnectioncheckinterval())
@@ -16,11 +16,16 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
-import re, string, types
+import re, string, types, rfc822
+from StringIO import StringIO
 from offlineimap.ui import getglobalui
 quotere = re.compile('^("(?:[^"]|\\\\")*")')
 
 def debug(*args):
+    if not getglobalui().isdebugging('imap'):
+        # This is called for every message we look at; don't even
+        # format the message then.
+        return
     msg = []
     for arg in args:
         msg.append(str(arg))
@@ -162,6 +167,105 @@ def flagsimap2maildir(flagstring):
     retval.sort()
     return retval
 
+# Tokens of a FETCH response: parentheses, quoted strings, a literal
+# size at the end of the line, or atoms, which include section specs
+# such as BODY[HEADER.FIELDS (FROM)]<0>.
+fetchtokenre = re.compile(r'[()]|"(?:[^"\\]|\\.)*"|\{\d+\}$|'
+                          r'[^\s()"\[]+(?:\[[^\]]*\][^\s()"]*)?')
+fetchre = re.compile(r'\s*\d+\s+\((.*)\)\s*$', re.S)
+# The common case: items whose values are atoms, quoted strings or
+# lists of atoms, as in '1 (UID 3 FLAGS (\\Seen))'.
+fetchitemre = r'[^\s()"]+ (?:\([^()"]*\)|"(?:[^"\\]|\\.)*"|[^\s()"]+)'
+flatfetchre = re.compile(r'\s*\d+\s+\(((?:%s)?(?: %s)*) ?\)\s*$' % \
+                         (fetchitemre, fetchitemre))
+flatitemre = re.compile(r'([^\s()"]+) (?:\(([^()"]*)\)|("(?:[^"\\]|\\.)*"|'
+                        r'[^\s()"]+))')
+maildirflags = dict([(imapflag.lower(), maildirflag) \
+                     for imapflag, maildirflag in flagmap])
+
+# There are only so many combinations of flags in a folder.
+flagcache = {}
+
+def fetchflags(flaglist):
+    """Returns the maildir flags for flaglist, either the contents of
+    an IMAP flag list or the list of its flags."""
+    if type(flaglist) == types.ListType:
+        flaglist = ' '.join(flaglist)
+    flags = flagcache.get(flaglist)
+    if flags == None:
+        flags = []
+        for flag in flaglist.split():
+            flag = maildirflags.get(flag.lower())
+            if flag:
+                flags.append(flag)
+        flags.sort()
+        if len(flagcache) > 1000:
+            flagcache.clear()
+        flagcache[flaglist] = flags
+    # Callers may change their copy.
+    return flags[:]
+
+def fetchitems(response):
+    """Splits a FETCH response into a list alternating between item
+    names and values; parenthesized values become nested lists."""
+    m = fetchre.match(response)
+    if not m:
+        raise ValueError, "Not a FETCH response: '%s'" % response
+    stack = [[]]
+    for token in fetchtokenre.findall(m.group(1)):
+        if token == '(':
+            stack.append([])
+        elif token == ')':
+            if len(stack) > 1:
+                value = stack.pop()
+                stack[-1].append(value)
+        else:
+            stack[-1].append(token)
+    return stack[0]
+
+def parsefetch(responses):
+    """Parses a list of FETCH responses, as imaplib returns them, in one
+    pass.  A literal shows up there as a (text, literal) tuple, with the
+    rest of the response following as the next item; literals are
+    skipped.
+
+    Returns a list of (uid, flags, internaldate, size) tuples, one per
+    response.  uid and size (RFC822.SIZE) are longs, flags a sorted list
+    of maildir flags and internaldate the date string; each is None if
+    the response did not have it."""
+    retval = []
+    head = ''
+    for response in responses:
+        if type(response) == types.TupleType:
+            # The literal's value stands in as NIL.
+            head += response[0][:response[0].rindex('{')] + 'NIL '
+            continue
+        if response == None:
+            continue
+        response = head + response
+        head = ''
+        m = flatfetchre.match(response)
+        if m:
+            items = flatitemre.findall(m.group(1))
+        else:
+            items = fetchitems(response)
+            items = [(items[i], items[i + 1], items[i + 1]) \
+                     for i in range(0, len(items) - 1, 2)]
+        uid = flags = internaldate = size = None
+        for name, flaglist, value in items:
+            name = name.upper()
+            if name == 'UID':
+                uid = long(value)
+            elif name == 'FLAGS':
+                flags = fetchflags(flaglist)
+            elif name == 'INTERNALDATE':
+                internaldate = value[1:-1]
+            elif name == 'RFC822.SIZE':
+                size = long(value)
+        retval.append((uid, flags, internaldate, size))
+    debug("parsefetch() returning:", retval)
+    return retval
+
 def flagsmaildir2imap(maildirflaglist):
     retval = []
     for imapflag, maildirflag in flagmap:
@@ -205,3 +309,155 @@ def listjoin(list):
 
             
         
+
+def listsplit(string):
+    """Takes an IMAP sequence set, as generated by listjoin() or returned
+    by the server (eg in a VANISHED response), and returns the list of
+    numbers it contains.  '1:3,7' becomes [1, 2, 3, 7]."""
+    retval = []
+    for item in string.strip().split(','):
+        if not item:
+            continue
+        if ':' in item:
+            start, end = [long(x) for x in item.split(':')]
+            if start > end:
+                start, end = end, start
+            retval.extend(range(start, end + 1))
+        else:
+            retval.append(long(item))
+    return retval
+
+# The headers which identify a message well enough to notice that it
+# was moved between folders.
+keyheaders = ('Message-ID', 'Date', 'From', 'Subject')
+
+def readheaders(file):
+    """Reads the header block of a message from file, a file-like object
+    positioned at its start, and returns it."""
+    lines = []
+    while 1:
+        line = file.readline()
+        if not line or not line.strip():
+            break
+        lines.append(line)
+    return ''.join(lines)
+
+def messagekey(headers):
+    """Returns a string identifying the message with the given headers, as
+    read by readheaders() or fetched with BODY.PEEK[HEADER.FIELDS (...)]
+    of keyheaders.  Returns None if the message has neither a Message-ID
+    nor a Date, as it cannot be told apart from others then."""
+    message = rfc822.Message(StringIO(headers), 0)
+    values = []
+    for name in keyheaders:
+        value = message.getheader(name)
+        if value == None:
+            value = ''
+        values.append(' '.join(value.split()))
+    if not values[0] and not values[1]:
+        return None
+    return '\n'.join(values)
+
+barelfre = re.compile("(?<!\r)\n")
+
+class LineEndingFile:
+    """File-like object reading from file with all line endings turned
+    into newline: "\\n" as messages are stored locally, or "\\r\\n" as
+    IMAP wants them.  Only a chunk of the message is held in memory at
+    any time.  Supports read(), readline(), seek(0), getsize() and
+    close()."""
+    chunksize = 65536
+
+    def __init__(self, file, newline):
+        self.file = file
+        self.newline = newline
+        self.buf = ''
+        self.pending = ''
+        self.eof = 0
+
+    def _fill(self):
+        """Converts the next chunk of file and adds it to buf.  Returns
+        false at end of file."""
+        if self.eof:
+            return 0
+        data = self.file.read(self.chunksize)
+        if not data:
+            self.eof = 1
+            data = self.pending
+        else:
+            data = self.pending + data
+            self.pending = ''
+            if data[-1] == '\r':
+                # Could be the first half of a CRLF.
+                self.pending = '\r'
+                data = data[:-1]
+        if self.newline == "\n":
+            self.buf += data.replace("\r\n", "\n")
+        else:
+            self.buf += barelfre.sub("\r\n", data)
+        return 1
+
+    def read(self, size = -1):
+        if size < 0:
+            while self._fill():
+                pass
+            size = len(self.buf)
+        while len(self.buf) < size and self._fill():
+            pass
+        retval = self.buf[:size]
+        self.buf = self.buf[size:]
+        return retval
+
+    def readline(self):
+        while self.buf.find("\n") == -1 and self._fill():
+            pass
+        nlindex = self.buf.find("\n")
+        if nlindex == -1:
+            nlindex = len(self.buf) - 1
+        retval = self.buf[:nlindex + 1]
+        self.buf = self.buf[nlindex + 1:]
+        return retval
+
+    def seek(self, offset, whence = 0):
+        if offset != 0 or whence != 0:
+            raise IOError, "LineEndingFile can only be rewound"
+        self.file.seek(0)
+        self.buf = ''
+        self.pending = ''
+        self.eof = 0
+
+    def getsize(self):
+        """Returns the size of the file read from, before its line endings
+        are turned around, which is close enough to reckon with."""
+        pos = self.file.tell()
+        self.file.seek(0, 2)
+        size = self.file.tell()
+        self.file.seek(pos)
+        return size
+
+    def close(self):
+        self.file.close()
+
+class ConcatFile:
+    """File-like object reading the given files one after another.
+    len() returns length, which must be the total size, so that it can
+    be sent as an IMAP literal."""
+
+    def __init__(self, files, length):
+        self.files = files
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size = -1):
+        retval = ''
+        while self.files and (size < 0 or len(retval) < size):
+            if size < 0:
+                data = self.files[0].read()
+            else:
+                data = self.files[0].read(size - len(retval))
+            if not data:
+                del self.files[0]
+            retval += data
+        return retval
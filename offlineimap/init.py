@@ -146,6 +146,14 @@ class OfflineImap:
               "changes, and we have the message locally, it will be left "
               "untouched in a quick run.")
 
+        parser.add_option("--dry-run",
+                  action="store_true", dest="dryrun",
+                  default=False,
+                  help="Do not change anything, but show what a "
+              "synchronization would do for each folder, with an estimate "
+              "of the bytes it would transfer and of the round trips to "
+              "the servers it would take. Implies -o.")
+
         parser.add_option("-u", dest="interface",
                   help="Specifies an alternative user interface to "
               "use. This overrides the default specified in the "
@@ -224,6 +232,14 @@ class OfflineImap:
                 if type.lower() == 'thread':
                     threading._VERBOSE = 1
 
+        if options.dryrun:
+            options.runonce = True
+            config.set('general', 'dryrun', 'True')
+
+        if options.singlethreading:
+            # No writer threads for downloads either.
+            config.set('general', 'inflightbytes', '0')
+
         if options.runonce:
             # FIXME: maybe need a better
             for section in accounts.getaccountlist(config):
@@ -300,13 +316,14 @@ class OfflineImap:
                                          config.getdefaultint("general", "maxsyncaccounts", 1))
     
             for reposname in config.getsectionlist('Repository'):
-                for instancename in ["FOLDER_" + reposname,
-                                     "MSGCOPY_" + reposname]:
-                    if options.singlethreading:
-                        threadutil.initInstanceLimit(instancename, 1)
-                    else:
-                        threadutil.initInstanceLimit(instancename,
-                                                     config.getdefaultint('Repository ' + reposname, "maxconnections", 1))
+                workers = 1
+                if not options.singlethreading:
+                    workers = config.getdefaultint('Repository ' + reposname,
+                                                   "maxconnections", 1)
+                # All the folders are queued at once, so that they are
+                # synced in the order of their priority.
+                threadutil.initWorkerPool("FOLDER_" + reposname, workers, 0)
+                threadutil.initWorkerPool("MSGCOPY_" + reposname, workers)
             siglisteners = []
             def sig_handler(signum, frame):
                 if signum == signal.SIGUSR1:
@@ -0,0 +1,258 @@
+# Watching Maildir trees with the Linux inotify interface
+# Copyright (C) 2002-2007 John Goerzen <jgoerzen@complete.org>
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+import os, sys, errno, struct
+from threading import Lock
+from offlineimap.threadutil import ExitNotifyThread
+from offlineimap.ui import getglobalui
+
+try:
+    import ctypes, ctypes.util
+except ImportError:
+    ctypes = None
+
+# From <sys/inotify.h>
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+# Messages only ever get added, renamed (for their flags) and removed.
+watchmask = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+            IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+# struct inotify_event, without the name that follows it
+eventheader = struct.Struct('iIII')
+
+libc = None
+
+def getlibc():
+    """Returns the C library if it has the inotify calls, or None."""
+    global libc
+    if libc == None:
+        libc = False
+        if ctypes and sys.platform.startswith('linux'):
+            try:
+                lib = ctypes.CDLL(ctypes.util.find_library('c') or \
+                                  'libc.so.6', use_errno = True)
+                lib.inotify_init
+                lib.inotify_add_watch.argtypes = [ctypes.c_int,
+                                                  ctypes.c_char_p,
+                                                  ctypes.c_uint32]
+                libc = lib
+            except (OSError, AttributeError):
+                pass
+    return libc or None
+
+class MaildirWatcher:
+    """Watches the new/ and cur/ directories of all Maildir folders below
+    root, as well as the directories holding them so as to notice new
+    folders.  Folders are named as MaildirRepository does; subdirectories
+    of folders are only folders themselves if nested is true.
+
+    Keeps track of which folders saw no change since checkunchanged() was
+    last called for them, and calls the callback given to setcallback()
+    with the name of each folder that changes."""
+
+    def __init__(self, root, nested):
+        self.libc = getlibc()
+        if self.libc == None:
+            raise OSError, "inotify is not available on this system"
+        self.ui = getglobalui()
+        self.root = root
+        self.nested = nested
+        self.lock = Lock()
+        self.callback = None
+        self.watches = {}               # wd -> (path, foldername, dirannex)
+        self.folderwatches = {}         # foldername -> {dirannex: wd}
+        self.unchanged = {}
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, "inotify_init: " + os.strerror(err))
+        self.lock.acquire()
+        try:
+            self._addtree(root, '.')
+        finally:
+            self.lock.release()
+        self.ui.debug('maildir', 'watching %d directories below %s' % \
+                      (len(self.watches), root))
+        thread = ExitNotifyThread(target = self._watch,
+                                  name = "Maildir watch " + root)
+        thread.setDaemon(1)
+        thread.start()
+
+    def setcallback(self, callback):
+        """Sets the function to call with the name of each folder that
+        changes from now on; None to stop calling anything."""
+        self.lock.acquire()
+        self.callback = callback
+        self.lock.release()
+
+    def checkunchanged(self, foldername):
+        """Returns True if nothing happened in the new/ and cur/
+        directories of foldername since the last call, which starts the
+        tracking over.  Callers should look at the folder afterwards, not
+        before, so as not to miss changes in between."""
+        self.lock.acquire()
+        try:
+            unchanged = self.unchanged.has_key(foldername)
+            if len(self.folderwatches.get(foldername, {})) == 2:
+                self.unchanged[foldername] = 1
+            return unchanged
+        finally:
+            self.lock.release()
+
+    def markchanged(self, foldername):
+        """Have the next checkunchanged() for foldername return False,
+        e.g. because looking at it failed half-way."""
+        self.lock.acquire()
+        self.unchanged.pop(foldername, None)
+        self.lock.release()
+
+    def _addwatch(self, path, foldername, dirannex):
+        wd = self.libc.inotify_add_watch(self.fd, path, watchmask)
+        if wd < 0:
+            # Gone already, or out of watches: such a folder will simply
+            # never be considered unchanged.
+            self.ui.debug('maildir', 'cannot watch %s: %s' % \
+                          (path, os.strerror(ctypes.get_errno())))
+            return
+        self.watches[wd] = (path, foldername, dirannex)
+        if dirannex != None:
+            self.folderwatches.setdefault(foldername, {})[dirannex] = wd
+
+    def _addtree(self, path, foldername):
+        """Watches the directory path, holding the folder foldername if it
+        is a Maildir, and what is below it."""
+        self._addwatch(path, foldername, None)
+        try:
+            entries = os.listdir(path)
+        except OSError:
+            return
+        for dirannex in ['new', 'cur']:
+            if dirannex in entries:
+                self._addwatch(os.path.join(path, dirannex), foldername,
+                               dirannex)
+        if foldername != '.' and not self.nested:
+            return
+        for entry in entries:
+            fullname = os.path.join(path, entry)
+            if entry in ['cur', 'new', 'tmp'] or not os.path.isdir(fullname):
+                continue
+            self._addtree(fullname, self._subfoldername(foldername, entry))
+
+    def _subfoldername(self, foldername, name):
+        if foldername == '.':
+            return name
+        return os.path.join(foldername, name)
+
+    def _forgettree(self, foldername):
+        """Stops tracking foldername and the folders below it, after they
+        were moved away or deleted."""
+        prefix = os.path.join(foldername, '')
+        for name in self.folderwatches.keys():
+            if name == foldername or name.startswith(prefix):
+                del self.folderwatches[name]
+                self.unchanged.pop(name, None)
+
+    def _handleevents(self, data):
+        """Processes the inotify events in data, and returns the names
+        of the folders they changed."""
+        changed = []
+        pos = 0
+        while pos + eventheader.size <= len(data):
+            wd, mask, cookie, length = eventheader.unpack_from(data, pos)
+            pos += eventheader.size
+            name = data[pos:pos + length].rstrip('\0')
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost; anything may have changed.
+                self.unchanged = {}
+                changed.extend(self.folderwatches.keys())
+                continue
+            if not self.watches.has_key(wd):
+                continue
+            path, foldername, dirannex = self.watches[wd]
+            if dirannex != None:
+                # In new/ or cur/: the folder changed.
+                changed.append(foldername)
+                if mask & IN_IGNORED:
+                    del self.watches[wd]
+                    watches = self.folderwatches.get(foldername, {})
+                    if watches.get(dirannex) == wd:
+                        del watches[dirannex]
+                continue
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+            if not mask & IN_ISDIR:
+                continue
+            if name in ['new', 'cur']:
+                changed.append(foldername)
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._addwatch(os.path.join(path, name), foldername,
+                                   name)
+            elif name != 'tmp' and (foldername == '.' or self.nested):
+                subfoldername = self._subfoldername(foldername, name)
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._addtree(os.path.join(path, name), subfoldername)
+                else:
+                    self._forgettree(subfoldername)
+                changed.append(subfoldername)
+        for foldername in changed:
+            self.unchanged.pop(foldername, None)
+        return changed
+
+    def _watch(self):
+        try:
+            while 1:
+                try:
+                    data = os.read(self.fd, 65536)
+                except OSError, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                self.lock.acquire()
+                try:
+                    changed = self._handleevents(data)
+                    callback = self.callback
+                finally:
+                    self.lock.release()
+                if callback == None:
+                    continue
+                reported = {}
+                for foldername in changed:
+                    if not reported.has_key(foldername):
+                        reported[foldername] = 1
+                        callback(foldername)
+        except:
+            # Never trust our bookkeeping again, but do not take the
+            # whole program down either.
+            self.ui.warn("Stopped watching %s for changes: %s" % \
+                         (self.root, sys.exc_info()[1]))
+            self.lock.acquire()
+            self.folderwatches = {}
+            self.unchanged = {}
+            self.callback = None
+            self.lock.release()
+            os.close(self.fd)
@@ -0,0 +1,473 @@
+# Compact message lists
+# Copyright (C) 2002-2007 John Goerzen <jgoerzen@complete.org>
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+from array import array
+from bisect import bisect_left
+from threading import RLock
+import os.path
+
+# UIDs need 64 bits, for negative ones as well as the IMAP 32 bit range;
+# a double holds those exactly where a C long is too short.
+if array('l').itemsize >= 8:
+    uidtypecode = 'l'
+else:
+    uidtypecode = 'd'
+
+nan = float('nan')
+
+# Maildir flags are capital letters, which get a bit each; anything else
+# is kept aside.
+flagbits = {}
+for i in range(26):
+    flagbits[chr(ord('A') + i)] = 1L << i
+flagstrings = {}
+
+def flags2mask(flags):
+    """Returns (mask, others) for a list of flags: the bits of those
+    which are capital letters, and a string of the rest."""
+    mask = 0
+    others = ''
+    for flag in flags:
+        bit = flagbits.get(flag)
+        if bit == None:
+            others += flag
+        else:
+            mask |= bit
+    return (mask, others)
+
+def mask2flags(mask, others = ''):
+    """Returns the sorted list of flags for what flags2mask() said."""
+    flags = flagstrings.get(mask)
+    if flags == None:
+        flags = ''.join([flag for flag in sorted(flagbits.keys()) \
+                         if mask & flagbits[flag]])
+        flagstrings[mask] = flags
+    if others:
+        return sorted(flags + others)
+    return list(flags)
+
+class MessageTable:
+    """A message list: a hash from UIDs to hashes such as {'uid': 42,
+    'flags': ['S'], 'time': None, 'filename': '/path/to/message'} as
+    the folders keep them, but stored in parallel arrays sorted by UID,
+    with the flags as a bit mask and the directories of file names
+    shared, which takes a few dozen bytes a message instead of hundreds.
+
+    It can be used like such a hash, except that the message hashes it
+    hands out are views on the table: setting one of their keys changes
+    the table, but changing the list of flags one returns in place does
+    not, and 'uid' cannot be changed.  Keys come out in UID order."""
+
+    def __init__(self, messages = None):
+        # Copy threads save messages concurrently, and a row is spread
+        # over several arrays.
+        self.lock = RLock()
+        self.clear()
+        if messages != None:
+            self.update(messages)
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self._clear()
+        finally:
+            self.lock.release()
+
+    def _clear(self):
+        self.uids = array(uidtypecode)
+        self.masks = array('L')
+        self.times = array('d')
+        self.dirnums = array('i')       # into self.dirs, -1 for no file
+        self.names = []
+        self.dirs = []
+        self.dirindex = {}
+        self.otherflags = {}
+        # The rows up to sortedlen are sorted by UID; those appended out
+        # of order after them are found through tail, a hash from their
+        # UIDs to their rows, until _sort() merges them in.
+        self.sortedlen = 0
+        self.tail = {}
+        # Bumped whenever rows move, which invalidates views' indexes.
+        self.version = 0
+
+    def _sort(self):
+        """Merges the rows appended out of order into the sorted ones."""
+        if not len(self.tail):
+            return
+        uids = self.uids
+        # Two sorted runs, which sorted() merges in linear time.
+        order = sorted(range(self.sortedlen) + \
+                       sorted(self.tail.values(), key = uids.__getitem__),
+                       key = uids.__getitem__)
+        self.uids = array(uidtypecode, [uids[i] for i in order])
+        self.masks = array('L', [self.masks[i] for i in order])
+        self.times = array('d', [self.times[i] for i in order])
+        self.dirnums = array('i', [self.dirnums[i] for i in order])
+        self.names = [self.names[i] for i in order]
+        self.sortedlen = len(self.uids)
+        self.tail = {}
+        self.version += 1
+
+    def _index(self, uid):
+        """Returns the row of uid, or -1."""
+        self.lock.acquire()
+        try:
+            i = bisect_left(self.uids, uid, 0, self.sortedlen)
+            if i < self.sortedlen and self.uids[i] == uid:
+                return i
+            return self.tail.get(uid, -1)
+        finally:
+            self.lock.release()
+
+    def _setrow(self, i, uid, flags, time, filename):
+        mask, others = flags2mask(flags)
+        if others:
+            self.otherflags[uid] = others
+        elif self.otherflags.has_key(uid):
+            del self.otherflags[uid]
+        if time == None:
+            time = nan
+        dirnum = -1
+        name = None
+        if filename != None:
+            dirname, name = os.path.split(filename)
+            dirnum = self.dirindex.get(dirname)
+            if dirnum == None:
+                dirnum = len(self.dirs)
+                self.dirs.append(dirname)
+                self.dirindex[dirname] = dirnum
+        if i < 0:
+            if len(self.tail) or (len(self.uids) and uid < self.uids[-1]):
+                self.tail[uid] = len(self.uids)
+            else:
+                self.sortedlen += 1
+            self.uids.append(uid)
+            self.masks.append(mask)
+            self.times.append(time)
+            self.dirnums.append(dirnum)
+            self.names.append(name)
+            if len(self.tail) > max(1000, self.sortedlen / 4):
+                # A merge takes time linear in the size of the table;
+                # waiting for the tail to be a fair part of it keeps the
+                # cost per message constant.
+                self._sort()
+        else:
+            self.masks[i] = mask
+            self.times[i] = time
+            self.dirnums[i] = dirnum
+            self.names[i] = name
+
+    def _getfield(self, i, key):
+        if key == 'uid':
+            return long(self.uids[i])
+        if key == 'flags':
+            return mask2flags(self.masks[i],
+                              self.otherflags.get(self.uids[i], ''))
+        if key == 'time':
+            time = self.times[i]
+            if time != time:            # NaN
+                return None
+            return time
+        if key == 'filename' and self.names[i] != None:
+            return os.path.join(self.dirs[self.dirnums[i]], self.names[i])
+        raise KeyError, key
+
+    def _setfield(self, i, key, value):
+        uid = self.uids[i]
+        message = {'flags': self._getfield(i, 'flags'),
+                   'time': self._getfield(i, 'time'),
+                   'filename': self._getfilename(i)}
+        if key == 'uid':
+            if value != uid:
+                raise ValueError, "Cannot change the UID of a message"
+            return
+        if not message.has_key(key):
+            raise KeyError, key
+        message[key] = value
+        self._setrow(i, uid, message['flags'], message['time'],
+                     message['filename'])
+
+    def _getfilename(self, i):
+        if self.names[i] == None:
+            return None
+        return self._getfield(i, 'filename')
+
+    def _keys(self, i):
+        if self.names[i] == None:
+            return ['uid', 'flags', 'time']
+        return ['uid', 'flags', 'time', 'filename']
+
+    def __len__(self):
+        return len(self.uids)
+
+    def __contains__(self, uid):
+        return self._index(uid) >= 0
+
+    has_key = __contains__
+
+    def __getitem__(self, uid):
+        i = self._index(uid)
+        if i < 0:
+            raise KeyError, uid
+        return MessageView(self, uid, i)
+
+    def get(self, uid, default = None):
+        i = self._index(uid)
+        if i < 0:
+            return default
+        return MessageView(self, uid, i)
+
+    def __setitem__(self, uid, message):
+        filename = None
+        if message.has_key('filename'):
+            filename = message['filename']
+        flags = message['flags']
+        time = message.get('time')
+        self.lock.acquire()
+        try:
+            i = -1
+            if len(self.tail) or (len(self.uids) and uid <= self.uids[-1]):
+                i = self._index(uid)
+            self._setrow(i, uid, flags, time, filename)
+        finally:
+            self.lock.release()
+
+    def __delitem__(self, uid):
+        self.lock.acquire()
+        try:
+            # Rows after i move down, which would leave tail stale.
+            self._sort()
+            i = self._index(uid)
+            if i < 0:
+                raise KeyError, uid
+            del self.uids[i]
+            del self.masks[i]
+            del self.times[i]
+            del self.dirnums[i]
+            del self.names[i]
+            self.sortedlen -= 1
+            if self.otherflags.has_key(uid):
+                del self.otherflags[uid]
+            self.version += 1
+        finally:
+            self.lock.release()
+
+    def deletekeys(self, uidlist):
+        """Deletes all of uidlist at once, which is faster than one by
+        one."""
+        self.lock.acquire()
+        try:
+            self._sort()
+            drop = {}
+            for uid in uidlist:
+                drop[uid] = 1
+                if self.otherflags.has_key(uid):
+                    del self.otherflags[uid]
+            keep = [i for i in xrange(len(self.uids)) \
+                    if not drop.has_key(self.uids[i])]
+            self.uids = array(uidtypecode, [self.uids[i] for i in keep])
+            self.masks = array('L', [self.masks[i] for i in keep])
+            self.times = array('d', [self.times[i] for i in keep])
+            self.dirnums = array('i', [self.dirnums[i] for i in keep])
+            self.names = [self.names[i] for i in keep]
+            self.sortedlen = len(self.uids)
+            self.version += 1
+        finally:
+            self.lock.release()
+
+    def update(self, messages):
+        for uid, message in messages.items():
+            self[uid] = message
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def keys(self):
+        self.lock.acquire()
+        try:
+            self._sort()
+            return [long(uid) for uid in self.uids]
+        finally:
+            self.lock.release()
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def values(self):
+        self.lock.acquire()
+        try:
+            self._sort()
+            return [MessageView(self, self.uids[i], i) \
+                    for i in xrange(len(self.uids))]
+        finally:
+            self.lock.release()
+
+    def iteritems(self):
+        for message in self.itervalues():
+            yield (message.uid, message)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def copy(self):
+        return MessageTable(self)
+
+    def getarrays(self):
+        """Returns (uids, masks, otherflags): copies of the sorted UID
+        array, of the flag masks of the UIDs, and of the hash from UIDs
+        to their flags that are not in the masks."""
+        self.lock.acquire()
+        try:
+            self._sort()
+            return (self.uids[:], self.masks[:], self.otherflags.copy())
+        finally:
+            self.lock.release()
+
+    def __repr__(self):
+        return repr(dict([(uid, message.copy()) \
+                          for uid, message in self.iteritems()]))
+
+class MessageView:
+    """A message of a MessageTable, which looks like a hash."""
+
+    def __init__(self, table, uid, index):
+        self.table = table
+        self.uid = long(uid)
+        self.index = index
+        self.version = table.version
+
+    def _row(self):
+        if self.version != self.table.version:
+            self.index = self.table._index(self.uid)
+            self.version = self.table.version
+        if self.index < 0:
+            raise KeyError, self.uid
+        return self.index
+
+    def __getitem__(self, key):
+        self.table.lock.acquire()
+        try:
+            return self.table._getfield(self._row(), key)
+        finally:
+            self.table.lock.release()
+
+    def __setitem__(self, key, value):
+        self.table.lock.acquire()
+        try:
+            self.table._setfield(self._row(), key, value)
+        finally:
+            self.table.lock.release()
+
+    def get(self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        self.table.lock.acquire()
+        try:
+            return self.table._keys(self._row())
+        finally:
+            self.table.lock.release()
+
+    def has_key(self, key):
+        return key in self.keys()
+
+    __contains__ = has_key
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def copy(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, MessageView):
+            other = other.copy()
+        return self.copy() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self.copy())
+
+def diffmessagelists(srclist, destlist):
+    """Compares two message lists, in a single pass over their sorted UID
+    arrays.  Returns (copylist, deletelist, addflags, delflags) for
+    syncing srclist to destlist: the UIDs not below 0 only in srclist, those
+    only in destlist, and for the UIDs in both, hashes from each flag to
+    the UIDs it has to be added to, and removed from, in destlist.  All
+    UID lists are sorted, which lets imaputil.listjoin() turn them into
+    ranges.  Hashes are converted to a MessageTable first."""
+    if not isinstance(srclist, MessageTable):
+        srclist = MessageTable(srclist)
+    if not isinstance(destlist, MessageTable):
+        destlist = MessageTable(destlist)
+    srcuids, srcmasks, srcothers = srclist.getarrays()
+    destuids, destmasks, destothers = destlist.getarrays()
+    # Negative UIDs are never synced; they sort first.
+    srcstart = bisect_left(srcuids, 0)
+    deststart = bisect_left(destuids, 0)
+
+    if srcuids[srcstart:] == destuids[deststart:]:
+        # The usual case: no message came or went.
+        copylist = []
+        deletelist = []
+        if not len(srcothers) and not len(destothers) and \
+               srcmasks[srcstart:] == destmasks[deststart:]:
+            return (copylist, deletelist, {}, {})
+        srcrows = xrange(srcstart, len(srcuids))
+        destrows = xrange(deststart, len(destuids))
+    else:
+        srcset = set(srcuids[srcstart:])
+        destset = set(destuids[deststart:])
+        copylist = [long(uid) for uid in srcuids[srcstart:] \
+                    if not uid in destset]
+        deletelist = [long(uid) for uid in destuids[deststart:] \
+                      if not uid in srcset]
+        srcrows = [i for i in xrange(srcstart, len(srcuids)) \
+                   if srcuids[i] in destset]
+        destrows = [i for i in xrange(deststart, len(destuids)) \
+                    if destuids[i] in srcset]
+
+    addflags = {}
+    delflags = {}
+    for i, j in zip(srcrows, destrows):
+        srcmask = srcmasks[i]
+        destmask = destmasks[j]
+        uid = srcuids[i]
+        if srcmask != destmask:
+            uid = long(uid)
+            for flag in mask2flags(srcmask & ~destmask):
+                addflags.setdefault(flag, []).append(uid)
+            for flag in mask2flags(destmask & ~srcmask):
+                delflags.setdefault(flag, []).append(uid)
+        if srcothers.has_key(uid) or destothers.has_key(uid):
+            srcother = srcothers.get(uid, '')
+            destother = destothers.get(uid, '')
+            for flag in srcother:
+                if not flag in destother:
+                    addflags.setdefault(flag, []).append(long(uid))
+            for flag in destother:
+                if not flag in srcother:
+                    delflags.setdefault(flag, []).append(long(uid))
+    return (copylist, deletelist, addflags, delflags)
@@ -123,6 +123,11 @@ class BaseRepository(CustomConfig.ConfigHelperMixin):
     def getsep(self):
         raise NotImplementedError
 
+    def getservername(self):
+        """Returns a name for the server the repository is on, the same
+        for all repositories on that server, or None if it has none."""
+        return None
+
     def makefolder(self, foldername):
         raise NotImplementedError
 
@@ -189,3 +194,16 @@ class BaseRepository(CustomConfig.ConfigHelperMixin):
         for the threads to terminate."""
         pass
     
+
+    ##### Push notification
+
+    def startidle(self, callback):
+        """Watch the configured folders for changes, calling
+        callback(foldername) for each change.  The default implementation
+        will do nothing."""
+        pass
+
+    def stopidle(self):
+        """Stop watching folders, but don't bother waiting
+        for the threads to terminate."""
+        pass
@@ -20,6 +20,7 @@ from Base import BaseRepository
 from offlineimap import folder, imaputil, imapserver
 from offlineimap.folder.UIDMaps import MappedIMAPFolder
 from offlineimap.threadutil import ExitNotifyThread
+from offlineimap.ui import getglobalui
 import re, types, os, netrc, errno
 from threading import *
 
@@ -27,11 +28,22 @@ class IMAPRepository(BaseRepository):
     def __init__(self, reposname, account):
         """Initialize an IMAPRepository object."""
         BaseRepository.__init__(self, reposname, account)
+        self.ui = getglobalui()
+        self.modseqdir = os.path.join(os.path.dirname(self.uiddir), 'ModSeq')
+        if not os.path.exists(self.modseqdir):
+            os.mkdir(self.modseqdir, 0700)
+        self.quickstatusdir = os.path.join(os.path.dirname(self.uiddir),
+                                           'FolderStatus')
+        if not os.path.exists(self.quickstatusdir):
+            os.mkdir(self.quickstatusdir, 0700)
         self.imapserver = imapserver.ConfigedIMAPServer(self)
         self.folders = None
+        self.folderstatus = None
+        self.folderstatuslock = Lock()
         self.nametrans = lambda foldername: foldername
         self.folderfilter = lambda foldername: 1
         self.folderincludes = []
+        self.idlefolders = []
         self.foldersort = cmp
         localeval = self.localeval
         if self.config.has_option(self.getsection(), 'nametrans'):
@@ -46,6 +58,9 @@ class IMAPRepository(BaseRepository):
         if self.config.has_option(self.getsection(), 'foldersort'):
             self.foldersort = localeval.eval(self.getconf('foldersort'),
                                              {'re': re})
+        if self.config.has_option(self.getsection(), 'idlefolders'):
+            self.idlefolders = localeval.eval(self.getconf('idlefolders'),
+                                              {'re': re})
 
     def startkeepalive(self):
         keepalivetime = self.getkeepalive()
@@ -66,6 +81,27 @@ class IMAPRepository(BaseRepository):
         del self.kathread
         del self.kaevent
 
+    def startidle(self, callback):
+        if not self.idlefolders: return
+        self.idleevent = Event()
+        for foldername in self.idlefolders:
+            thread = ExitNotifyThread(target = self.imapserver.idle,
+                                      name = "Idle %s[%s]" % \
+                                      (self.getname(), foldername),
+                                      args = (foldername, self.idleevent,
+                                              callback))
+            thread.setDaemon(1)
+            thread.start()
+
+    def stopidle(self):
+        if not hasattr(self, 'idleevent'):
+            # Not idling.
+            return
+
+        self.idleevent.set()
+        self.imapserver.stopidle()
+        del self.idleevent
+
     def holdordropconnections(self):
         if not self.getholdconnectionopen():
             self.dropconnections()
@@ -95,6 +131,15 @@ class IMAPRepository(BaseRepository):
         if host != None:
             return host
 
+    def getservername(self):
+        if self.getpreauthtunnel():
+            return None
+        host = self.gethost()
+        port = self.getport()
+        if port == None:
+            port = (143, 993)[bool(self.getssl())]
+        return "%s:%d" % (host.lower(), port)
+
     def getuser(self):
         user = None
         localeval = self.localeval
@@ -154,6 +199,30 @@ class IMAPRepository(BaseRepository):
     def getexpunge(self):
         return self.getconfboolean('expunge', 1)
 
+    def getfetchbatchsize(self):
+        return self.getconfint('fetchbatchsize', 1048576)
+
+    def getappendbatchsize(self):
+        return self.getconfint('appendbatchsize', 1048576)
+
+    def getqresync(self):
+        return self.getconfboolean('qresync', 1)
+
+    def getcompress(self):
+        return self.getconfboolean('compress', 0)
+
+    def getconnectionidletimeout(self):
+        return self.getconfint('connectionidletimeout', 0)
+
+    def getconnectioncheckinterval(self):
+        return self.getconfint('connectioncheckinterval', 60)
+
+    def getmodseqdir(self):
+        return self.modseqdir
+
+    def getquickstatusdir(self):
+        return self.quickstatusdir
+
     def getpassword(self):
         """Return the IMAP password for this repository.
 
@@ -218,11 +287,58 @@ class IMAPRepository(BaseRepository):
         return folder.IMAP.IMAPFolder
 
     def connect(self):
-        imapobj = self.imapserver.acquireconnection()
-        self.imapserver.releaseconnection(imapobj)
+        """Opens all the connections we may use at once, rather than
+        having the folder threads open them one after the other."""
+        self.imapserver.warmup(self.getmaxconnections())
 
     def forgetfolders(self):
         self.folders = None
+        self.folderstatus = None
+
+    def getfolderstatus(self, foldername):
+        """Returns the current MESSAGES, UIDNEXT, UIDVALIDITY and, if
+        supported, HIGHESTMODSEQ of the remote folder with the full name
+        foldername as a
+        dictionary, or None if the server did not tell.
+
+        The first call asks the server about all folders at once: with
+        a single LIST-STATUS command if the server supports it, and with
+        pipelined STATUS commands otherwise.  This is much cheaper than
+        selecting each folder in turn."""
+        self.folderstatuslock.acquire()
+        try:
+            if self.folderstatus == None:
+                self.folderstatus = self._fetchfolderstatus()
+        finally:
+            self.folderstatuslock.release()
+        return self.folderstatus.get(foldername)
+
+    def _fetchfolderstatus(self):
+        foldernames = [folder.getfullname() for folder in self.getfolders()]
+        result = {}
+        imapobj = self.imapserver.acquireconnection()
+        try:
+            items = 'MESSAGES UIDNEXT UIDVALIDITY'
+            if 'CONDSTORE' in imapobj.capabilities or \
+                   'QRESYNC' in imapobj.capabilities:
+                items += ' HIGHESTMODSEQ'
+            items = '(%s)' % items
+            if 'LIST-STATUS' in imapobj.capabilities:
+                try:
+                    result = imapobj.liststatus(self.imapserver.reference,
+                                                '*', items)
+                except imapobj.abort:
+                    raise
+                except imapobj.error, e:
+                    self.ui.debug('imap', 'LIST-STATUS failed: %s' % e)
+            # folderincludes may lie outside of what LIST returned.
+            missing = [name for name in foldernames \
+                       if not result.has_key(name)]
+            if missing:
+                result.update(imapobj.multistatus(missing, items))
+        finally:
+            self.imapserver.releaseconnection(imapobj)
+        return result
 
     def getfolders(self):
         if self.folders != None:
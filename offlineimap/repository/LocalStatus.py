@@ -18,26 +18,54 @@
 
 from Base import BaseRepository
 from offlineimap import folder
-import offlineimap.folder.LocalStatus
+import offlineimap.folder.LocalStatus, offlineimap.folder.LocalStatusSQLite
 import os, re
 
 class LocalStatusRepository(BaseRepository):
     def __init__(self, reposname, account):
         BaseRepository.__init__(self, reposname, account)
-        self.directory = os.path.join(account.getaccountmeta(), 'LocalStatus')
-        if not os.path.exists(self.directory):
-            os.mkdir(self.directory, 0700)
+        self.plaindirectory = os.path.join(account.getaccountmeta(),
+                                           'LocalStatus')
+        if not os.path.exists(self.plaindirectory):
+            os.mkdir(self.plaindirectory, 0700)
+        self.backend = account.getconf('status_backend', 'plain')
+        if self.backend == 'plain':
+            self.directory = self.plaindirectory
+            self.folderclass = folder.LocalStatus.LocalStatusFolder
+        elif self.backend == 'sqlite':
+            self.directory = os.path.join(account.getaccountmeta(),
+                                          'LocalStatus-sqlite')
+            if not os.path.exists(self.directory):
+                os.mkdir(self.directory, 0700)
+            self.folderclass = folder.LocalStatusSQLite.LocalStatusSQLiteFolder
+        else:
+            raise ValueError, "Unknown status_backend %s for account %s" % \
+                  (self.backend, account.getname())
         self.folders = None
 
     def getsep(self):
         return '.'
 
-    def getfolderfilename(self, foldername):
+    def _getfilename(self, directory, foldername):
         foldername = re.sub('/\.$', '/dot', foldername)
         foldername = re.sub('^\.$', 'dot', foldername)
-        return os.path.join(self.directory, foldername)
+        return os.path.join(directory, foldername)
+
+    def getfolderfilename(self, foldername):
+        return self._getfilename(self.directory, foldername)
+
+    def getplainfolderfilename(self, foldername):
+        """Where the plain text status of foldername is, or was before
+        it was converted to another status_backend."""
+        return self._getfilename(self.plaindirectory, foldername)
 
     def makefolder(self, foldername):
+        if self.backend != 'plain':
+            # Create it empty.
+            self.getfolder(foldername).savedata([])
+            self.folders = None
+            return
+
         # "touch" the file, truncating it.
         filename = self.getfolderfilename(foldername)
         file = open(filename + ".tmp", "wt")
@@ -52,16 +80,16 @@ class LocalStatusRepository(BaseRepository):
 
     def getfolders(self):
         retval = []
-        for folder in os.listdir(self.directory):
-            retval.append(folder.LocalStatus.LocalStatusFolder(self.directory,
-                                                               folder, self, self.accountname, 
-                                                               self.config))
+        for foldername in os.listdir(self.directory):
+            if foldername.endswith("-wal") or foldername.endswith("-shm") \
+                   or foldername.endswith(".tmp"):
+                continue
+            retval.append(self.getfolder(foldername))
         return retval
 
     def getfolder(self, foldername):
-        return folder.LocalStatus.LocalStatusFolder(self.directory, foldername,
-                                                    self, self.accountname,
-                                                    self.config)
+        return self.folderclass(self.directory, foldername, self,
+                                self.accountname, self.config)
 
 
     
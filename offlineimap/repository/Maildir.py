@@ -17,7 +17,7 @@
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
 from Base import BaseRepository
-from offlineimap import folder, imaputil
+from offlineimap import folder, imaputil, inotify
 from offlineimap.ui import getglobalui
 from mailbox import Maildir
 import os
@@ -31,6 +31,11 @@ class MaildirRepository(BaseRepository):
 
         self.root = self.getlocalroot()
         self.folders = None
+        self.watcher = None
+        self.scanindexdir = os.path.join(os.path.dirname(self.uiddir),
+                                         'MaildirIndex')
+        if not os.path.exists(self.scanindexdir):
+            os.mkdir(self.scanindexdir, 0700)
         self.ui = getglobalui()
         self.debug("MaildirRepository initialized, sep is " + repr(self.getsep()))
 	self.folder_atimes = []
@@ -59,6 +64,26 @@ class MaildirRepository(BaseRepository):
     def getlocalroot(self):
         return os.path.expanduser(self.getconf('localfolders'))
 
+    def getscanindexdir(self):
+        return self.scanindexdir
+
+    def getscanindex(self):
+        return self.getconfboolean('scanindex', 1)
+
+    def getinotify(self):
+        return self.getconfboolean('inotify', 1)
+
+    def checkunchanged(self, foldername):
+        """Returns True if the folder named foldername is known not to
+        have changed since this was last called for it."""
+        if not self.watcher:
+            return False
+        return self.watcher.checkunchanged(foldername)
+
+    def markchanged(self, foldername):
+        if self.watcher:
+            self.watcher.markchanged(foldername)
+
     def debug(self, msg):
         self.ui.debug('maildir', msg)
 
@@ -109,6 +134,26 @@ class MaildirRepository(BaseRepository):
     def deletefolder(self, foldername):
         self.ui.warn("NOT YET IMPLEMENTED: DELETE FOLDER %s" % foldername)
 
+    def startidle(self, callback):
+        """Watches the local folders with inotify, where available, and
+        calls callback(foldername) for each one that changes.  The watch
+        itself is kept up between syncs, so that checkunchanged() can
+        tell which folders need not be looked at."""
+        if self.watcher == None:
+            self.watcher = False
+            if self.getinotify():
+                try:
+                    self.watcher = inotify.MaildirWatcher(self.root,
+                                                          self.getsep() == '/')
+                except OSError, e:
+                    self.debug("not watching %s: %s" % (self.root, e))
+        if self.watcher:
+            self.watcher.setcallback(callback)
+
+    def stopidle(self):
+        if self.watcher:
+            self.watcher.setcallback(None)
+
     def getfolder(self, foldername):
 	if self.config.has_option('Repository ' + self.name, 'restoreatime') and self.config.getboolean('Repository ' + self.name, 'restoreatime'):
 	    self._append_folder_atimes(foldername)
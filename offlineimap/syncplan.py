@@ -0,0 +1,222 @@
+# Planning folder syncs
+# Copyright (C) 2002-2007 John Goerzen <jgoerzen@complete.org>
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+import sys
+from offlineimap.messagetable import MessageTable, diffmessagelists
+
+class SyncPlan:
+    """What syncing the messages of the folder src to the folder dest
+    does, worked out from their message lists before any of it is done:
+    the messages with a negative UID to upload (pass 1), those to copy
+    (pass 2) and to delete (pass 3), and the flags to change (pass 4).
+    applyto is what BaseFolder.syncmessagesto() takes.
+
+    srclist and destlist default to the current message lists of src and
+    dest.  A plan made with deletesonly only deletes, as
+    syncmessagesto_delete() on its own does."""
+
+    def __init__(self, src, dest, applyto = None, srclist = None,
+                 destlist = None, deletesonly = 0):
+        if applyto == None:
+            applyto = [dest]
+        if srclist == None:
+            srclist = src.getmessagelist()
+        if destlist == None:
+            destlist = dest.getmessagelist()
+        self.src = src
+        self.dest = dest
+        self.applyto = applyto
+        self.deletesonly = deletesonly
+        self.copylist, self.deletelist, self.addflags, self.delflags = \
+                       diffmessagelists(srclist, destlist)
+        self.newlist = []
+        if deletesonly:
+            self.copylist = []
+            self.addflags = {}
+            self.delflags = {}
+        else:
+            self.newlist = [uid for uid in srclist.keys() if uid < 0]
+            self.newlist.sort()
+        self.sizes = None
+
+    def getdiff(self):
+        """Returns the plan as messagetable.diffmessagelists() does."""
+        return (self.copylist, self.deletelist, self.addflags, self.delflags)
+
+    def isempty(self):
+        return not (len(self.newlist) or len(self.copylist) or \
+                    len(self.deletelist) or len(self.addflags) or \
+                    len(self.delflags))
+
+    def storesmessages(self):
+        """Returns true if the plan copies message bodies, rather than
+        just UIDs and flags."""
+        for folder in self.applyto:
+            if folder.storesmessages():
+                return 1
+        return 0
+
+    def getsizes(self):
+        """Returns a hash from the UIDs of the messages whose bodies the
+        plan copies or uploads to their sizes, as far as src knows
+        them."""
+        if self.sizes == None:
+            self.sizes = {}
+            uidlist = self.newlist + self.copylist
+            if len(uidlist) and self.storesmessages():
+                self.sizes = self.src.getmessagesizes(uidlist)
+        return self.sizes
+
+    def getbytes(self):
+        """Returns how many bytes of message bodies the plan copies, not
+        counting messages of unknown size."""
+        return sum(self.getsizes().values())
+
+    def getroundtrips(self):
+        """Estimates how many server round trips carrying out the plan
+        takes, as the folders' estimateroundtrips() do."""
+        trips = 0
+        if len(self.copylist) and self.storesmessages():
+            batches = self.src.getcopybatches(self.copylist)
+            trips += self.src.estimateroundtrips(fetches = len(batches))
+        uploads = len(self.copylist)
+        if self.storesmessages():
+            uploads += len(self.newlist)
+        for folder in self.applyto:
+            trips += folder.estimateroundtrips(uploads = uploads,
+                     deletes = len(self.deletelist),
+                     flagchanges = len(self.addflags) + len(self.delflags))
+        return trips
+
+    def executechanges(self):
+        """Carries out the deletes and flag changes of the plan, which
+        take a few bulk commands, unlike the copies."""
+        src = self.src
+        try:
+            src.syncmessagesto_delete(self.dest, self.applyto,
+                                      self.getdiff())
+        except (KeyboardInterrupt):
+            raise
+        except:
+            src.ui.warn("ERROR attempting to delete messages " \
+                + "for account " + src.getaccountname() + ":" + str(sys.exc_info()[1]))
+        if self.deletesonly:
+            return
+
+        try:
+            src.syncmessagesto_flags(self.dest, self.applyto, self.getdiff())
+        except (KeyboardInterrupt):
+            raise
+        except:
+            src.ui.warn("ERROR attempting to sync flags " \
+                + "for account " + src.getaccountname() + ":" + str(sys.exc_info()[1]))
+
+    def executecopies(self):
+        """Carries out the uploads and copies of the plan."""
+        src = self.src
+        if self.deletesonly:
+            return
+        try:
+            src.syncmessagesto_neguid(self.dest, self.applyto)
+        except (KeyboardInterrupt):
+            raise
+        except:
+            src.ui.warn("ERROR attempting to handle negative uids " \
+                + "for account " + src.getaccountname() + ":" + str(sys.exc_info()[1]))
+
+        #all threads launched here are in try / except clauses when they copy anyway...
+        src.syncmessagesto_copy(self.dest, self.applyto, self.getdiff())
+
+    def execute(self):
+        self.executechanges()
+        self.executecopies()
+
+def _applyflags(messagelist, plan):
+    """Changes the flags in messagelist as plan does."""
+    for flags, add in [(plan.addflags, 1), (plan.delflags, 0)]:
+        for flag, uidlist in flags.items():
+            for uid in uidlist:
+                if not messagelist.has_key(uid):
+                    continue
+                msgflags = messagelist[uid]['flags']
+                if add and not flag in msgflags:
+                    msgflags.append(flag)
+                elif not add and flag in msgflags:
+                    msgflags.remove(flag)
+                messagelist[uid]['flags'] = msgflags
+
+def _applycopies(messagelist, srclist, plan):
+    """Adds the messages plan copies from srclist to messagelist."""
+    for uid in plan.copylist:
+        messagelist[uid] = srclist[uid]
+
+def planfolder(remotefolder, localfolder, statusfolder, locallist = None,
+               statuslist = None, statusisnew = None):
+    """Plans the sync of a folder as accounts.syncfolder() carries it out,
+    and returns the SyncPlans of its steps, in order.  Each step is
+    planned with the message lists the steps before it leave behind if
+    they go through, starting from the current ones, or from locallist
+    and statuslist for localfolder and statusfolder if given.
+    statusisnew defaults to whether statusfolder is new."""
+    if locallist == None:
+        locallist = localfolder.getmessagelist()
+    if statuslist == None:
+        statuslist = statusfolder.getmessagelist()
+    if statusisnew == None:
+        statusisnew = statusfolder.isnewfolder()
+    remote = MessageTable(remotefolder.getmessagelist())
+    local = MessageTable(locallist)
+    status = MessageTable(statuslist)
+    plans = []
+
+    if not statusisnew:
+        # Messages deleted on the server go first, so that local flag
+        # changes to them are not pushed.
+        plan = SyncPlan(remotefolder, localfolder,
+                        [localfolder, statusfolder], remote, local,
+                        deletesonly = 1)
+        plans.append(plan)
+        local.deletekeys(plan.deletelist)
+        status.deletekeys(plan.deletelist)
+
+        # Local changes
+        plan = SyncPlan(localfolder, statusfolder,
+                        [remotefolder, statusfolder], local, status)
+        plans.append(plan)
+        remote.deletekeys(plan.deletelist)
+        status.deletekeys(plan.deletelist)
+        _applyflags(remote, plan)
+        _applyflags(status, plan)
+        # Uploads end up under the same new UID on all sides, which
+        # leaves nothing to do for them in the following steps.
+        local.deletekeys(plan.newlist + plan.copylist)
+        status.deletekeys(plan.copylist)
+
+    # Remote changes
+    plan = SyncPlan(remotefolder, localfolder, [localfolder, statusfolder],
+                    remote, local)
+    plans.append(plan)
+    _applycopies(local, remote, plan)
+    _applycopies(status, remote, plan)
+    local.deletekeys(plan.deletelist)
+    status.deletekeys(plan.deletelist)
+    _applyflags(local, plan)
+    _applyflags(status, plan)
+
+    # Whatever the status folder still misses
+    plans.append(SyncPlan(localfolder, statusfolder, None, local, status))
+    return plans
@@ -19,6 +19,7 @@
 from threading import *
 from StringIO import StringIO
 from Queue import Queue, Empty
+from heapq import heappush, heappop
 import sys, traceback, thread, time
 from offlineimap.ui import getglobalui
 
@@ -247,7 +248,209 @@ class InstanceLimitedThread(ExitNotifyThread):
             if instancelimitedsems and instancelimitedsems[self.instancename]:
                 instancelimitedsems[self.instancename].release()
         
-    
+
+######################################################################
+# Worker pools
+######################################################################
+
+class PoolTask:
+    """A call submitted to a WorkerPool.  wait() returns once it has
+    been made; getResult() then returns what it returned, and
+    getRunTime() how many seconds it took.  If it raised an exception,
+    that was reported to the UI, and getExitCause() and friends tell
+    about it as they do for an ExitNotifyThread."""
+    def __init__(self, name, accountname, target, args, kwargs):
+        self.name = name
+        self.accountname = accountname
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.runtime = None
+        self.exitcause = None
+        self.exitexception = None
+        self.exitstacktrace = None
+        self.done = Event()
+
+    def getName(self):
+        return self.name
+
+    def run(self):
+        start = time.time()
+        try:
+            try:
+                self.result = apply(self.target, self.args, self.kwargs)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                self.exitcause = 'EXCEPTION'
+                self.exitexception = sys.exc_info()[1]
+                sbuf = StringIO()
+                traceback.print_exc(file = sbuf)
+                self.exitstacktrace = sbuf.getvalue()
+                getglobalui().taskException(self)
+            else:
+                self.exitcause = 'NORMAL'
+        finally:
+            self.runtime = time.time() - start
+            self.done.set()
+
+    def wait(self):
+        self.done.wait()
+
+    def getResult(self):
+        return self.result
+
+    def getRunTime(self):
+        return self.runtime
+
+    def getExitCause(self):
+        return self.exitcause
+    def getExitException(self):
+        return self.exitexception
+    def getExitStackTrace(self):
+        return self.exitstacktrace
+
+class WorkerPool:
+    """Up to workers threads making the calls submitted to the pool,
+    those of the lowest priority first, and in the order they were
+    submitted among equals.  At most maxqueued calls wait for a thread,
+    or any number if maxqueued is 0; submit() blocks while that many do,
+    which keeps whoever submits from running far ahead of the workers.
+
+    Pools put into the same group by joinWorkerPoolGroup() lend each
+    other their idle threads: a thread with nothing left to do in its own
+    pool takes the most urgent call waiting in another pool of its group.
+
+    Threads are started as calls come in and end after they have been
+    idle for a while, so a pool costs nothing between syncs."""
+    idletime = 2.0
+
+    def __init__(self, name, workers, maxqueued = None):
+        if maxqueued == None:
+            maxqueued = workers
+        self.name = name
+        self.workers = workers
+        self.maxqueued = maxqueued
+        self.tasks = []                 # heap of (priority, seq, task)
+        self.seq = 0
+        self.running = 0
+        self.group = [self]
+
+    def submit(self, target, args = (), kwargs = {}, name = None,
+               accountname = None, priority = 0):
+        """Has target called with args and kwargs by one of the pool's
+        threads, which the UI is told is working for accountname.
+        Returns the PoolTask."""
+        if name == None:
+            name = self.name
+        task = PoolTask(name, accountname, target, args, kwargs)
+        workerpoolscond.acquire()
+        try:
+            while self.maxqueued > 0 and len(self.tasks) >= self.maxqueued:
+                workerpoolscond.wait()
+            heappush(self.tasks, (priority, self.seq, task))
+            self.seq += 1
+            workerpoolscond.notifyAll()
+            # A thread of our own if we may start one, else one of
+            # another pool of the group.
+            for pool in [self] + self.group:
+                if pool.running < pool.workers:
+                    pool.running += 1
+                    thread = ExitNotifyThread(target = pool._work,
+                                              name = "%s worker" % pool.name)
+                    thread.setDaemon(1)
+                    thread.start()
+                    break
+        finally:
+            workerpoolscond.release()
+        return task
+
+    def _take(self):
+        """Takes the next task of the pool, or else the most urgent one
+        of the other pools of its group.  Returns None if there is none.
+        Called with workerpoolscond held."""
+        pool = None
+        if len(self.tasks):
+            pool = self
+        else:
+            for other in self.group:
+                if len(other.tasks) and (pool == None or \
+                                         other.tasks[0][0] < pool.tasks[0][0]):
+                    pool = other
+        if pool == None:
+            return None
+        # There is room for another one now.
+        workerpoolscond.notifyAll()
+        return heappop(pool.tasks)[2]
+
+    def _work(self):
+        ui = getglobalui()
+        try:
+            while 1:
+                workerpoolscond.acquire()
+                try:
+                    deadline = time.time() + self.idletime
+                    task = self._take()
+                    while task == None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            return
+                        workerpoolscond.wait(remaining)
+                        task = self._take()
+                finally:
+                    workerpoolscond.release()
+                if task.accountname != None and \
+                       ui.getthreadaccount() != task.accountname:
+                    if ui.getthreadaccount() != '*Control':
+                        ui.threadExited(currentThread())
+                    ui.registerthread(task.accountname)
+                task.run()
+        finally:
+            # Also when a KeyboardInterrupt or SystemExit from a task
+            # ends the thread, so that submit() starts another one.
+            workerpoolscond.acquire()
+            try:
+                self.running -= 1
+            finally:
+                workerpoolscond.release()
+
+# All pools share one condition: they are few and their tasks are big,
+# and it lets idle threads notice work in other pools of their group.
+workerpoolscond = Condition(Lock())
+workerpools = {}
+workerpoolgroups = {}
+
+def initWorkerPool(poolname, workers, maxqueued = None):
+    """Initialize the worker pool poolname, with up to workers threads
+    and at most maxqueued waiting calls, as WorkerPool takes them."""
+    workerpoolscond.acquire()
+    if not workerpools.has_key(poolname):
+        workerpools[poolname] = WorkerPool(poolname, workers, maxqueued)
+    workerpoolscond.release()
+
+def getWorkerPool(poolname):
+    """Returns the worker pool poolname, which gets a single thread if
+    initWorkerPool() was not called for it."""
+    initWorkerPool(poolname, 1)
+    return workerpools[poolname]
+
+def joinWorkerPoolGroup(groupname, poolname):
+    """Puts the worker pool poolname into the group groupname, leaving
+    the group it was in before."""
+    pool = getWorkerPool(poolname)
+    workerpoolscond.acquire()
+    try:
+        group = workerpoolgroups.setdefault(groupname, [])
+        if pool.group is not group:
+            pool.group.remove(pool)
+            group.append(pool)
+            pool.group = group
+            # Idle threads of the group may take what is waiting here.
+            workerpoolscond.notifyAll()
+    finally:
+        workerpoolscond.release()
+
 ######################################################################
 # Multi-lock -- capable of handling a single thread requesting a lock
 # multiple times
@@ -59,6 +59,10 @@ class BlinkenBase:
         s.gettf().setcolor('orange')
         s.__class__.__bases__[-1].copyingmessage(s, uid, src, destlist)
 
+    def movingmessages(s, uidlist, src, dest):
+        s.gettf().setcolor('orange')
+        s.__class__.__bases__[-1].movingmessages(s, uidlist, src, dest)
+
     def deletingmessages(s, uidlist, destlist):
         s.gettf().setcolor('red')
         s.__class__.__bases__[-1].deletingmessages(s, uidlist, destlist)
@@ -124,6 +124,10 @@ class MachineUI(UIBase):
         ds = s.folderlist(destlist)
         s._printData('deletingmessages', "%s\n%s" % (s.uidlist(uidlist), ds))
 
+    def movingmessages(s, uidlist, src, dest):
+        s._printData('movingmessages', "%s\n%s" % (s.uidlist(uidlist),
+                                                   s.folderlist([src, dest])))
+
     def addingflags(s, uidlist, flags, destlist):
         ds = s.folderlist(destlist)
         s._printData("addingflags", "%s\n%s\n%s" % (s.uidlist(uidlist),
@@ -136,6 +140,32 @@ class MachineUI(UIBase):
                                                       "\f".join(flags),
                                                       ds))
 
+    def copythroughput(s, folder, destlist, fetchstats, writestats):
+        s._printData('copythroughput', "%s\n%s\n%s" % \
+                     (s.folderlist([folder]), s.folderlist(destlist),
+                      "\f".join(["%s\t%d\t%d\t%f\t%f" % \
+                                 (stats.name, stats.messages, stats.bytes,
+                                  stats.busy, stats.stalled) \
+                                 for stats in [fetchstats, writestats]])))
+
+    def syncplan(s, folder, plans, nbytes, roundtrips):
+        for plan in plans:
+            if plan.isempty():
+                continue
+            copies = plan.copylist
+            if plan.storesmessages():
+                copies = plan.newlist + copies
+            s._printData('syncplanstep', "%s\n%s\n%s\n%s\n%s\n%s" % \
+                    (s.folderlist([plan.src]), s.folderlist(plan.applyto),
+                     s.uidlist(copies), s.uidlist(plan.deletelist),
+                     s.flaglist(plan.addflags), s.flaglist(plan.delflags)))
+        s._printData('syncplan', "%s\n%d\n%d" % (folder.getname(), nbytes,
+                                                 roundtrips))
+
+    def flaglist(s, flags):
+        return ("\f".join(["%s\t%s" % (flag, ",".join([str(u) for u in uidlist]))
+                           for flag, uidlist in flags.items()]))
+
     def threadException(s, thread):
         print s.getThreadExceptionString(thread)
         s._printData('threadException', "%s\n%s" % \
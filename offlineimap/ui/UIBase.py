@@ -79,8 +79,11 @@ class UIBase:
 
     def registerthread(s, account):
         """Provides a hint to UIs about which account this particular
-        thread is processing."""
-        if s.threadaccounts.has_key(threading.currentThread()):
+        thread is processing.  Worker pool threads stay registered
+        between tasks, so registering again for the same account is
+        fine."""
+        if s.threadaccounts.get(threading.currentThread(), account) != \
+               account:
             raise ValueError, "Thread %s already registered (old %s, new %s)" %\
                   (threading.currentThread().getName(),
                    s.getthreadaccount(s), account)
@@ -112,6 +115,11 @@ class UIBase:
             if not s._log("DEBUG[%s]: %s" % (debugtype, msg)):
                 s._display("DEBUG[%s]: %s" % (debugtype, msg))
 
+    def isdebugging(s, debugtype):
+        """Returns true if debug messages of debugtype are shown.  Lets
+        hot code paths skip building messages nobody will see."""
+        return debugtype in s.debuglist
+
     def add_debug(s, debugtype):
         global debugtypes
         if debugtype in debugtypes:
@@ -244,6 +252,13 @@ class UIBase:
             s._msg("Copy message %d %s[%s] -> %s" % (uid, s.getnicename(src),
                                                      src.getname(), ds))
 
+    def movingmessages(s, uidlist, src, dest):
+        if s.verbose >= 0:
+            s._msg("Moving %d messages (%s) %s[%s] -> %s[%s]" % \
+                   (len(uidlist), ", ".join([str(u) for u in uidlist]),
+                    s.getnicename(src), src.getname(),
+                    s.getnicename(dest), dest.getname()))
+
     def deletingmessage(s, uid, destlist):
         if s.verbose >= 0:
             ds = s.folderlist(destlist)
@@ -269,6 +284,62 @@ class UIBase:
             s._msg("Deleting flags %s to %d messages on %s" % \
                    (", ".join(flags), len(uidlist), ds))
 
+    def copythroughput(s, folder, destlist, fetchstats, writestats):
+        """Called when messages were copied from folder through a
+        copypipeline.CopyPipeline, with the StageCounters of its fetch
+        and write stages.  Whichever stage waited less for the other is
+        the one holding the copies up."""
+        if s.verbose < 0 or not fetchstats.messages:
+            return
+        rates = []
+        for stats in [fetchstats, writestats]:
+            rate = stats.getrate()
+            if rate == None:
+                rates.append("%s ?" % stats.name)
+            else:
+                rates.append("%s %.1f KB/s" % (stats.name, rate / 1024.0))
+        if fetchstats.stalled > writestats.stalled:
+            bottleneck = writestats.name
+        else:
+            bottleneck = fetchstats.name
+        s._msg("Copied %d messages (%d bytes) %s[%s] -> %s: %s, %s; " \
+               "limited by %s" % \
+               (writestats.messages, writestats.bytes, s.getnicename(folder),
+                folder.getname(), s.folderlist(destlist), rates[0],
+                rates[1], bottleneck))
+
+    def syncplan(s, folder, plans, nbytes, roundtrips):
+        """Called with the syncplan.SyncPlans of a folder sync on a dry
+        run, and what they are estimated to cost."""
+        if s.verbose < 0:
+            return
+        for plan in plans:
+            if plan.isempty():
+                continue
+            actions = []
+            copies = len(plan.copylist)
+            if plan.storesmessages():
+                copies += len(plan.newlist)
+                if copies:
+                    actions.append("copy %d messages (%d bytes)" % \
+                                   (copies, plan.getbytes()))
+            elif copies:
+                actions.append("record %d messages" % copies)
+            if len(plan.deletelist):
+                actions.append("delete %d messages" % len(plan.deletelist))
+            for flag, uidlist in plan.addflags.items():
+                actions.append("add flag %s to %d messages" % \
+                               (flag, len(uidlist)))
+            for flag, uidlist in plan.delflags.items():
+                actions.append("remove flag %s from %d messages" % \
+                               (flag, len(uidlist)))
+            if len(actions):
+                s._msg("Would %s: %s[%s] -> %s" % \
+                       (", ".join(actions), s.getnicename(plan.src),
+                        plan.src.getname(), s.folderlist(plan.applyto)))
+        s._msg("Plan for %s: %d bytes, about %d round trips" % \
+               (folder.getname(), nbytes, roundtrips))
+
     ################################################## Threads
 
     def getThreadDebugLog(s, thread):
@@ -298,6 +369,12 @@ class UIBase:
         s.delThreadDebugLog(thread)
         s.terminate(100)
 
+    def taskException(s, task):
+        """Called when a threadutil.PoolTask has failed with an exception.
+        Unlike a thread, the worker carries on with the next task."""
+        s.warn("Task '%s' failed with exception:\n%s" % \
+               (task.getName(), task.getExitStackTrace()))
+
     def getMainExceptionString(s):
         sbuf = StringIO()
         traceback.print_exc(file = sbuf)
@@ -337,13 +414,15 @@ class UIBase:
         however, call sleeping() which DOES output something.
 
         Returns 0 if timeout expired, 1 if there is a request to cancel
-        the timer, and 2 if there is a request to abort the program."""
+        the timer, 2 if there is a request to abort the program, and 3 if
+        some folders were pushed to us by the server."""
 
         abortsleep = 0
         while sleepsecs > 0 and not abortsleep:
             try:
                 abortsleep = siglistener.get_nowait()
-                # retrieved signal while sleeping: 1 means immediately resynch, 2 means immediately die
+                # retrieved signal while sleeping: 1 means immediately resynch, 2 means immediately die,
+                # 3 means resynch the pushed folders
             except Empty:
                 # no signal
                 abortsleep = s.sleeping(10, sleepsecs)
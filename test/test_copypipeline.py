@@ -0,0 +1,107 @@
+# Tests for offlineimap.copypipeline
+# Copyright (C) 2002-2007 John Goerzen <jgoerzen@complete.org>
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+import os, sys, unittest
+from StringIO import StringIO
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from offlineimap import imaputil
+from offlineimap.copypipeline import CopyPipeline, getsize
+from offlineimap.folder.Base import BaseFolder
+
+class FakeUI:
+    def __init__(self):
+        self.warnings = []
+        self.throughput = None
+    def registerthread(self, account):
+        pass
+    def copyingmessage(self, uid, src, destlist):
+        pass
+    def warn(self, msg):
+        self.warnings.append(msg)
+    def copythroughput(self, folder, destlist, fetchstats, writestats):
+        self.throughput = (fetchstats, writestats)
+
+class SourceFolder(BaseFolder):
+    """Hands out its messages as the real folders do, as
+    imaputil.LineEndingFiles."""
+    def __init__(self, ui, messages, failafter = None):
+        BaseFolder.__init__(self)
+        self.ui = ui
+        self.messages = messages
+        self.failafter = failafter
+    def getvisiblename(self):
+        return 'INBOX'
+    def getaccountname(self):
+        return 'Test'
+    def getmessages(self, uidlist):
+        for count, uid in enumerate(uidlist):
+            if count == self.failafter:
+                raise IOError, "connection lost"
+            yield (uid, imaputil.LineEndingFile(StringIO(self.messages[uid]),
+                                                "\n"), [], None)
+
+class DestFolder:
+    def __init__(self):
+        self.saved = {}
+    def storesmessages(self):
+        return 1
+    def savemessagefile(self, uid, file, flags, rtime):
+        self.saved[uid] = file.read()
+        return uid
+
+class CopyPipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.messages = {}
+        for uid in range(1, 21):
+            self.messages[uid] = "Subject: %d\r\n\r\n%s\r\n" % (uid, 'x' * uid * 100)
+        self.ui = FakeUI()
+        self.dest = DestFolder()
+
+    def testLineEndingFileSize(self):
+        message = imaputil.LineEndingFile(StringIO("a\r\nb\r\n"), "\n")
+        self.assertEqual(message.readline(), "a\n")
+        self.assertEqual(getsize(message), 6)
+        self.assertEqual(message.read(), "b\n")
+
+    def testCopies(self):
+        src = SourceFolder(self.ui, self.messages)
+        # Small enough to make the fetcher wait for the writers.
+        pipeline = CopyPipeline(src, [self.dest], 3000, 2)
+        pipeline.fetch(range(1, 11))
+        pipeline.fetch(range(11, 21))
+        pipeline.finish()
+        self.assertEqual(self.ui.warnings, [])
+        self.assertEqual(sorted(self.dest.saved.keys()), range(1, 21))
+        for uid, content in self.dest.saved.items():
+            self.assertEqual(content, self.messages[uid].replace("\r\n", "\n"))
+        fetchstats, writestats = self.ui.throughput
+        total = sum([len(content) for content in self.messages.values()])
+        self.assertEqual((fetchstats.messages, fetchstats.bytes), (20, total))
+        self.assertEqual((writestats.messages, writestats.bytes), (20, total))
+        self.assertEqual(pipeline.queue.inflight, 0)
+
+    def testFetchFailure(self):
+        src = SourceFolder(self.ui, self.messages, failafter = 3)
+        pipeline = CopyPipeline(src, [self.dest], 3000, 1)
+        pipeline.fetch(range(1, 11))
+        pipeline.finish()
+        self.assertEqual(sorted(self.dest.saved.keys()), [1, 2, 3])
+        self.assertEqual(len(self.ui.warnings), 1)
+        self.assert_("connection lost" in self.ui.warnings[0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+# Tests for offlineimap.folder.LocalStatusSQLite
+# Copyright (C) 2002-2007 John Goerzen <jgoerzen@complete.org>
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+import os, sys, time, shutil, tempfile, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from offlineimap.folder.LocalStatus import LocalStatusFolder
+from offlineimap.folder.LocalStatusSQLite import LocalStatusSQLiteFolder
+
+class FakeConfig:
+    def __init__(self, dryrun = 0):
+        self.dryrun = dryrun
+    def getfsync(self):
+        return False
+    def getdefaultboolean(self, section, option, default):
+        if (section, option) == ('general', 'dryrun'):
+            return self.dryrun
+        return default
+
+class FakeRepository:
+    def __init__(self, directory, plaindirectory):
+        self.directory = directory
+        self.plaindirectory = plaindirectory
+    def getfolderfilename(self, foldername):
+        return os.path.join(self.directory, foldername)
+    def getplainfolderfilename(self, foldername):
+        return os.path.join(self.plaindirectory, foldername)
+
+class SwitchBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.plainrepos = FakeRepository(os.path.join(self.tmpdir, 'plain'),
+                                         os.path.join(self.tmpdir, 'plain'))
+        self.sqliterepos = FakeRepository(os.path.join(self.tmpdir, 'sqlite'),
+                                          os.path.join(self.tmpdir, 'plain'))
+        for directory in ['plain', 'sqlite']:
+            os.mkdir(os.path.join(self.tmpdir, directory))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def getfolder(self, repository, folderclass, dryrun = 0):
+        folder = folderclass(repository.directory, 'INBOX', repository,
+                             'Test', FakeConfig(dryrun))
+        folder.cachemessagelist()
+        return folder
+
+    def getuids(self, folder):
+        return sorted(folder.getmessagelist().keys())
+
+    def testPlainToSQLite(self):
+        plain = self.getfolder(self.plainrepos, LocalStatusFolder)
+        plain.savemessage(1, None, ['S'], 0)
+        plain.savemessage(2, None, [], 0)
+        sqlite = self.getfolder(self.sqliterepos, LocalStatusSQLiteFolder)
+        self.assertEqual(self.getuids(sqlite), [1, 2])
+        self.failIf(os.path.exists(self.plainrepos.getfolderfilename('INBOX')))
+
+    def testSQLiteToPlainAndBack(self):
+        sqlite = self.getfolder(self.sqliterepos, LocalStatusSQLiteFolder)
+        sqlite.savemessage(1, None, ['S'], 0)
+        sqlite.save()
+        sqlite.connection.close()
+        time.sleep(1.1)
+        # Back to plain, which starts over, and syncs more messages.
+        plain = self.getfolder(self.plainrepos, LocalStatusFolder)
+        for uid in [1, 2, 3]:
+            plain.savemessage(uid, None, [], 0)
+        # And to sqlite again: the database is older than the plain
+        # status, which wins.
+        sqlite = self.getfolder(self.sqliterepos, LocalStatusSQLiteFolder)
+        self.assertEqual(self.getuids(sqlite), [1, 2, 3])
+        self.failIf(os.path.exists(self.plainrepos.getfolderfilename('INBOX')))
+
+    def testLeftoverPlainStatus(self):
+        plain = self.getfolder(self.plainrepos, LocalStatusFolder)
+        plain.savemessage(1, None, [], 0)
+        plainfilename = self.plainrepos.getfolderfilename('INBOX')
+        leftover = open(plainfilename).read()
+        sqlite = self.getfolder(self.sqliterepos, LocalStatusSQLiteFolder)
+        sqlite.savemessage(2, None, [], 0)
+        sqlite.save()
+        sqlite.connection.close()
+        # As if the conversion was interrupted before the plain status
+        # was removed.
+        open(plainfilename, "wt").write(leftover)
+        os.utime(plainfilename, (0, 0))
+        sqlite = self.getfolder(self.sqliterepos, LocalStatusSQLiteFolder)
+        self.assertEqual(self.getuids(sqlite), [1, 2])
+        self.failIf(os.path.exists(plainfilename))
+
+    def testDryRun(self):
+        plain = self.getfolder(self.plainrepos, LocalStatusFolder)
+        plain.savemessage(1, None, ['S'], 0)
+        plainfilename = self.plainrepos.getfolderfilename('INBOX')
+        sqlite = self.getfolder(self.sqliterepos, LocalStatusSQLiteFolder,
+                                dryrun = 1)
+        self.assertEqual(self.getuids(sqlite), [1])
+        # Read, but not converted.
+        self.assert_(os.path.exists(plainfilename))
+        self.failIf(os.path.exists(self.sqliterepos.getfolderfilename('INBOX')))
+
+if __name__ == '__main__':
+    unittest.main()
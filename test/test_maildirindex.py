@@ -0,0 +1,158 @@
+# Tests for the scan index of offlineimap.folder.Maildir
+# Copyright (C) 2002-2007 John Goerzen <jgoerzen@complete.org>
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+import os, sys, shutil, tempfile, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from offlineimap.folder import Maildir
+from offlineimap.folder.Maildir import MaildirFolder
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+class FakeUI:
+    def debug(self, debugtype, msg):
+        pass
+
+class FakeConfig:
+    def getfsync(self):
+        return False
+    def getdefaultint(self, section, option, default):
+        return default
+
+class FakeRepository:
+    def __init__(self, indexdir):
+        self.indexdir = indexdir
+    def getscanindexdir(self):
+        return self.indexdir
+    def getscanindex(self):
+        return True
+    def getsep(self):
+        return '.'
+    def checkunchanged(self, foldername):
+        return False
+    def markchanged(self, foldername):
+        pass
+
+class ScanIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmpdir, 'mail')
+        self.indexdir = os.path.join(self.tmpdir, 'index')
+        os.mkdir(self.indexdir)
+        for dirannex in ['cur', 'new', 'tmp']:
+            os.makedirs(os.path.join(self.root, 'INBOX', dirannex))
+        self.folderstr = ',FMD5=' + md5('INBOX').hexdigest()
+        self.tick = 1000
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def getfolder(self):
+        folder = MaildirFolder(self.root, 'INBOX', '.',
+                               FakeRepository(self.indexdir), 'Test',
+                               FakeConfig())
+        folder.ui = FakeUI()
+        return folder
+
+    def touch(self, dirannex):
+        # An old mtime that differs each time, which the index trusts.
+        self.tick += 1
+        os.utime(os.path.join(self.root, 'INBOX', dirannex),
+                 (self.tick, self.tick))
+
+    def getname(self, uid, flags):
+        return '%d_%d.host,U=%d%s:2,%s' % (1200000000 + uid, uid, uid,
+                                           self.folderstr, flags)
+
+    def add(self, uid, flags):
+        open(os.path.join(self.root, 'INBOX', 'cur',
+                          self.getname(uid, flags)), 'w').close()
+        self.touch('cur')
+
+    def rename(self, uid, oldflags, newflags):
+        dirname = os.path.join(self.root, 'INBOX', 'cur')
+        os.rename(os.path.join(dirname, self.getname(uid, oldflags)),
+                  os.path.join(dirname, self.getname(uid, newflags)))
+        self.touch('cur')
+
+    def scan(self):
+        messages = self.getfolder()._scanfolder()
+        return dict([(uid, ''.join(messages[uid]['flags'])) \
+                     for uid in messages.keys()])
+
+    def getlines(self):
+        file = open(self.getfolder()._getindexfilename())
+        try:
+            return file.readlines()
+        finally:
+            file.close()
+
+    def testJournal(self):
+        for uid in range(1, 4):
+            self.add(uid, 'S')
+        self.touch('new')
+        self.assertEqual(self.scan(), {1: 'S', 2: 'S', 3: 'S'})
+        written = len(self.getlines())
+        self.rename(2, 'S', 'RS')
+        os.unlink(os.path.join(self.root, 'INBOX', 'cur',
+                               self.getname(3, 'S')))
+        self.touch('cur')
+        self.assertEqual(self.scan(), {1: 'S', 2: 'RS'})
+        # Only the changes got appended: the rename, as a removal and an
+        # addition, the removal, and the new mtime of cur/.
+        self.assertEqual(len(self.getlines()), written + 4)
+        # And they read back the same.
+        self.assertEqual(self.scan(), {1: 'S', 2: 'RS'})
+
+    def testTornRecord(self):
+        self.add(1, 'S')
+        self.touch('new')
+        self.scan()
+        self.add(2, 'S')
+        self.scan()
+        # As if the last append was cut short.
+        filename = self.getfolder()._getindexfilename()
+        data = open(filename).read()
+        open(filename, 'w').write(data[:-3])
+        # The new mtime of cur/ is lost with it, so cur/ is listed again.
+        index, records = self.getfolder()._loadindex()
+        self.assertEqual(index['cur'][0], self.tick - 2)
+        self.assertEqual(self.scan(), {1: 'S', 2: 'S'})
+        self.assertEqual(self.scan(), {1: 'S', 2: 'S'})
+
+    def testCompaction(self):
+        self.add(1, '')
+        self.touch('new')
+        self.scan()
+        flags = ''
+        for flag in 'DFRST' * 250:
+            newflags = ''.join(sorted(set(flags + flag)))
+            if newflags == flags:
+                newflags = flag
+            self.rename(1, flags, newflags)
+            flags = newflags
+            self.scan()
+        # Rewritten now and then with what it holds; the magic line, the
+        # message and the mtimes of new/ and cur/ at the least.
+        self.assert_(len(self.getlines()) < 2 * 3 + 1000 + 5)
+        self.assertEqual(self.scan(), {1: flags})
+        self.assertEqual(self.getlines()[0].strip(), Maildir.indexmagicline)
+
+if __name__ == '__main__':
+    unittest.main()
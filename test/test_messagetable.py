@@ -0,0 +1,81 @@
+# Tests for offlineimap.messagetable
+# Copyright (C) 2002-2007 John Goerzen <jgoerzen@complete.org>
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+import os, sys, random, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from offlineimap.messagetable import MessageTable, diffmessagelists
+
+class MessageTableTest(unittest.TestCase):
+    def setUp(self):
+        self.table = MessageTable()
+        for uid in [1, 2, 4, 5]:
+            self.table[uid] = {'uid': uid, 'flags': ['S'], 'time': None}
+
+    def testViewAfterUnsortedWrite(self):
+        view = self.table[5]
+        # Out of order, so that the next write is appended too.
+        self.table[3] = {'uid': 3, 'flags': [], 'time': None}
+        self.table[5] = {'uid': 5, 'flags': ['F'], 'time': None}
+        self.assertEqual(view['flags'], ['F'])
+        view['flags'] = ['R']
+        self.assertEqual(self.table[5]['flags'], ['R'])
+        self.assertEqual(self.table.keys(), [1, 2, 3, 4, 5])
+
+    def testRandomOrder(self):
+        table = MessageTable()
+        uids = range(1, 5001)
+        random.Random(42).shuffle(uids)
+        view = None
+        for uid in uids:
+            # As the folders' savemessage() do before each insert.
+            self.failIf(uid in table)
+            table[uid] = {'uid': uid, 'flags': ['S'], 'time': None}
+            self.assert_(uid in table)
+            if uid == 2500:
+                view = table[uid]
+        self.assertEqual(len(table), 5000)
+        view['flags'] = ['R']
+        self.assertEqual(table.keys(), range(1, 5001))
+        self.assertEqual(table[2500]['flags'], ['R'])
+        self.assertEqual(table.get(1)['flags'], ['S'])
+
+    def testUpdateInTail(self):
+        self.table[3] = {'uid': 3, 'flags': [], 'time': None}
+        self.table[3] = {'uid': 3, 'flags': ['F'], 'time': None}
+        self.assertEqual(len(self.table), 5)
+        self.assertEqual(self.table[3]['flags'], ['F'])
+        del self.table[3]
+        self.assertEqual(self.table.keys(), [1, 2, 4, 5])
+
+    def testViewAfterDelete(self):
+        view = self.table[5]
+        del self.table[1]
+        view['flags'] = ['R', 'S']
+        self.assertEqual(self.table[5]['flags'], ['R', 'S'])
+        del self.table[5]
+        self.assertRaises(KeyError, view.__getitem__, 'flags')
+
+    def testOtherFlags(self):
+        self.table[2] = {'uid': 2, 'flags': ['S', 'a'], 'time': None}
+        self.assertEqual(sorted(self.table[2]['flags']), ['S', 'a'])
+        other = MessageTable(self.table)
+        other[2] = {'uid': 2, 'flags': ['S'], 'time': None}
+        self.assertEqual(diffmessagelists(self.table, other),
+                         ([], [], {'a': [2]}, {}))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,218 @@
+# Tests for offlineimap.syncplan
+# Copyright (C) 2002-2007 John Goerzen <jgoerzen@complete.org>
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+import os, sys, random, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from offlineimap.folder.Base import BaseFolder
+from offlineimap.messagetable import MessageTable
+from offlineimap.syncplan import planfolder
+
+class FakeUI:
+    def __init__(self):
+        self.warnings = []
+    def warn(self, msg, minor = 0):
+        self.warnings.append(msg)
+    def __getattr__(self, name):
+        # registerthread(), copyingmessage() and the other progress
+        # reports.
+        return lambda *args, **kwargs: None
+
+class FakeConfig:
+    def getinflightbytes(self):
+        return 0
+
+class MemoryFolder(BaseFolder):
+    """A folder kept in memory.  With assignsuids, it gives each message
+    saved to it a new UID, as an IMAP server does; without storesmessages,
+    it only keeps UIDs and flags, as the status folder does."""
+
+    def __init__(self, name, ui, messages, assignsuids = 0,
+                 storesmessages = 1):
+        BaseFolder.__init__(self)
+        self.name = name
+        self.ui = ui
+        self.config = FakeConfig()
+        self.repository = None
+        self.assignsuids = assignsuids
+        self.stores = storesmessages
+        self.nextuid = 1000
+        self.messagelist = MessageTable()
+        self.bodies = {}
+        for uid, flags in messages.items():
+            self.messagelist[uid] = {'uid': uid, 'flags': list(flags),
+                                     'time': None}
+            if storesmessages:
+                self.bodies[uid] = 'body of %d\n' % uid
+
+    def getaccountname(self):
+        return 'Test'
+
+    def storesmessages(self):
+        return self.stores
+
+    def getmessagelist(self):
+        return self.messagelist
+
+    def getmessage(self, uid):
+        return self.bodies[uid]
+
+    def getmessageflags(self, uid):
+        return self.messagelist[uid]['flags']
+
+    def getmessagetime(self, uid):
+        return None
+
+    def savemessageflags(self, uid, flags):
+        self.messagelist[uid]['flags'] = flags
+
+    def savemessage(self, uid, content, flags, rtime):
+        if self.assignsuids:
+            uid = self.nextuid
+            self.nextuid += 1
+        elif uid < 0:
+            return uid
+        elif uid in self.messagelist:
+            self.savemessageflags(uid, flags)
+            return uid
+        self.messagelist[uid] = {'uid': uid, 'flags': sorted(flags),
+                                 'time': rtime}
+        if self.stores:
+            self.bodies[uid] = content
+        return uid
+
+    def deletemessage(self, uid):
+        if uid in self.messagelist:
+            del self.messagelist[uid]
+            self.bodies.pop(uid, None)
+
+    def getstate(self):
+        return dict([(uid, (''.join(sorted(message['flags'])),
+                            self.bodies.get(uid))) \
+                     for uid, message in self.messagelist.items()])
+
+def warnonerror(folder, func, *args):
+    """Calls func as BaseFolder.syncmessagesto() did its passes: with
+    errors turned into warnings."""
+    try:
+        return func(*args)
+    except (KeyboardInterrupt):
+        raise
+    except:
+        folder.ui.warn("ERROR in %s: %s" % (func.__name__,
+                                            sys.exc_info()[1]))
+
+def oldsyncmessagesto(src, dest, applyto = None):
+    """BaseFolder.syncmessagesto() as it was before SyncPlan: the passes
+    one after the other, the last three from one diff."""
+    if applyto == None:
+        applyto = [dest]
+    warnonerror(src, src.syncmessagesto_neguid, dest, applyto)
+    diff = src.getsyncdiff(dest)
+    src.syncmessagesto_copy(dest, applyto, diff)
+    warnonerror(src, src.syncmessagesto_delete, dest, applyto, diff)
+    warnonerror(src, src.syncmessagesto_flags, dest, applyto, diff)
+
+def oldsyncfolder(remote, local, status, statusisnew):
+    """The passes of accounts.syncfolder() as it was before planfolder()."""
+    if not statusisnew:
+        remote.syncmessagesto_delete(local, [local, status])
+        oldsyncmessagesto(local, status, [remote, status])
+    oldsyncmessagesto(remote, local, [local, status])
+    oldsyncmessagesto(local, status)
+
+def plannedsyncfolder(remote, local, status, statusisnew):
+    """The passes of accounts.syncfolder() now."""
+    plans = planfolder(remote, local, status, statusisnew = statusisnew)
+    for plan in plans[:-1]:
+        plan.executechanges()
+    for plan in plans[:-1]:
+        plan.executecopies()
+    local.syncmessagesto(status)
+
+class PlanFolderTest(unittest.TestCase):
+    def sync(self, syncfunc, remote, local, status, statusisnew):
+        ui = FakeUI()
+        folders = [MemoryFolder('remote', ui, remote, assignsuids = 1),
+                   MemoryFolder('local', ui, local),
+                   MemoryFolder('status', ui, status, storesmessages = 0)]
+        syncfunc(*(folders + [statusisnew]))
+        return [folder.getstate() for folder in folders], ui.warnings
+
+    def check(self, remote, local, status, statusisnew = 0, warns = 0):
+        """Returns the end state of the remote, local and status folders
+        after a planned sync, checking that it is the same as with the
+        old passes.  Unless warns, neither may run into errors."""
+        new, newwarnings = self.sync(plannedsyncfolder, remote, local,
+                                     status, statusisnew)
+        old, oldwarnings = self.sync(oldsyncfolder, remote, local, status,
+                                     statusisnew)
+        self.assertEqual(new, old)
+        if not warns:
+            self.assertEqual(newwarnings, [])
+            self.assertEqual(oldwarnings, [])
+        return [dict([(uid, flags) for uid, (flags, body) \
+                      in state.items()]) for state in new]
+
+    def testRemoteDeleteLocalFlag(self):
+        # 2 was deleted on the server and flagged locally; 1 was
+        # answered locally.
+        remote, local, status = self.check({1: 'S'},
+                                           {1: 'RS', 2: 'FS'},
+                                           {1: 'S', 2: 'S'})
+        self.assertEqual(remote, {1: 'RS'})
+        self.assertEqual(local, {1: 'RS'})
+        self.assertEqual(status, {1: 'RS'})
+
+    def testLocalNewMessage(self):
+        remote, local, status = self.check({1: 'S', 2: ''},
+                                           {1: 'S', -1: 'S'},
+                                           {1: 'S'})
+        # Uploaded, and renamed locally to the UID the server gave it.
+        self.assertEqual(remote, {1: 'S', 2: '', 1000: 'S'})
+        self.assertEqual(local, remote)
+        self.assertEqual(status, remote)
+
+    def testNewStatusFolder(self):
+        # Without a status, local messages the server lacks are taken to
+        # be deleted on the server.
+        remote, local, status = self.check({1: 'S', 2: 'F'},
+                                           {1: 'S', 3: 'S'}, {},
+                                           statusisnew = 1)
+        self.assertEqual(remote, {1: 'S', 2: 'F'})
+        self.assertEqual(local, remote)
+        self.assertEqual(status, local)
+
+    def testRandomStates(self):
+        rand = random.Random(42)
+        for i in range(200):
+            remote, local, status = {}, {}, {}
+            for uid in range(1, 9):
+                flags = [''.join(rand.sample('FRS', rand.randint(0, 2))) \
+                         for j in range(3)]
+                for messages, flag in zip([remote, local, status], flags):
+                    if rand.random() < 0.8:
+                        messages[uid] = flag
+            for uid in range(-2, 0):
+                if rand.random() < 0.5:
+                    local[uid] = rand.choice(['', 'S'])
+            # Flag changes to messages the status folder lacks fail in
+            # either order, and the following passes mend them.
+            self.check(remote, local, status, rand.random() < 0.1,
+                       warns = 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+# Tests for the worker pools of offlineimap.threadutil
+# Copyright (C) 2002-2007 John Goerzen <jgoerzen@complete.org>
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+import os, sys, threading, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from offlineimap.threadutil import WorkerPool
+
+def exit():
+    raise SystemExit
+
+class WorkerPoolTest(unittest.TestCase):
+    def getpool(self, workers):
+        pool = WorkerPool('test', workers)
+        # Idle threads go away soon, for joinworkers().
+        pool.idletime = 0.1
+        return pool
+
+    def joinworkers(self):
+        for thread in threading.enumerate():
+            if thread.getName() == 'test worker':
+                thread.join()
+
+    def tearDown(self):
+        # Not to leave threads behind at interpreter shutdown.
+        self.joinworkers()
+
+    def testResults(self):
+        pool = self.getpool(2)
+        tasks = [pool.submit(pow, (2, i)) for i in range(5)]
+        for task in tasks:
+            task.wait()
+        self.assertEqual([task.getResult() for task in tasks],
+                         [1, 2, 4, 8, 16])
+
+    def testExitingTask(self):
+        pool = self.getpool(1)
+        task = pool.submit(exit)
+        task.wait()
+        # The thread that made the call is gone; the next call gets a
+        # new one rather than waiting forever.
+        self.joinworkers()
+        self.assertEqual(pool.running, 0)
+        task = pool.submit(pow, (2, 3))
+        task.done.wait(10)
+        self.assert_(task.done.isSet())
+        self.assertEqual(task.getResult(), 8)
+
+if __name__ == '__main__':
+    unittest.main()
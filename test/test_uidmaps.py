@@ -0,0 +1,126 @@
+# Tests for the map file of offlineimap.folder.UIDMaps
+# Copyright (C) 2002-2007 John Goerzen <jgoerzen@complete.org>
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+import os, sys, shutil, tempfile, unittest
+from threading import Lock
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from offlineimap.folder import UIDMaps
+from offlineimap.folder.UIDMaps import MappingFolderMixIn
+
+class FakeUI:
+    def debug(self, debugtype, msg):
+        pass
+
+class FakeRepository:
+    def __init__(self, mapdir):
+        self.mapdir = mapdir
+    def getmapdir(self):
+        return self.mapdir
+
+class MapFolder(MappingFolderMixIn):
+    """Just the map file half of a mapped folder."""
+    def __init__(self, mapdir):
+        self.repository = FakeRepository(mapdir)
+        self.ui = FakeUI()
+        self.maplock = Lock()
+    def getfolderbasename(self):
+        return 'INBOX'
+
+class MapFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'INBOX')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        UIDMaps.mapcompactslack = 1000
+
+    def write(self, data):
+        open(self.filename, 'wb').write(data)
+
+    def read(self):
+        return open(self.filename, 'rb').read()
+
+    def load(self, data):
+        """Returns the folder and its l2r map after loading data."""
+        self.write(data)
+        folder = MapFolder(self.tmpdir)
+        r2l, l2r = folder._loadmaps()
+        self.assertEqual(r2l, dict([(v, k) for k, v in l2r.items()]))
+        return folder, l2r
+
+    def getrecords(self):
+        lines = self.read().splitlines()
+        lines.sort()
+        return lines
+
+    def testTornRecord(self):
+        folder, l2r = self.load("1:100\n2:200\n3:3")
+        self.assertEqual(l2r, {1: 100, 2: 200})
+        self.assertEqual(self.read(), "1:100\n2:200\n")
+        # And it loads the same the next time.
+        folder, l2r = self.load(self.read())
+        self.assertEqual(l2r, {1: 100, 2: 200})
+        self.assertEqual(folder.maprecords, 2)
+
+    def testBadRecord(self):
+        self.write("1:100\nnonsense\n2:200\n")
+        self.assertRaises(ValueError, MapFolder(self.tmpdir)._loadmaps)
+        # Left alone.
+        self.assertEqual(self.read(), "1:100\nnonsense\n2:200\n")
+
+    def testReplace(self):
+        # 1 gets mapped to 300 in place of 100, and 200 to 3 in place
+        # of 2.
+        folder, l2r = self.load("1:100\n2:200\n1:300\n3:200\n")
+        self.assertEqual(l2r, {1: 300, 3: 200})
+        # The replaced records got compacted away.
+        self.assertEqual(self.getrecords(), ['1:300', '3:200'])
+        self.assertEqual(folder.maprecords, 2)
+
+    def testDelete(self):
+        # The second delete is of a mapping that is not there.
+        folder, l2r = self.load("1:100\n2:200\nD1:100\nD2:300\n")
+        self.assertEqual(l2r, {2: 200})
+        self.assertEqual(self.getrecords(), ['2:200'])
+
+    def testAppendAndCompact(self):
+        UIDMaps.mapcompactslack = 10
+        folder, l2r = self.load("1:100\n2:200\n")
+        folder.diskl2r = l2r
+        folder.maplock.acquire()
+        try:
+            for ruid in range(300, 307):
+                # Remapping 2 takes two records each time, a delete and
+                # an add.
+                oldruid = folder.diskl2r[2]
+                folder.diskl2r[2] = ruid
+                folder._appendmaps([(2, ruid)], [(2, oldruid)])
+                if folder.maprecords > 2:
+                    self.assertEqual(len(self.getrecords()),
+                                     folder.maprecords)
+        finally:
+            folder.maplock.release()
+        # 2 + 7 * 2 = 16 records would be more than 2 * 2 + 10 of them,
+        # so the last append compacted the file instead.
+        self.assertEqual(folder.maprecords, 2)
+        self.assertEqual(self.getrecords(), ['1:100', '2:306'])
+        folder, l2r = self.load(self.read())
+        self.assertEqual(l2r, {1: 100, 2: 306})
+
+if __name__ == '__main__':
+    unittest.main()